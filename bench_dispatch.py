@@ -0,0 +1,84 @@
+"""Сравнение стоимости диспетчеризации сообщения: старые фильтры or_f(Command, F.text.lower()...) против classify_command.
+
+Обработчики в обоих вариантах пустые, поэтому время — это чистая цена выбора обработчика aiogram'ом.
+Запуск: python bench_dispatch.py [число сообщений]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("DB_URL", "postgresql://bench")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import logging
+logging.disable(logging.CRITICAL)
+
+from aiogram import Dispatcher, F, Router, types
+from aiogram.filters import Command, or_f
+
+import main
+
+
+def _noop(name: str):
+    async def handler(message: types.Message): return None
+    handler.__name__ = name
+    return handler
+
+
+def build_legacy() -> Dispatcher:
+    # Те же команды и в том же порядке, что и до классификатора: по фильтру на обработчик.
+    dp = Dispatcher()
+    for name, (aliases, bare) in main.COMMANDS.items():
+        filters = [Command(*aliases)]
+        if bare in (main.BARE_EXACT, main.BARE_ANY): filters.append(F.text.lower().in_(list(aliases)))
+        if bare in (main.BARE_ARGS, main.BARE_ANY): filters.append(F.text.lower().startswith(tuple(f"{alias} " for alias in aliases)))
+        dp.message.register(_noop(name), or_f(*filters) if len(filters) > 1 else filters[0])
+    dp.message.register(_noop("track_user_activity"), F.chat.type.in_({'group', 'supergroup'}))
+    return dp
+
+
+def build_classified() -> Dispatcher:
+    dp = Dispatcher()
+    dp.message.outer_middleware(main.classify_command)
+    commands, messages = Router(), Router()
+    commands.message.filter(main.CommandRoute())
+    for name in main.COMMANDS: commands.message.register(_noop(name), main.CommandRoute(name))
+    messages.message.register(_noop("track_user_activity"), F.chat.type.in_({'group', 'supergroup'}))
+    dp.include_routers(commands, messages)
+    return dp
+
+
+def make_updates(count: int, command_share: float):
+    rng = random.Random(42)
+    chat, user = types.Chat(id=-100, type="supergroup"), types.User(id=5, is_bot=False, first_name="A")
+    chatter = ["привет всем", "кто играет сегодня?", "ахах", "ну да", "вечером зайду", "ok", "лол, это было круто"]
+    commands = ["казино 100", "/profile", "профиль", "топ неделя", "пинг 3", "/casino 50", "ник Змей", "охота"]
+    updates = []
+    for i in range(count):
+        text = rng.choice(commands) if rng.random() < command_share else rng.choice(chatter)
+        updates.append(types.Update(update_id=i, message=types.Message(message_id=i, date=datetime.now(), chat=chat, from_user=user, text=text)))
+    return updates
+
+
+async def measure(dp: Dispatcher, updates) -> float:
+    for update in updates[:200]: await dp.feed_update(main.bot, update)  # прогрев
+    started = time.perf_counter()
+    for update in updates: await dp.feed_update(main.bot, update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+
+async def run(count: int):
+    print(f"{'сообщения':<28}{'до, мкс':>10}{'после, мкс':>12}{'ускорение':>11}")
+    for title, share in (("только обычный текст", 0.0), ("5% команд", 0.05), ("только команды", 1.0)):
+        updates = make_updates(count, share)
+        before, after = await measure(build_legacy(), updates), await measure(build_classified(), updates)
+        print(f"{title:<28}{before:>10.1f}{after:>12.1f}{before / after:>10.1f}x")
+    await main.bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
@@ -1,21 +1,39 @@
 import logging
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import os
 import json
 import asyncio
+import hmac
 import html
+import re
+import sys
+import csv
+import io
+import time
+import heapq
+import multiprocessing
+import queue
+import signal
+from collections import OrderedDict, Counter
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 import asyncpg
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandObject, or_f
+from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram.filters import CommandObject, Filter
 from aiogram.enums import ChatMemberStatus, ParseMode
 from aiogram.utils.markdown import hlink
 from aiogram.types import CallbackQuery, Message, LabeledPrice, PreCheckoutQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiohttp import web
+
+import storage
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
@@ -38,129 +56,1374 @@ QUIZ_SUCCESS_COOLDOWN_HOURS = 15
 QUIZ_FAIL_COOLDOWN_HOURS = 5
 QUIZ_QUESTION_TIME_SECONDS = 30
 QUIZ_MAX_QUESTIONS = 3
+QUIZ_DECK_CACHE_SIZE = int(os.getenv("QUIZ_DECK_CACHE_SIZE", "50000"))
 MARRIAGE_MIN_LEVEL = 35
 PET_MIN_LEVEL = 55
 MARRIAGE_COST = 250
 PET_DEATH_DAYS = 2
 NICKNAME_MIN_LENGTH = 2
 NICKNAME_MAX_LENGTH = 20
+TOP_LIMIT = 10
+
+# --- НАСТРОЙКИ КЭША ---
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL", "300"))
+LEDGER_FLUSH_INTERVAL_MS = int(os.getenv("LEDGER_FLUSH_INTERVAL_MS", "500"))
+LEDGER_FLUSH_MAX_ROWS = int(os.getenv("LEDGER_FLUSH_MAX_ROWS", "500"))
+ACTIVITY_FLUSH_INTERVAL_SECONDS = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", "50000"))
+NAME_NEGATIVE_TTL_SECONDS = int(os.getenv("NAME_NEGATIVE_TTL", "3600"))
+NAME_FLUSH_INTERVAL_SECONDS = float(os.getenv("NAME_FLUSH_INTERVAL", "30"))
+
+# --- НАСТРОЙКИ МАСШТАБИРОВАНИЯ ---
+# WORKERS > 1 — главный процесс получает апдейты и раздаёт их WORKERS процессам по id чата (или пользователя),
+# так что все апдейты одного чата обрабатывает один процесс и в порядке поступления. WORKER_INDEX выставляет главный процесс.
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+# Хранилище FSM: postgres (общее для всех процессов и переживает рестарт) или memory. aiogram читает состояние
+# на каждый апдейт, поэтому в одном процессе по умолчанию memory: обычное сообщение не должно стоить запроса к БД.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres" if WORKERS > 1 else "memory").lower()
+# Имя процесса в PostgreSQL (application_name): по нему воркер отличает NOTIFY о своих же записях от чужих.
+DB_APPLICATION_NAME = f"newbot-worker-{WORKER_INDEX}" if WORKER_INDEX >= 0 else "newbot"
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "20000"))
+
+# --- НАСТРОЙКИ ИСХОДЯЩИХ СООБЩЕНИЙ ---
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 сообщений/мин в одну группу, ~1 сообщение/с в личку.
+# Глобальный лимит очереди ниже 30, чтобы оставить запас для прямых ответов обработчиков.
+# Глобальный лимит делится между процессами; лимиты на чат — нет, потому что чат всегда в одном процессе.
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25")) / WORKERS
+OUTBOX_GROUP_RATE_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_RATE_PER_MINUTE", "20"))
+OUTBOX_PRIVATE_RATE = float(os.getenv("OUTBOX_PRIVATE_RATE", "1"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+OUTBOX_DRAIN_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "10"))
+OUTBOX_HIGH, OUTBOX_NORMAL, OUTBOX_LOW = 0, 1, 2
+SCHEDULER_FLUSH_INTERVAL_SECONDS = float(os.getenv("SCHEDULER_FLUSH_INTERVAL", "1"))
+PET_SWEEP_INTERVAL_SECONDS = float(os.getenv("PET_SWEEP_INTERVAL", "60"))
+SUBSCRIPTION_SWEEP_INTERVAL_SECONDS = float(os.getenv("SUBSCRIPTION_SWEEP_INTERVAL", "60"))
+
+# --- НАСТРОЙКИ ПОДКЛЮЧЕНИЯ К БД ---
+# Пул PostgreSQL открывает DB_POOL_MIN_SIZE соединений сразу при запуске (параллельно), до DB_POOL_MAX_SIZE — по требованию.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Простаивающее дольше стольких секунд соединение сверх минимума закрывается (0 — никогда).
+DB_POOL_MAX_INACTIVE_SECONDS = float(os.getenv("DB_POOL_MAX_INACTIVE", "300"))
+# Кэш подготовленных запросов asyncpg на соединение; за PgBouncer в режиме transaction его нужно выключить (0).
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "200"))
+# Запрос дольше DB_COMMAND_TIMEOUT секунд прерывается. Свободного соединения ждём не дольше DB_ACQUIRE_TIMEOUT секунд:
+# при всплеске нагрузки обработчик получает ошибку сразу, а не копится в очереди к пулу (0 — ждать без ограничения).
+DB_COMMAND_TIMEOUT_SECONDS = float(os.getenv("DB_COMMAND_TIMEOUT", "10")) or None
+DB_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("DB_ACQUIRE_TIMEOUT", "3")) or None
+# Недоступная при запуске БД — не повод падать: повторяем с экспоненциальной задержкой до DB_CONNECT_BACKOFF_MAX секунд.
+DB_CONNECT_ATTEMPTS = int(os.getenv("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_BACKOFF_SECONDS = float(os.getenv("DB_CONNECT_BACKOFF", "0.5"))
+DB_CONNECT_BACKOFF_MAX_SECONDS = float(os.getenv("DB_CONNECT_BACKOFF_MAX", "30"))
+
+# --- НАСТРОЙКИ ДИАГНОСТИКИ БД ---
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Границы корзин гистограмм задержек (запросы к БД и обработчики), в секундах.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Эндпоинт /metrics в формате Prometheus; порт 0 отключает его.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# DB_URL=sqlite:///путь/bot.db — SQLite вместо PostgreSQL (локальный запуск, CI). Изменения фиксируются пачкой раз в
+# SQLITE_COMMIT_INTERVAL_MS или после SQLITE_COMMIT_MAX_WRITES операторов, так что при падении теряется только последний интервал.
+SQLITE_PATH = storage.sqlite_path(DATABASE_URL)
+SQLITE_COMMIT_INTERVAL_MS = int(os.getenv("SQLITE_COMMIT_INTERVAL_MS", "50"))
+SQLITE_COMMIT_MAX_WRITES = int(os.getenv("SQLITE_COMMIT_MAX_WRITES", "1000"))
+if WORKERS > 1 and SQLITE_PATH is not None:
+    logger.critical("КРИТИЧЕСКАЯ ОШИБКА: с SQLite бот работает только в одном процессе, уберите WORKERS или используйте PostgreSQL.")
+    exit()
+
+# --- НАСТРОЙКИ ВЕБХУКА ---
+# BOT_MODE=webhook — получать апдейты через вебхук вместо long polling. Без WEBHOOK_URL сервер поднимается,
+# но вебхук у Telegram не регистрируется — так удобно проверять локально, отправляя записанные апдейты POST-запросом.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Без WEBHOOK_SECRET любой, кто достучится до порта, может прислать поддельный апдейт (например, successful_payment),
+# поэтому без секрета сервер слушает только 127.0.0.1 и только для локальной проверки, без регистрации в Telegram.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0" if WEBHOOK_SECRET else "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET and (WEBHOOK_URL or WEBHOOK_HOST not in ("127.0.0.1", "localhost", "::1")):
+    logger.critical("КРИТИЧЕСКАЯ ОШИБКА: вебхук без WEBHOOK_SECRET принимал бы поддельные апдейты. Задайте WEBHOOK_SECRET.")
+    exit()
 
 PET_ACTIONS_COST = { "feed": 1, "grow": 5, "water": 2, "walk": 3 }
 EGGS = { "common": {"name": "🥚 Обычное яйцо", "cost": 150, "rarity": "common"}, "rare": {"name": "💎 Редкое яйцо", "cost": 500, "rarity": "rare"}, "legendary": {"name": "⚜️ Легендарное яйцо", "cost": 1500, "rarity": "legendary"}, "mythic": {"name": "✨ Мифическое яйцо", "cost": 5000, "rarity": "mythic"} }
 CASINO_PAYOUTS = { "red": 2, "black": 2, "green": 10 }
 CASINO_WEIGHTS = { "red": 47.5, "black": 47.5, "green": 5.0 }
 CASINO_ANIMATION_FRAMES = ["🔴", "⚫️", "🔴", "⚫️", "🔴", "⚫️", "💚", "🔴", "⚫️", "🔴"]
+CASINO_FRAME_DELAY_SECONDS = 0.4
+CASINO_MAX_EDITS_PER_SECOND = float(os.getenv("CASINO_MAX_EDITS_PER_SECOND", "1"))
+# Промежуточные кадры берут токены из лимита чата в очереди исходящих только сверх этой доли ёмкости:
+# остаток лимита всегда достаётся обычным сообщениям (пингам, уведомлениям), анимация — в последнюю очередь.
+CASINO_CHAT_BUDGET_RESERVE = float(os.getenv("CASINO_CHAT_BUDGET_RESERVE", "0.5"))
+# Облегчённый режим включается, когда одновременно крутится больше рулеток, чем указано (всего или в одном чате).
+CASINO_LITE_GLOBAL_SPINS = int(os.getenv("CASINO_LITE_GLOBAL_SPINS", "20"))
+CASINO_LITE_CHAT_SPINS = int(os.getenv("CASINO_LITE_CHAT_SPINS", "3"))
+CASINO_LITE_STYLE = os.getenv("CASINO_LITE_STYLE", "edit")  # "edit" — только итоговая правка, "dice" — нативная анимация 🎰
+# Повторное нажатие той же кнопки тем же пользователем в течение этого времени после обработки первого игнорируется.
+CALLBACK_DEDUP_SECONDS = float(os.getenv("CALLBACK_DEDUP_SECONDS", "1.5"))
 PET_SPECIES = { "common": [{"species_name": "Полоз", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}, {"species_name": "Уж", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}], "rare": [{"species_name": "Гадюка", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}, {"species_name": "Эфа", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}], "legendary": [{"species_name": "Питон", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}, {"species_name": "Кобра", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}], "mythic": [{"species_name": "Василиск", "images": {1: "https://i.imgur.com/example.png", 10: "https://i.imgur.com/example.png", 35: "https://i.imgur.com/example.png"}}]}
+PET_SPECIES_BY_NAME = {species['species_name']: species for variants in PET_SPECIES.values() for species in variants}
 PING_MESSAGES = [ "чем занимаешься?", "заходи на игру?", "как насчет катки?", "го общаться!", "скучно, давай поговорим?", "кто со мной?", "есть кто живой?", "не спим!", "вы где все?", "нужна компания", "ауууу!", "давайте поболтаем", "собираю пати", "кто в игру?", "какие планы?"]
-recent_users_activity = {}
-ping_cooldowns = {}
+# Кандидаты для /ping: кто писал в чат за последние PING_ACTIVITY_WINDOW секунд (не больше PING_MAX_USERS_PER_CHAT на чат).
+PING_ACTIVITY_WINDOW_SECONDS = int(os.getenv("PING_ACTIVITY_WINDOW", str(3 * 24 * 3600)))
+PING_MAX_USERS_PER_CHAT = int(os.getenv("PING_MAX_USERS_PER_CHAT", "1000"))
+PING_MAX_CHATS = int(os.getenv("PING_MAX_CHATS", "20000"))
+PING_COOLDOWN_SECONDS = 300
+PING_TARGETS = 3
+
+# --- ХРАНИЛИЩЕ FSM ---
+# Состояния и данные FSM в таблице fsm_storage. Апдейты одного чата всегда попадают в один процесс,
+# поэтому процесс может держать сквозной кэш своих ключей и читать БД только при первом обращении к ключу.
+class PostgresStorage(BaseStorage):
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    async def _load(self, key: str):
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry
+        row = await db_execute("SELECT state, data FROM fsm_storage WHERE storage_key = $1", key, fetch='one')
+        return self._remember(key, (row['state'], json.loads(row['data'])) if row else (None, {}))
+
+    def _remember(self, key: str, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        return entry
+
+    async def _save(self, key: str, state, data: dict):
+        self._remember(key, (state, data))
+        if state is None and not data: await db_execute("DELETE FROM fsm_storage WHERE storage_key = $1", key)
+        else: await db_execute("INSERT INTO fsm_storage (storage_key, state, data) VALUES ($1, $2, $3::jsonb) ON CONFLICT (storage_key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data", key, state, json.dumps(data, ensure_ascii=False))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self._key(key)
+        _, data = await self._load(key)
+        await self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        key = self._key(key)
+        state, _ = await self._load(key)
+        await self._save(key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._load(self._key(key)))[1])
+
+    async def close(self) -> None: self._cache.clear()
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+dp = Dispatcher(storage=PostgresStorage(FSM_CACHE_SIZE) if FSM_STORAGE == "postgres" else MemoryStorage())
 db_pool = None
 
+# --- МАРШРУТИЗАЦИЯ КОМАНД ---
+# Вместо десятков фильтров вида or_f(Command(...), F.text.lower()...) на каждом обработчике сообщение разбирается
+# один раз (classify_command): первое слово ищется в таблице алиасов, результат кладётся в data как command_name
+# и command (CommandObject — и для «/казино 100», и для «казино 100»). Командные обработчики живут в commands_router,
+# у которого один общий фильтр: обычный текст отсекается одной проверкой и сразу уходит в messages_router.
+BARE_EXACT, BARE_ARGS, BARE_ANY = "exact", "args", "any"
+# Команда: (алиасы, форма без слэша). exact — только само слово, args — только со словом и аргументами, any — оба варианта,
+# None — только через «/».
+COMMANDS = {
+    "start": (("start", "help", "старт", "помощь"), BARE_EXACT),
+    "profile": (("profile", "профиль"), BARE_EXACT),
+    "setnick": (("setnick", "ник"), BARE_ARGS),
+    "delnick": (("delnick", "удалитьник"), BARE_EXACT),
+    "hunt": (("hunt", "охота"), BARE_EXACT),
+    "pay": (("pay", "перевод"), BARE_ARGS),
+    "privacy": (("privacy",), None),
+    "casinostats": (("casinostats",), None),
+    "top": (("top", "топ"), BARE_ANY),
+    "adminprofile": (("adminprofile", "админпрофиль"), None),
+    "botstats": (("botstats",), None),
+    "dbstats": (("dbstats",), None),
+    "reconcile": (("reconcile", "сверка"), None),
+    "casino": (("casino", "казино"), BARE_ANY),
+    "dice": (("dice", "кости"), BARE_ANY),
+    "importquiz": (("importquiz",), None),
+    "mypet": (("mypet", "мойпитомец"), BARE_EXACT),
+    "shop": (("shop", "магазин"), BARE_EXACT),
+    "topup": (("topup", "пополнить"), BARE_EXACT),
+    "cancel": (("cancel", "отмена"), BARE_EXACT),
+    "marry": (("marry", "женить"), BARE_EXACT),
+    "accept": (("accept", "принять"), BARE_EXACT),
+    "divorce": (("divorce", "развод"), BARE_EXACT),
+    "ping": (("ping", "пинг"), BARE_ANY),
+}
+SLASH_ALIASES = {alias: name for name, (aliases, _) in COMMANDS.items() for alias in aliases}
+BARE_ALIASES = {alias: (name, bare) for name, (aliases, bare) in COMMANDS.items() if bare for alias in aliases}
+
+def classify_text(text: str, is_caption: bool = False, bot_username: str = None):
+    # Возвращает (имя команды, CommandObject) или (None, None). Без слэша команды распознаются только в тексте, не в подписях.
+    # Разбор повторяет прежние фильтры: «/команда» — с учётом регистра, как Command; без слэша — без учёта,
+    # exact — весь текст равен слову, args — текст начинается со «слово ».
+    if text.lstrip().startswith("/"):
+        head, *rest = text.split(maxsplit=1)
+        token, _, mention = head[1:].partition("@")
+        name = SLASH_ALIASES.get(token)
+        if not name or (mention and bot_username is not None and mention.lower() != bot_username.lower()): return None, None
+        return name, CommandObject(prefix="/", command=token, mention=mention or None, args=rest[0] if rest else None)
+    if is_caption: return None, None
+    head, separator, rest = text.partition(" ")
+    entry = BARE_ALIASES.get(head.lower())
+    if entry is None: return None, None
+    name, bare = entry
+    if (bare == BARE_EXACT and separator) or (bare == BARE_ARGS and not separator): return None, None
+    return name, CommandObject(prefix="", command=head, args=rest or None)
+
+class CommandRoute(Filter):
+    # CommandRoute("casino") пропускает только разобранную команду casino, CommandRoute() — любую команду.
+    def __init__(self, name: str = None):
+        self.name = name
+
+    async def __call__(self, message: Message, command_name: str = None) -> bool:
+        return command_name is not None if self.name is None else command_name == self.name
+
+commands_router = Router(name="commands")
+commands_router.message.filter(CommandRoute())
+messages_router = Router(name="messages")
+dp.include_routers(commands_router, messages_router)
+
+@dp.message.outer_middleware()
+async def classify_command(handler, message: Message, data: dict):
+    text = message.text if message.text is not None else message.caption
+    name = command = None
+    if text:
+        bot_username = None
+        if text.lstrip().startswith("/") and "@" in text.split(maxsplit=1)[0]: bot_username = (await data["bot"].me()).username
+        name, command = classify_text(text, message.text is None, bot_username)
+    data["command_name"] = name
+    if command is not None: data["command"] = command
+    return await handler(message, data)
+
+# --- ЗАЩИТА ОТ ДВОЙНЫХ НАЖАТИЙ ---
+# Колбэки одного пользователя и колбэки одного игрового сообщения выполняются по очереди (KeyedLocks),
+# а повтор той же кнопки, пока первая ещё обрабатывается или только что обработана, сразу получает ответ без похода в БД.
+# Обработчик может отпустить блокировки раньше (release_locks), например после списания ставки, чтобы анимация игры
+# не держала остальные кнопки игрока. Игровое сообщение забирается один раз (consume): повторные нажатия на него,
+# в том числе от других игроков и после окончания игры, отклоняются.
+class KeyedLocks:
+    def __init__(self):
+        self._locks = {}
+        self.waits = 0
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        # Несколько ключей берутся в одном порядке, чтобы два обработчика не заблокировали друг друга.
+        entries = []
+        for key in sorted(set(keys), key=repr):
+            entry = self._locks.get(key)
+            if entry is None: entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            entries.append((key, entry))
+        acquired = []
+        def release():
+            while acquired: acquired.pop().release()
+        try:
+            for _, entry in entries:
+                if entry[0].locked(): self.waits += 1
+                await entry[0].acquire()
+                acquired.append(entry[0])
+            yield release
+        finally:
+            release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if not entry[1]: del self._locks[key]
+
+    def __len__(self): return len(self._locks)
+
+class CallbackGuard:
+    CONSUMED_SIZE = 10000
+
+    def __init__(self, window: float):
+        self.window = window
+        self.locks = KeyedLocks()
+        self._recent = OrderedDict()  # ключ нажатия -> monotonic-время, до которого повтор отбрасывается (inf — ещё выполняется)
+        self._consumed = OrderedDict()  # уже забранные игровые сообщения (chat_id, message_id), самые старые вытесняются
+        self.passed = self.dropped = 0
+
+    def consume(self, target) -> bool:
+        if target in self._consumed: return False
+        self._consumed[target] = None
+        if len(self._consumed) > self.CONSUMED_SIZE: self._consumed.popitem(last=False)
+        return True
+
+    def restore(self, target): self._consumed.pop(target, None)
+
+    def claim(self, key) -> bool:
+        now = time.monotonic()
+        while self._recent:
+            oldest, until = next(iter(self._recent.items()))
+            if until > now: break
+            del self._recent[oldest]
+        if self._recent.get(key, 0) > now: return False
+        self._recent[key] = float("inf")
+        self._recent.move_to_end(key)
+        return True
+
+    def release(self, key):
+        # Выполненное нажатие встаёт в конец очереди: до него все сроки не позже, поэтому чистка с начала остаётся корректной.
+        self._recent.pop(key, None)
+        self._recent[key] = time.monotonic() + self.window
+
+    def stats(self) -> dict: return {"passed": self.passed, "dropped": self.dropped, "lock_waits": self.locks.waits, "locks": len(self.locks), "tracked": len(self._recent), "consumed": len(self._consumed)}
+
+callback_guard = CallbackGuard(CALLBACK_DEDUP_SECONDS)
+
+@dp.callback_query.outer_middleware()
+async def guard_callbacks(handler, callback: CallbackQuery, data: dict):
+    message = callback.message
+    target = (message.chat.id, message.message_id) if message else callback.inline_message_id
+    key = (callback.from_user.id, target, callback.data)
+    if not callback_guard.claim(key):
+        callback_guard.dropped += 1
+        try: await callback.answer("⏳ Уже обрабатываю…")
+        except TelegramBadRequest: pass
+        return None
+    callback_guard.passed += 1
+    lock_keys = [("user", callback.from_user.id)] + ([("message", target)] if target else [])
+    try:
+        async with callback_guard.locks.hold(*lock_keys) as release_locks:
+            data["release_locks"] = release_locks
+            return await handler(callback, data)
+    finally:
+        callback_guard.release(key)
+
 # --- FSM СОСТОЯНИЯ ---
 class TopupStates(StatesGroup): waiting_for_amount = State()
 class QuizStates(StatesGroup): in_quiz = State()
 class PetHatchStates(StatesGroup): waiting_for_name = State()
 
+# --- СТАТИСТИКА ЗАПРОСОВ ---
+# db_execute меряет каждое выполнение: время ожидания соединения из пула, время самого запроса, число строк и ошибки.
+# Запросы группируются по нормализованному тексту (литералы заменены на ?), так что один вызов в коде — одна строка статистики.
+@lru_cache(maxsize=2048)
+def normalize_sql(query: str) -> str:
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"(?<![$\w])\d+\b", "?", query)
+    return " ".join(query.split())
+
+class LatencyStat:
+    __slots__ = ("calls", "errors", "rows", "total", "max", "buckets")
+
+    def __init__(self):
+        self.calls = self.errors = self.rows = 0
+        self.total = self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, elapsed: float, failed: bool = False):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max: self.max = elapsed
+        if failed: self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound: break
+        else: i = len(LATENCY_BUCKETS)
+        self.buckets[i] += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попадает q-квантиль; для последней корзины — максимум.
+        rank, seen = q * self.calls, 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank: return bound
+        return self.max
+
+class QueryStats:
+    def __init__(self, slow_threshold_ms: float):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.statements = {}
+        self.wait_total = self.wait_max = 0.0
+        self.acquires = self.slow = 0
+        # Исчерпание пула: сколько запросов сейчас стоят в очереди за соединением, пик очереди,
+        # сколько раз ждать пришлось и сколько не дождались. Взявшие свободное соединение сразу в очередь не считаются.
+        self.waiting = self.waiting_max = self.exhausted = self.acquire_timeouts = 0
+
+    def begin_wait(self, exhausted: bool) -> bool:
+        if not exhausted: return False
+        self.exhausted += 1
+        self.waiting += 1
+        if self.waiting > self.waiting_max: self.waiting_max = self.waiting
+        return True
+
+    def end_wait(self, elapsed: float, blocked: bool, acquired: bool = True, timed_out: bool = False):
+        if blocked: self.waiting -= 1
+        if timed_out: self.acquire_timeouts += 1
+        if not acquired: return
+        self.acquires += 1
+        self.wait_total += elapsed
+        if elapsed > self.wait_max: self.wait_max = elapsed
+
+    def observe(self, query: str, elapsed: float, rows: int, failed: bool, caller=None, wait: float = 0.0):
+        key = normalize_sql(query)
+        stat = self.statements.get(key)
+        if stat is None: stat = self.statements[key] = LatencyStat()
+        stat.observe(elapsed, failed)
+        stat.rows += rows
+        if elapsed >= self.slow_threshold:
+            self.slow += 1
+            site = f"{caller.f_code.co_name} ({os.path.basename(caller.f_code.co_filename)}:{caller.f_lineno})" if caller else "?"
+            logger.warning(f"Медленный запрос: {elapsed * 1000:.0f} мс (ожидание пула {wait * 1000:.0f} мс, строк {rows}) из {site}: {key[:300]}")
+
+    def top(self, limit: int = 10, by: str = "total"):
+        return sorted(self.statements.items(), key=lambda item: getattr(item[1], by), reverse=True)[:limit]
+
+    def stats(self) -> dict:
+        return {"statements": len(self.statements), "calls": sum(s.calls for s in self.statements.values()), "errors": sum(s.errors for s in self.statements.values()),
+                "slow": self.slow, "acquires": self.acquires, "wait_avg": (self.wait_total / self.acquires) if self.acquires else 0.0, "wait_max": self.wait_max,
+                "waiting": self.waiting, "waiting_max": self.waiting_max, "exhausted": self.exhausted, "acquire_timeouts": self.acquire_timeouts}
+
+query_stats = QueryStats(SLOW_QUERY_MS)
+
 # --- РАБОТА С БАЗОЙ ДАННЫХ ---
+# db_pool — бэкенд из storage.py (PostgreSQL или SQLite); запросы пишутся в диалекте PostgreSQL, для SQLite их переводит бэкенд.
+# Где один текст запроса невозможен (изменяющие CTE, unnest, LISTEN), код проверяет db_pool.dialect.
 async def create_pool():
     global db_pool
+    delay = DB_CONNECT_BACKOFF_SECONDS
+    for attempt in range(1, DB_CONNECT_ATTEMPTS + 1):
+        try:
+            if SQLITE_PATH is not None:
+                db_pool = await storage.SqliteBackend.connect(SQLITE_PATH, commit_interval=SQLITE_COMMIT_INTERVAL_MS / 1000, commit_max_writes=SQLITE_COMMIT_MAX_WRITES,
+                                                              acquire_timeout=DB_ACQUIRE_TIMEOUT_SECONDS)
+            else:
+                db_pool = await storage.PostgresBackend.connect(DATABASE_URL, acquire_timeout=DB_ACQUIRE_TIMEOUT_SECONDS, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                                                max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_SECONDS, statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                                                                command_timeout=DB_COMMAND_TIMEOUT_SECONDS, server_settings={"application_name": DB_APPLICATION_NAME})
+            logger.info(f"Соединение с БД ({db_pool.dialect}) успешно создано, соединений в пуле: {db_pool.get_size()}.")
+            return
+        except Exception as e:
+            if attempt == DB_CONNECT_ATTEMPTS:
+                logger.critical(f"Не удалось подключиться к БД за {attempt} попыток: {e}")
+                raise
+            # Случайная добавка к задержке, чтобы несколько процессов не ломились в БД одновременно.
+            pause = delay * random.uniform(1, 1.5)
+            logger.warning(f"Не удалось подключиться к БД (попытка {attempt} из {DB_CONNECT_ATTEMPTS}): {e}. Повтор через {pause:.1f} с.")
+            await asyncio.sleep(pause)
+            delay = min(delay * 2, DB_CONNECT_BACKOFF_MAX_SECONDS)
+
+class PoolExhausted(Exception): pass
+
+@asynccontextmanager
+async def acquire_connection():
+    # Соединение из пула с учётом ожидания в query_stats. Пул исчерпан, если все соединения открыты и заняты:
+    # тогда запрос встаёт в очередь, но не дольше DB_ACQUIRE_TIMEOUT, после чего получает PoolExhausted.
+    started = time.perf_counter()
+    blocked = query_stats.begin_wait(exhausted=db_pool.get_idle_size() == 0 and db_pool.get_size() >= db_pool.get_max_size())
+    acquired = timed_out = False
     try:
-        db_pool = await asyncpg.create_pool(dsn=DATABASE_URL)
-        logger.info("Пул соединений с PostgreSQL успешно создан.")
-    except Exception as e:
-        logger.critical(f"Не удалось подключиться к PostgreSQL: {e}")
-        exit()
+        async with db_pool.acquire() as connection:
+            acquired = True
+            query_stats.end_wait(time.perf_counter() - started, blocked)
+            yield connection
+    except asyncio.TimeoutError as e:
+        if acquired: raise
+        timed_out = True
+        raise PoolExhausted(f"нет свободного соединения с БД за {DB_ACQUIRE_TIMEOUT_SECONDS} с") from e
+    finally:
+        if not acquired: query_stats.end_wait(time.perf_counter() - started, blocked, acquired=False, timed_out=timed_out)
 
 async def db_execute(query, *params, fetch=None):
     global db_pool
     if not db_pool:
         logger.error("Пул соединений не инициализирован!")
         return None
-    async with db_pool.acquire() as connection:
-        try:
-            if fetch == 'one': return await connection.fetchrow(query, *params)
-            elif fetch == 'all': return await connection.fetch(query, *params)
-            else: await connection.execute(query, *params); return None
-        except Exception as e:
-            logger.error(f"Ошибка выполнения SQL-запроса: {query} с параметрами {params}. Ошибка: {e}")
-            return None
+    caller = sys._getframe(1)
+    started = time.perf_counter()
+    try:
+        async with acquire_connection() as connection:
+            acquired = time.perf_counter()
+            result, rows, failed = None, 0, False
+            try:
+                if fetch == 'one':
+                    result = await connection.fetchrow(query, *params)
+                    rows = int(result is not None)
+                elif fetch == 'all':
+                    result = await connection.fetch(query, *params)
+                    rows = len(result)
+                else:
+                    status = await connection.execute(query, *params)
+                    rows = int(status.rsplit(" ", 1)[-1]) if status and status.rsplit(" ", 1)[-1].isdigit() else 0
+            except Exception as e:
+                failed = True
+                logger.error(f"Ошибка выполнения SQL-запроса: {query} с параметрами {params}. Ошибка: {e}")
+            query_stats.observe(query, time.perf_counter() - acquired, rows, failed, caller, acquired - started)
+            return result
+    except PoolExhausted as e:
+        logger.error(f"Запрос отменён, {e}: {normalize_sql(query)[:200]}")
+        return None
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Схема задаётся упорядоченными миграциями, а номер последней применённой хранится в schema_version.
+# Обычный рестарт — один запрос версии; недостающие миграции применяются все разом в одной транзакции на одном соединении.
+# Миграция — функция от соединения; новую добавляют в конец со следующим номером и никогда не меняют уже выпущенные.
+SCHEMA_MIGRATIONS = []
+
+def schema_migration(version: int, description: str):
+    def register(func):
+        if SCHEMA_MIGRATIONS and SCHEMA_MIGRATIONS[-1][0] >= version: raise ValueError(f"Миграция {version} объявлена не по порядку")
+        SCHEMA_MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+async def table_columns(connection, table: str) -> set:
+    query = "SELECT name AS column_name FROM pragma_table_xinfo($1)" if db_pool.dialect == "sqlite" else "SELECT column_name FROM information_schema.columns WHERE table_name = $1"
+    return {row['column_name'] for row in await connection.fetch(query, table)}
+
+@schema_migration(1, "базовая схема")
+async def migration_baseline(connection):
+    # Базы, созданные до появления миграций, уже содержат часть этого, поэтому всё здесь идемпотентно.
+    await connection.execute(""" CREATE TABLE IF NOT EXISTS users ( user_id BIGINT PRIMARY KEY, username TEXT, nickname TEXT, balance BIGINT DEFAULT 0, level INTEGER DEFAULT 0, last_hunt BIGINT DEFAULT 0, last_quiz BIGINT DEFAULT 0, partner_id BIGINT DEFAULT 0, proposal_from_id BIGINT DEFAULT 0, prefix_end BIGINT DEFAULT 0, antitar_end BIGINT DEFAULT 0, vip_end BIGINT DEFAULT 0 ); """)
+    await connection.execute(""" CREATE TABLE IF NOT EXISTS pets ( pet_id SERIAL PRIMARY KEY, owner_id BIGINT NOT NULL, name TEXT, species TEXT, pet_level INTEGER DEFAULT 1, last_fed BIGINT DEFAULT 0, last_watered BIGINT DEFAULT 0, last_grown BIGINT DEFAULT 0, last_walked BIGINT DEFAULT 0, creation_date BIGINT ); """)
+    await connection.execute("CREATE TABLE IF NOT EXISTS user_eggs (user_egg_id SERIAL PRIMARY KEY, owner_id BIGINT, egg_type TEXT);")
+    await connection.execute("CREATE TABLE IF NOT EXISTS quiz_questions (question_id SERIAL PRIMARY KEY, question_text TEXT NOT NULL, options JSONB NOT NULL, correct_answer TEXT NOT NULL);")
+    await connection.execute("CREATE TABLE IF NOT EXISTS casino_logs (log_id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, bet_amount BIGINT NOT NULL, win_amount BIGINT NOT NULL, timestamp BIGINT NOT NULL);")
+    await connection.execute("CREATE TABLE IF NOT EXISTS balance_ledger (entry_id BIGSERIAL PRIMARY KEY, user_id BIGINT NOT NULL, delta BIGINT NOT NULL, reason TEXT NOT NULL, ref TEXT, ts BIGINT NOT NULL);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS balance_ledger_user_id_idx ON balance_ledger (user_id);")
+    await connection.execute("CREATE TABLE IF NOT EXISTS scheduled_jobs (job_key TEXT PRIMARY KEY, kind TEXT NOT NULL, run_at DOUBLE PRECISION NOT NULL, payload JSONB NOT NULL DEFAULT '{}');")
+    await connection.execute("CREATE TABLE IF NOT EXISTS fsm_storage (storage_key TEXT PRIMARY KEY, state TEXT, data JSONB NOT NULL DEFAULT '{}');")
+    user_column_names = await table_columns(connection, 'users')
+    if 'hide_balance' not in user_column_names: await connection.execute("ALTER TABLE users ADD COLUMN hide_balance BOOLEAN DEFAULT FALSE;")
+    if 'hide_level' not in user_column_names: await connection.execute("ALTER TABLE users ADD COLUMN hide_level BOOLEAN DEFAULT FALSE;")
+    if 'quiz_record' not in user_column_names: await connection.execute("ALTER TABLE users ADD COLUMN quiz_record INTEGER DEFAULT 0;")
+    if 'full_name' not in user_column_names: await connection.execute("ALTER TABLE users ADD COLUMN full_name TEXT;")
+    # Пустой журнал открывается текущими балансами, иначе сверка покажет расхождение у всех старых пользователей.
+    await connection.execute("INSERT INTO balance_ledger (user_id, delta, reason, ts) SELECT user_id, balance, 'opening', $1 FROM users WHERE balance <> 0 AND NOT EXISTS (SELECT 1 FROM balance_ledger)", int(datetime.now().timestamp()))
+    await connection.execute(""" CREATE TABLE IF NOT EXISTS chat_activity ( id SERIAL PRIMARY KEY, chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL, message_count INTEGER DEFAULT 1, activity_date DATE NOT NULL, UNIQUE (chat_id, user_id, activity_date) ); """)
+    # Недельные, месячные и общие сводки активности для /top, поддерживаются тем же сбросом, что и chat_activity.
+    await connection.execute("CREATE TABLE IF NOT EXISTS chat_activity_weekly (chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL, week_start DATE NOT NULL, message_count BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, week_start, user_id));")
+    await connection.execute("CREATE TABLE IF NOT EXISTS chat_activity_monthly (chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL, month_start DATE NOT NULL, message_count BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, month_start, user_id));")
+    await connection.execute("CREATE TABLE IF NOT EXISTS chat_activity_total (chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL, message_count BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, user_id));")
+    await connection.execute("CREATE INDEX IF NOT EXISTS chat_activity_chat_date_idx ON chat_activity (chat_id, activity_date, message_count DESC);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS chat_activity_weekly_top_idx ON chat_activity_weekly (chat_id, week_start, message_count DESC);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS chat_activity_monthly_top_idx ON chat_activity_monthly (chat_id, month_start, message_count DESC);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS chat_activity_total_top_idx ON chat_activity_total (chat_id, message_count DESC);")
+    # Если сводки пустые, а сырые данные уже есть — заполняем их один раз из chat_activity.
+    await connection.execute("INSERT INTO chat_activity_weekly SELECT chat_id, user_id, date_trunc('week', activity_date)::date, SUM(message_count) FROM chat_activity WHERE NOT EXISTS (SELECT 1 FROM chat_activity_weekly) GROUP BY 1, 2, 3")
+    await connection.execute("INSERT INTO chat_activity_monthly SELECT chat_id, user_id, date_trunc('month', activity_date)::date, SUM(message_count) FROM chat_activity WHERE NOT EXISTS (SELECT 1 FROM chat_activity_monthly) GROUP BY 1, 2, 3")
+    await connection.execute("INSERT INTO chat_activity_total SELECT chat_id, user_id, SUM(message_count) FROM chat_activity WHERE NOT EXISTS (SELECT 1 FROM chat_activity_total) GROUP BY 1, 2")
+    # Время последнего ухода считает сама БД, чтобы уборщик питомцев находил умерших по индексу.
+    # SQLite умеет добавлять через ALTER только вычисляемые VIRTUAL-колонки, но индекс по такой колонке тоже работает.
+    if 'last_care_at' not in await table_columns(connection, 'pets'):
+        await connection.execute(f"ALTER TABLE pets ADD COLUMN last_care_at BIGINT GENERATED ALWAYS AS (GREATEST(last_fed, last_watered, last_walked)) {'VIRTUAL' if db_pool.dialect == 'sqlite' else 'STORED'};")
+    await connection.execute("CREATE INDEX IF NOT EXISTS pets_last_care_at_idx ON pets (last_care_at);")
+    for item_id in ('prefix', 'antitar', 'vip'):
+        await connection.execute(f"CREATE INDEX IF NOT EXISTS users_{item_id}_end_idx ON users ({item_id}_end) WHERE {item_id}_end > 0;")
+    if db_pool.dialect != "postgres": return
+    # LISTEN/NOTIFY есть только в PostgreSQL; с SQLite бот работает в одном процессе и перечитывает данные сам.
+    # Любое изменение банка вопросов уведомляет бота, чтобы тот перечитал его в память.
+    await connection.execute("""CREATE OR REPLACE FUNCTION notify_quiz_questions_changed() RETURNS trigger AS $$ BEGIN PERFORM pg_notify('quiz_questions_changed', ''); RETURN NULL; END; $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS quiz_questions_changed ON quiz_questions;
+        CREATE TRIGGER quiz_questions_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON quiz_questions FOR EACH STATEMENT EXECUTE PROCEDURE notify_quiz_questions_changed();""")
+    await connection.execute("CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS trigger AS $$ BEGIN PERFORM pg_notify('users_changed', OLD.user_id::text); RETURN NULL; END; $$ LANGUAGE plpgsql;")
+
+@schema_migration(2, "индексы по владельцу питомцев и яиц, по времени игр казино")
+async def migration_owner_indexes(connection):
+    await connection.execute("CREATE INDEX IF NOT EXISTS pets_owner_id_idx ON pets (owner_id);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS user_eggs_owner_id_idx ON user_eggs (owner_id);")
+    await connection.execute("CREATE INDEX IF NOT EXISTS casino_logs_timestamp_idx ON casino_logs (timestamp);")
+
+@schema_migration(3, "источник изменения в уведомлении users_changed")
+async def migration_users_changed_origin(connection):
+    # К id пользователя добавляется application_name записавшего процесса: свои записи воркер уже положил в кэш сам.
+    if db_pool.dialect != "postgres": return
+    await connection.execute("""CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS trigger AS $$ BEGIN
+        PERFORM pg_notify('users_changed', OLD.user_id::text || ':' || current_setting('application_name')); RETURN NULL; END; $$ LANGUAGE plpgsql;""")
+
+# Версия схемы и, для PostgreSQL, есть ли триггер users_changed — одним запросом.
+SCHEMA_STATE_QUERIES = {
+    "postgres": "SELECT COALESCE(MAX(version), 0) AS version, EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'users_changed' AND NOT tgisinternal) AS users_trigger FROM schema_version",
+    "sqlite": "SELECT COALESCE(MAX(version), 0) AS version, FALSE AS users_trigger FROM schema_version",
+}
 
 async def init_db():
-    await db_execute(""" CREATE TABLE IF NOT EXISTS users ( user_id BIGINT PRIMARY KEY, username TEXT, nickname TEXT, balance BIGINT DEFAULT 0, level INTEGER DEFAULT 0, last_hunt BIGINT DEFAULT 0, last_quiz BIGINT DEFAULT 0, partner_id BIGINT DEFAULT 0, proposal_from_id BIGINT DEFAULT 0, prefix_end BIGINT DEFAULT 0, antitar_end BIGINT DEFAULT 0, vip_end BIGINT DEFAULT 0 ); """)
-    await db_execute(""" CREATE TABLE IF NOT EXISTS pets ( pet_id SERIAL PRIMARY KEY, owner_id BIGINT NOT NULL, name TEXT, species TEXT, pet_level INTEGER DEFAULT 1, last_fed BIGINT DEFAULT 0, last_watered BIGINT DEFAULT 0, last_grown BIGINT DEFAULT 0, last_walked BIGINT DEFAULT 0, creation_date BIGINT ); """)
-    await db_execute("CREATE TABLE IF NOT EXISTS user_eggs (user_egg_id SERIAL PRIMARY KEY, owner_id BIGINT, egg_type TEXT);")
-    await db_execute("CREATE TABLE IF NOT EXISTS quiz_questions (question_id SERIAL PRIMARY KEY, question_text TEXT NOT NULL, options JSONB NOT NULL, correct_answer TEXT NOT NULL);")
-    await db_execute("CREATE TABLE IF NOT EXISTS casino_logs (log_id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, bet_amount BIGINT NOT NULL, win_amount BIGINT NOT NULL, timestamp BIGINT NOT NULL);")
-    await db_execute(""" CREATE TABLE IF NOT EXISTS chat_activity ( id SERIAL PRIMARY KEY, chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL, message_count INTEGER DEFAULT 1, activity_date DATE NOT NULL, UNIQUE (chat_id, user_id, activity_date) ); """)
-    
-    user_columns = await db_execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users'", fetch='all')
-    user_column_names = [c['column_name'] for c in user_columns]
-    if 'hide_balance' not in user_column_names: await db_execute("ALTER TABLE users ADD COLUMN hide_balance BOOLEAN DEFAULT FALSE;")
-    if 'hide_level' not in user_column_names: await db_execute("ALTER TABLE users ADD COLUMN hide_level BOOLEAN DEFAULT FALSE;")
-    if 'quiz_record' not in user_column_names: await db_execute("ALTER TABLE users ADD COLUMN quiz_record INTEGER DEFAULT 0;")
-    logger.info("Проверка всех таблиц в БД завершена.")
+    async with db_pool.acquire() as connection:
+        try: state = await connection.fetchrow(SCHEMA_STATE_QUERIES[db_pool.dialect])
+        except Exception:
+            # Первый запуск с миграциями: таблицы версий ещё нет.
+            await connection.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at BIGINT NOT NULL);")
+            state = await connection.fetchrow(SCHEMA_STATE_QUERIES[db_pool.dialect])
+        pending = [migration for migration in SCHEMA_MIGRATIONS if migration[0] > state['version']]
+        if pending:
+            async with connection.transaction():
+                for version, description, apply in pending:
+                    started = time.perf_counter()
+                    await apply(connection)
+                    await connection.execute("INSERT INTO schema_version (version, description, applied_at) VALUES ($1, $2, $3)", version, description, int(time.time()))
+                    logger.info(f"Миграция схемы {version} ({description}) применена за {time.perf_counter() - started:.2f} с.")
+        # Несколько процессов держат свои кэши пользователей: любое изменение строки users рассылается всем, чтобы они её сбросили.
+        # Триггер зависит от WORKERS, а не от версии схемы, поэтому сверяется при каждом запуске, но трогается только при расхождении.
+        if db_pool.dialect == "postgres" and state['users_trigger'] != (WORKERS > 1):
+            if WORKERS > 1: await connection.execute("CREATE TRIGGER users_changed AFTER UPDATE OR DELETE ON users FOR EACH ROW EXECUTE PROCEDURE notify_users_changed();")
+            else: await connection.execute("DROP TRIGGER IF EXISTS users_changed ON users;")
+    if state['version'] > SCHEMA_MIGRATIONS[-1][0]: logger.warning(f"Схема БД версии {state['version']} новее кода (знает до {SCHEMA_MIGRATIONS[-1][0]}): запущена старая версия бота?")
+    logger.info(f"Схема БД: версия {max(state['version'], SCHEMA_MIGRATIONS[-1][0])}, применено миграций: {len(pending)}.")
 
 async def populate_questions():
     if (await db_execute("SELECT COUNT(*) FROM quiz_questions", fetch='one'))[0] == 0:
-        questions = [("Какая змея считается самой ядовитой в мире?", json.dumps(["Тайпан", "Черная мамба", "Гадюка", "Кобра"]), "Тайпан"),("Какая змея самая большая в мире?", json.dumps(["Анаконда", "Сетчатый питон", "Королевская кобра", "Тигровый питон"]), "Сетчатый питон"),("Есть ли у змей уши?", json.dumps(["Да, но они скрыты", "Только внутреннее ухо", "Нет", "Да, как у ящериц"]), "Только внутреннее ухо"),]
-        for q in questions: await db_execute("INSERT INTO quiz_questions (question_text, options, correct_answer) VALUES ($1, $2, $3)", q[0], q[1], q[2])
+        questions = [("Какая змея считается самой ядовитой в мире?", ["Тайпан", "Черная мамба", "Гадюка", "Кобра"], "Тайпан"),("Какая змея самая большая в мире?", ["Анаконда", "Сетчатый питон", "Королевская кобра", "Тигровый питон"], "Сетчатый питон"),("Есть ли у змей уши?", ["Да, но они скрыты", "Только внутреннее ухо", "Нет", "Да, как у ящериц"], "Только внутреннее ухо"),]
+        await import_quiz_questions(questions)
         logger.info(f"Добавлено {len(questions)} вопросов в базу данных.")
 
+# --- КЭШ ПОЛЬЗОВАТЕЛЕЙ ---
+# LRU-кэш строк таблицы users с TTL. Все чтения идут через get_user, все записи
+# через update_user_field/add_user обновляют закэшированную строку (write-through).
+class UserCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, user_id: int):
+        entry = self._data.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        row, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return row
+
+    def put(self, user_id: int, row):
+        if row is None:
+            self.invalidate(user_id)
+            return None
+        # Храним новый dict, а не мутируем старый: уже выданные обработчикам строки не меняются.
+        row = dict(row)
+        self._data[user_id] = (row, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return row
+
+    def invalidate(self, user_id: int): self._data.pop(user_id, None)
+
+    def update_fields(self, user_id: int, **fields):
+        # Точечно обновляет закэшированную строку, не продлевая TTL и не трогая счётчики.
+        entry = self._data.get(user_id)
+        if entry: self._data[user_id] = ({**entry[0], **fields}, entry[1])
+    def clear(self): self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations, "hit_rate": (self.hits / total) if total else 0.0}
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
 # --- Функции для работы с данными ---
-async def get_user(user_id: int): return await db_execute("SELECT * FROM users WHERE user_id = $1", user_id, fetch='one')
-async def add_user(user_id: int, username: str): await db_execute("INSERT INTO users (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING", user_id, username)
-async def update_user_field(user_id: int, field: str, value): await db_execute(f"UPDATE users SET {field} = $1 WHERE user_id = $2", value, user_id)
+async def get_user(user_id: int):
+    cached = user_cache.get(user_id)
+    if cached is not None: return cached
+    return user_cache.put(user_id, await db_execute("SELECT * FROM users WHERE user_id = $1", user_id, fetch='one'))
+
+async def get_users(user_ids) -> dict:
+    # Пакетная версия get_user: всё, чего нет в кэше, читается одним запросом. Отсутствующих в БД нет в результате.
+    found, missing = {}, []
+    for user_id in user_ids:
+        cached = user_cache.get(user_id)
+        if cached is not None: found[user_id] = cached
+        else: missing.append(user_id)
+    if missing:
+        for row in await db_execute("SELECT * FROM users WHERE user_id = ANY($1::bigint[])", missing, fetch='all') or []:
+            found[row['user_id']] = user_cache.put(row['user_id'], row)
+    return found
+
+# Регистрация и чтение строки одним запросом через изменяющий CTE. SQLite таких CTE не умеет:
+# там INSERT ... DO NOTHING и отдельный SELECT (соединение одно, так что между ними никто не вклинится).
+INSERT_USER_QUERY = "INSERT INTO users (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING"
+UPSERT_USER_CTE = f"WITH ins AS ({INSERT_USER_QUERY} RETURNING *), u AS (SELECT * FROM ins UNION ALL SELECT * FROM users WHERE user_id = $1 LIMIT 1)"
+
+async def add_user(user_id: int, username: str):
+    # Пользователь в кэше — значит, строка уже есть в БД. Иначе вставляем и сразу забираем строку в кэш одним запросом.
+    if user_cache.get(user_id) is not None: return
+    if db_pool and db_pool.dialect == "sqlite":
+        await db_execute(INSERT_USER_QUERY, user_id, username)
+        row = await db_execute("SELECT * FROM users WHERE user_id = $1", user_id, fetch='one')
+    else: row = await db_execute(f"{UPSERT_USER_CTE} SELECT * FROM u", user_id, username, fetch='one')
+    user_cache.put(user_id, row)
+
+# Профиль целиком за один запрос: регистрация при первом обращении, строка пользователя,
+# ник и имя партнёра (LEFT JOIN) и число питомцев.
+PROFILE_SELECT = """SELECT u.*, partner.nickname AS partner_nickname, partner.full_name AS partner_full_name,
+        (SELECT COUNT(*) FROM pets WHERE pets.owner_id = u.user_id) AS pet_count
+    FROM {source} LEFT JOIN users partner ON partner.user_id = u.partner_id AND u.partner_id <> 0"""
+PROFILE_QUERY = f"{UPSERT_USER_CTE}\n    {PROFILE_SELECT.format(source='u')}"
+SQLITE_PROFILE_QUERY = PROFILE_SELECT.format(source='users u') + " WHERE u.user_id = $1"
+PROFILE_EXTRA_COLUMNS = ('partner_nickname', 'partner_full_name', 'pet_count')
+
+async def load_profile(user_id: int, username: str):
+    if db_pool and db_pool.dialect == "sqlite":
+        await db_execute(INSERT_USER_QUERY, user_id, username)
+        row = await db_execute(SQLITE_PROFILE_QUERY, user_id, fetch='one')
+    else: row = await db_execute(PROFILE_QUERY, user_id, username, fetch='one')
+    if not row: return None, {}
+    row = dict(row)
+    extra = {column: row.pop(column) for column in PROFILE_EXTRA_COLUMNS}
+    return user_cache.put(user_id, row), extra
+
+# Обновление одного поля — фиксированный набор запросов, а не имя колонки, подставленное в текст при каждом вызове:
+# у каждого запроса постоянный текст, поэтому asyncpg готовит его на соединении один раз и дальше берёт из кэша.
+USER_FIELD_UPDATES = {field: f"UPDATE users SET {field} = $1 WHERE user_id = $2 RETURNING *" for field in
+                      ("nickname", "level", "last_quiz", "quiz_record", "partner_id", "proposal_from_id", "hide_balance", "hide_level")}
+PET_FIELD_UPDATES = {field: f"UPDATE pets SET {field} = $1 WHERE pet_id = $2" for field in ("last_fed", "last_watered", "last_walked")}
+
+async def update_user_field(user_id: int, field: str, value):
+    row = await db_execute(USER_FIELD_UPDATES[field], value, user_id, fetch='one')
+    user_cache.put(user_id, row)
 async def get_pets(owner_id: int): return await db_execute("SELECT * FROM pets WHERE owner_id = $1 ORDER BY pet_id", owner_id, fetch='all')
 async def get_single_pet(pet_id: int): return await db_execute("SELECT * FROM pets WHERE pet_id = $1", pet_id, fetch='one')
 async def create_pet(owner_id: int, name: str, species: str):
     now = int(datetime.now().timestamp())
-    await db_execute("INSERT INTO pets (owner_id, name, species, last_fed, last_watered, last_grown, last_walked, creation_date) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)", owner_id, name, species, now, now, now, now, now)
-async def update_pet_field(pet_id: int, field: str, value): await db_execute(f"UPDATE pets SET {field} = $1 WHERE pet_id = $2", value, pet_id)
+    return await db_execute("INSERT INTO pets (owner_id, name, species, last_fed, last_watered, last_grown, last_walked, creation_date) VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING *", owner_id, name, species, now, now, now, now, now, fetch='one')
+async def update_pet_field(pet_id: int, field: str, value): await db_execute(PET_FIELD_UPDATES[field], value, pet_id)
 async def delete_pet(pet_id: int): await db_execute("DELETE FROM pets WHERE pet_id = $1", pet_id)
 async def get_user_eggs(owner_id: int): return await db_execute("SELECT * FROM user_eggs WHERE owner_id = $1", owner_id, fetch='all')
 async def add_user_egg(owner_id: int, egg_type: str): await db_execute("INSERT INTO user_eggs (owner_id, egg_type) VALUES ($1, $2)", owner_id, egg_type)
 async def delete_user_egg(user_egg_id: int): await db_execute("DELETE FROM user_eggs WHERE user_egg_id = $1", user_egg_id)
-async def get_random_question(): return await db_execute("SELECT * FROM quiz_questions ORDER BY RANDOM() LIMIT 1", fetch='one')
 
-# --- Вспомогательные функции ---
-async def get_user_display_name(user_id: int, user_record=None) -> str:
-    if not user_record: user_record = await get_user(user_id)
-    if user_record and user_record.get('nickname'): return html.escape(user_record['nickname'])
+# --- ФОНОВАЯ ЗАПИСЬ ---
+# Общий цикл для буферов, которые копят данные в памяти и сбрасывают их в БД пачками:
+# раз в interval секунд или раньше, если буфер попросил сброс через _wakeup.
+class BackgroundFlusher:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.flushes = self.errors = 0
+
+    async def flush(self): raise NotImplementedError
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if not self._task: self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+# --- ЖУРНАЛ БАЛАНСА ---
+# Каждое изменение баланса попадает в очередь в памяти и пишется в balance_ledger пачкой через COPY
+# раз в LEDGER_FLUSH_INTERVAL_MS или при накоплении LEDGER_FLUSH_MAX_ROWS записей — без лишнего INSERT в обработчике.
+class LedgerWriter(BackgroundFlusher):
+    COLUMNS = ['user_id', 'delta', 'reason', 'ref', 'ts']
+
+    def __init__(self, interval_ms: int, max_rows: int):
+        super().__init__(interval_ms / 1000)
+        self.max_rows = max_rows
+        self._buffer = []
+        self.written = 0
+
+    def record(self, user_id: int, delta: int, reason: str, ref=None):
+        self._buffer.append((user_id, delta, reason, None if ref is None else str(ref), int(time.time())))
+        if len(self._buffer) >= self.max_rows: self._wakeup.set()
+
+    async def flush(self):
+        if not self._buffer or not db_pool: return
+        batch, self._buffer = self._buffer, []
+        try:
+            async with db_pool.acquire() as connection:
+                await connection.copy_records_to_table('balance_ledger', records=batch, columns=self.COLUMNS)
+            self.written += len(batch)
+            self.flushes += 1
+        except Exception as e:
+            # Возвращаем пачку в начало очереди: записи не теряются, попробуем на следующем сбросе.
+            self._buffer[:0] = batch
+            self.errors += 1
+            logger.error(f"Не удалось записать {len(batch)} записей журнала баланса: {e}")
+
+    def stats(self) -> dict: return {"pending": len(self._buffer), "written": self.written, "flushes": self.flushes, "errors": self.errors}
+
+ledger = LedgerWriter(LEDGER_FLUSH_INTERVAL_MS, LEDGER_FLUSH_MAX_ROWS)
+
+async def reconcile_balances(limit: int = 10):
+    # Пересчитывает балансы по журналу и возвращает расхождения с users.balance (самые крупные первыми).
+    await ledger.flush()
+    summary = await db_execute("""SELECT COUNT(*) AS drifted, COALESCE(SUM(u.balance - COALESCE(l.total, 0)), 0) AS total_drift FROM users u
+        LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM balance_ledger GROUP BY user_id) l ON l.user_id = u.user_id WHERE u.balance <> COALESCE(l.total, 0)""", fetch='one')
+    rows = await db_execute("""SELECT u.user_id, u.balance, COALESCE(l.total, 0) AS ledger_balance FROM users u
+        LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM balance_ledger GROUP BY user_id) l ON l.user_id = u.user_id
+        WHERE u.balance <> COALESCE(l.total, 0) ORDER BY ABS(u.balance - COALESCE(l.total, 0)) DESC LIMIT $1""", limit, fetch='all')
+    return summary, rows or []
+
+# --- АКТИВНОСТЬ В ЧАТАХ ---
+# Сообщения считаются в памяти по ключу (chat_id, user_id, день) и раз в ACTIVITY_FLUSH_INTERVAL секунд
+# сбрасываются одним оператором: INSERT ... ON CONFLICT в chat_activity и инкремент недельной, месячной
+# и общей сводок. Обработка сообщения в группе не трогает БД, а /top читает готовые сводки.
+class ActivityCounter(BackgroundFlusher):
+    UPSERT = """WITH batch AS (SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::date[], $4::integer[]) AS t (chat_id, user_id, activity_date, message_count)),
+        daily AS (INSERT INTO chat_activity (chat_id, user_id, activity_date, message_count) SELECT chat_id, user_id, activity_date, message_count FROM batch
+            ON CONFLICT (chat_id, user_id, activity_date) DO UPDATE SET message_count = chat_activity.message_count + EXCLUDED.message_count),
+        weekly AS (INSERT INTO chat_activity_weekly (chat_id, user_id, week_start, message_count) SELECT chat_id, user_id, date_trunc('week', activity_date)::date, SUM(message_count) FROM batch GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, week_start, user_id) DO UPDATE SET message_count = chat_activity_weekly.message_count + EXCLUDED.message_count),
+        monthly AS (INSERT INTO chat_activity_monthly (chat_id, user_id, month_start, message_count) SELECT chat_id, user_id, date_trunc('month', activity_date)::date, SUM(message_count) FROM batch GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, month_start, user_id) DO UPDATE SET message_count = chat_activity_monthly.message_count + EXCLUDED.message_count)
+        INSERT INTO chat_activity_total (chat_id, user_id, message_count) SELECT chat_id, user_id, SUM(message_count) FROM batch GROUP BY 1, 2
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET message_count = chat_activity_total.message_count + EXCLUDED.message_count"""
+    # В SQLite нет unnest и изменяющих CTE: те же инкременты построчно, executemany по каждой таблице в одной транзакции.
+    SQLITE_UPSERTS = (
+        ("INSERT INTO chat_activity (chat_id, user_id, activity_date, message_count) VALUES ($1, $2, $3, $4) ON CONFLICT (chat_id, user_id, activity_date) DO UPDATE SET message_count = chat_activity.message_count + EXCLUDED.message_count", lambda day: day),
+        ("INSERT INTO chat_activity_weekly (chat_id, user_id, week_start, message_count) VALUES ($1, $2, $3, $4) ON CONFLICT (chat_id, week_start, user_id) DO UPDATE SET message_count = chat_activity_weekly.message_count + EXCLUDED.message_count", lambda day: day - timedelta(days=day.weekday())),
+        ("INSERT INTO chat_activity_monthly (chat_id, user_id, month_start, message_count) VALUES ($1, $2, $3, $4) ON CONFLICT (chat_id, month_start, user_id) DO UPDATE SET message_count = chat_activity_monthly.message_count + EXCLUDED.message_count", lambda day: day.replace(day=1)),
+    )
+    SQLITE_TOTAL_UPSERT = "INSERT INTO chat_activity_total (chat_id, user_id, message_count) VALUES ($1, $2, $3) ON CONFLICT (chat_id, user_id) DO UPDATE SET message_count = chat_activity_total.message_count + EXCLUDED.message_count"
+
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        self._counts = {}
+        self.messages = self.rows_written = 0
+
+    def hit(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id, date.today())
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self.messages += 1
+
+    async def flush(self):
+        if not self._counts or not db_pool: return
+        batch, self._counts = self._counts, {}
+        chat_ids, user_ids, days = zip(*batch.keys())
+        try:
+            async with db_pool.acquire() as connection:
+                if db_pool.dialect == "sqlite": await self._flush_rows(connection, batch)
+                else: await connection.execute(self.UPSERT, list(chat_ids), list(user_ids), list(days), list(batch.values()))
+            self.rows_written += len(batch)
+            self.flushes += 1
+        except Exception as e:
+            # Счётчики за неудачный сброс складываем обратно с теми, что успели накопиться.
+            for key, count in batch.items(): self._counts[key] = self._counts.get(key, 0) + count
+            self.errors += 1
+            logger.error(f"Не удалось сохранить активность чатов ({len(batch)} строк): {e}")
+
+    async def _flush_rows(self, connection, batch: dict):
+        async with connection.transaction():
+            for query, period_start in self.SQLITE_UPSERTS:
+                await connection.executemany(query, [(chat_id, user_id, period_start(day), count) for (chat_id, user_id, day), count in batch.items()])
+            await connection.executemany(self.SQLITE_TOTAL_UPSERT, [(chat_id, user_id, count) for (chat_id, user_id, _), count in batch.items()])
+
+    def stats(self) -> dict: return {"pending": len(self._counts), "messages": self.messages, "rows_written": self.rows_written, "flushes": self.flushes, "errors": self.errors}
+
+activity_counter = ActivityCounter(ACTIVITY_FLUSH_INTERVAL_SECONDS)
+
+# Лидерборды /top: (заголовок, запрос к сводке, функция начала периода).
+TOP_PERIODS = {
+    "day": ("за сегодня", "SELECT user_id, message_count FROM chat_activity WHERE chat_id = $1 AND activity_date = $2 ORDER BY message_count DESC LIMIT $3", lambda today: today),
+    "week": ("за неделю", "SELECT user_id, message_count FROM chat_activity_weekly WHERE chat_id = $1 AND week_start = $2 ORDER BY message_count DESC LIMIT $3", lambda today: today - timedelta(days=today.weekday())),
+    "month": ("за месяц", "SELECT user_id, message_count FROM chat_activity_monthly WHERE chat_id = $1 AND month_start = $2 ORDER BY message_count DESC LIMIT $3", lambda today: today.replace(day=1)),
+    "all": ("за всё время", "SELECT user_id, message_count FROM chat_activity_total WHERE chat_id = $1 ORDER BY message_count DESC LIMIT $2", None),
+}
+TOP_PERIOD_ALIASES = {"day": "day", "день": "day", "сегодня": "day", "week": "week", "неделя": "week", "month": "month", "месяц": "month", "all": "all", "все": "all", "всё": "all"}
+
+async def get_activity_top(chat_id: int, period: str, limit: int = TOP_LIMIT):
+    await activity_counter.flush()
+    _, query, period_start = TOP_PERIODS[period]
+    if period_start is None: return await db_execute(query, chat_id, limit, fetch='all') or []
+    return await db_execute(query, chat_id, period_start(date.today()), limit, fetch='all') or []
+
+@dp.message.outer_middleware()
+async def count_chat_activity(handler, message: Message, data: dict):
+    # Считаем все сообщения в группах, включая команды, до того как их разберут обработчики.
+    if message.chat.type in ('group', 'supergroup') and message.from_user and not message.from_user.is_bot:
+        activity_counter.hit(message.chat.id, message.from_user.id)
+    return await handler(message, data)
+
+# --- КОШЕЛЁК ---
+# Все изменения баланса — условные UPDATE ... RETURNING: один запрос на операцию и никаких потерянных обновлений
+# при параллельных нажатиях. Функции возвращают новый баланс, либо None, если средств не хватило или запрос не прошёл.
+# Успешные операции записываются в журнал баланса с причиной (reason) и ссылкой (ref).
+class InsufficientFunds(Exception): pass
+
+def _wallet_commit(user_id: int, row):
+    if row is None:
+        # Закэшированный баланс мог устареть — следующий get_user перечитает строку из БД.
+        user_cache.invalidate(user_id)
+        return None
+    return user_cache.put(user_id, row)
+
+async def wallet_credit(user_id: int, amount: int, reason: str, ref=None):
+    row = await db_execute("UPDATE users SET balance = balance + $1 WHERE user_id = $2 RETURNING *", amount, user_id, fetch='one')
+    row = _wallet_commit(user_id, row)
+    if not row: return None
+    ledger.record(user_id, amount, reason, ref)
+    return row['balance']
+
+async def wallet_debit(user_id: int, amount: int, reason: str, ref=None):
+    row = await db_execute("UPDATE users SET balance = balance - $1 WHERE user_id = $2 AND balance >= $1 RETURNING *", amount, user_id, fetch='one')
+    row = _wallet_commit(user_id, row)
+    if not row: return None
+    ledger.record(user_id, -amount, reason, ref)
+    return row['balance']
+
+async def wallet_transfer(from_id: int, to_id: int, amount: int, reason: str = "transfer"):
+    # Списание и зачисление одним оператором: списание проходит только при наличии средств и получателя,
+    # зачисление — только если прошло списание. Возвращает {user_id: новый баланс}. В SQLite — два UPDATE в одной транзакции.
+    if from_id == to_id: return None
+    if db_pool and db_pool.dialect == "sqlite": rows = await _wallet_transaction([(from_id, -amount), (to_id, amount)])
+    else: rows = await db_execute("""WITH debit AS (UPDATE users SET balance = balance - $3 WHERE user_id = $1 AND balance >= $3 AND EXISTS (SELECT 1 FROM users WHERE user_id = $2) RETURNING *),
+        credit AS (UPDATE users SET balance = balance + $3 WHERE user_id = $2 AND EXISTS (SELECT 1 FROM debit) RETURNING *)
+        SELECT * FROM debit UNION ALL SELECT * FROM credit""", from_id, to_id, amount, fetch='all')
+    if not rows or len(rows) != 2:
+        _wallet_commit(from_id, None); _wallet_commit(to_id, None)
+        return None
+    ledger.record(from_id, -amount, reason, f"to:{to_id}")
+    ledger.record(to_id, amount, reason, f"from:{from_id}")
+    return {row['user_id']: _wallet_commit(row['user_id'], row)['balance'] for row in rows}
+
+async def _wallet_transaction(changes: list):
+    # Изменения [(user_id, delta), ...] в одной транзакции; строки users после изменения или None, если что-то не прошло.
+    if not db_pool:
+        logger.error("Пул соединений не инициализирован!")
+        return None
+    rows = []
     try:
-        user = await bot.get_chat(user_id)
-        return hlink(user.full_name, f"tg://user?id={user.id}")
-    except TelegramBadRequest: return f"Пользователь (ID: {user_id})"
-    except Exception as e: logger.error(f"Could not get user mention for {user_id}: {e}"); return f"Пользователь (ID: {user_id})"
+        async with acquire_connection() as connection:
+            async with connection.transaction():
+                for user_id, delta in changes:
+                    row = await connection.fetchrow("UPDATE users SET balance = balance + $1 WHERE user_id = $2 AND balance + $1 >= 0 RETURNING *", delta, user_id)
+                    if row is None: raise InsufficientFunds(user_id)
+                    rows.append(row)
+    except InsufficientFunds: return None
+    except Exception as e:
+        logger.error(f"Ошибка транзакции кошелька {changes}: {e}")
+        return None
+    return rows
 
-async def check_items(user_id: int):
-    user = await get_user(user_id)
-    if not user: return
-    now = int(datetime.now().timestamp())
-    updates = {}
-    if user.get("prefix_end") and user.get("prefix_end", 0) < now: updates["prefix_end"] = 0
-    if user.get("antitar_end") and user.get("antitar_end", 0) < now: updates["antitar_end"] = 0
-    if user.get("vip_end") and user.get("vip_end", 0) < now: updates["vip_end"] = 0
-    for field, value in updates.items(): await update_user_field(user_id, field, value)
-
-async def check_all_pets_death(owner_id: int):
-    pets = await get_pets(owner_id)
-    if not pets: return
-    now_ts = int(datetime.now().timestamp())
-    death_timestamp = now_ts - (PET_DEATH_DAYS * 24 * 3600)
-    for pet in pets:
-        last_action_time = max(pet.get('last_fed', 0), pet.get('last_watered', 0), pet.get('last_walked', 0))
-        if last_action_time < death_timestamp:
-            await delete_pet(pet['pet_id'])
-            try:
-                await bot.send_message(owner_id, f"💔 Ваш питомец {html.escape(pet.get('name', ''))} ({html.escape(pet.get('species', ''))}) умер от недостатка ухода...", parse_mode="HTML")
-            except Exception as e: logger.error(f"Не удалось отправить сообщение о смерти питомца пользователю {owner_id}: {e}")
+async def wallet_apply(changes: list, reason: str, ref=None):
+    # Несколько изменений баланса [(user_id, delta), ...] в одной транзакции: если хоть одному не хватает средств, откатывается всё.
+    rows = await _wallet_transaction(changes)
+    if rows is None:
+        for user_id, _ in changes: _wallet_commit(user_id, None)
+        return None
+    for user_id, delta in changes: ledger.record(user_id, delta, reason, ref)
+    return {row['user_id']: _wallet_commit(row['user_id'], row)['balance'] for row in rows}
+
+async def wallet_claim_hunt(user_id: int, catch: int, now: int, cooldown: int):
+    # Награда за охоту и отметка времени одним запросом; повторный клик в пределах кулдауна ничего не начислит.
+    row = await db_execute("UPDATE users SET balance = balance + $1, last_hunt = $2 WHERE user_id = $3 AND COALESCE(last_hunt, 0) <= $4 RETURNING *", catch, now, user_id, now - cooldown, fetch='one')
+    row = _wallet_commit(user_id, row)
+    if not row: return None
+    ledger.record(user_id, catch, "hunt")
+    return row['balance']
+
+# --- ИМЕНА ПОЛЬЗОВАТЕЛЕЙ ---
+# full_name запоминается из каждого входящего апдейта (middleware ниже) и пачкой сохраняется в users.full_name,
+# поэтому упоминания почти никогда не требуют bot.get_chat. Промахи запрашиваются у Telegram параллельно,
+# а неудачные запросы кэшируются на NAME_NEGATIVE_TTL секунд.
+class NameResolver(BackgroundFlusher):
+    UPDATE = """UPDATE users SET full_name = t.full_name FROM unnest($1::bigint[], $2::text[]) AS t (user_id, full_name)
+        WHERE users.user_id = t.user_id AND users.full_name IS DISTINCT FROM t.full_name"""
+    SQLITE_UPDATE = "UPDATE users SET full_name = $2 WHERE user_id = $1 AND full_name IS DISTINCT FROM $2"
+
+    def __init__(self, maxsize: int, negative_ttl: float, interval: float):
+        super().__init__(interval)
+        self.maxsize, self.negative_ttl = maxsize, negative_ttl
+        self._names = OrderedDict()
+        self._failures = {}
+        self._dirty = {}
+        self.api_calls = self.api_failures = self.negative_hits = 0
+
+    def remember(self, user_id: int, full_name: str):
+        self._names[user_id] = full_name
+        self._names.move_to_end(user_id)
+        while len(self._names) > self.maxsize: self._names.popitem(last=False)
+
+    def observe(self, user_id: int, full_name: str):
+        if not full_name: return
+        self._failures.pop(user_id, None)
+        if self._names.get(user_id) == full_name:
+            self._names.move_to_end(user_id)
+            return
+        self.remember(user_id, full_name)
+        self._dirty[user_id] = full_name
+
+    def cached(self, user_id: int):
+        full_name = self._names.get(user_id)
+        if full_name: self._names.move_to_end(user_id)
+        return full_name
+
+    async def fetch(self, user_ids: list) -> dict:
+        now = time.monotonic()
+        if len(self._failures) > self.maxsize: self._failures = {uid: until for uid, until in self._failures.items() if until > now}
+        to_fetch = [uid for uid in user_ids if self._failures.get(uid, 0) <= now]
+        self.negative_hits += len(user_ids) - len(to_fetch)
+        self.api_calls += len(to_fetch)
+        results = await asyncio.gather(*(bot.get_chat(uid) for uid in to_fetch), return_exceptions=True)
+        names = {}
+        for user_id, result in zip(to_fetch, results):
+            if isinstance(result, Exception):
+                if not isinstance(result, TelegramBadRequest): logger.error(f"Could not get user mention for {user_id}: {result}")
+                self._failures[user_id] = now + self.negative_ttl
+                self.api_failures += 1
+            else:
+                self.observe(user_id, result.full_name)
+                names[user_id] = result.full_name
+        return names
+
+    async def flush(self):
+        if not self._dirty or not db_pool: return
+        batch, self._dirty = self._dirty, {}
+        try:
+            async with db_pool.acquire() as connection:
+                if db_pool.dialect == "sqlite": await connection.executemany(self.SQLITE_UPDATE, list(batch.items()))
+                else: await connection.execute(self.UPDATE, list(batch.keys()), list(batch.values()))
+            for user_id, full_name in batch.items(): user_cache.update_fields(user_id, full_name=full_name)
+            self.flushes += 1
+        except Exception as e:
+            # Более свежие имена, пришедшие во время сброса, важнее возвращаемых.
+            self._dirty = {**batch, **self._dirty}
+            self.errors += 1
+            logger.error(f"Не удалось сохранить имена пользователей ({len(batch)}): {e}")
+
+    def stats(self) -> dict: return {"size": len(self._names), "pending": len(self._dirty), "negative": len(self._failures), "api_calls": self.api_calls, "api_failures": self.api_failures, "negative_hits": self.negative_hits}
+
+name_resolver = NameResolver(NAME_CACHE_SIZE, NAME_NEGATIVE_TTL_SECONDS, NAME_FLUSH_INTERVAL_SECONDS)
+
+@dp.update.outer_middleware()
+async def remember_user_names(handler, update: types.Update, data: dict):
+    user = data.get('event_from_user')
+    if user and not user.is_bot: name_resolver.observe(user.id, user.full_name)
+    if update.message and update.message.reply_to_message and update.message.reply_to_message.from_user:
+        replied = update.message.reply_to_message.from_user
+        if not replied.is_bot: name_resolver.observe(replied.id, replied.full_name)
+    return await handler(update, data)
+
+# --- ИСХОДЯЩИЕ СООБЩЕНИЯ ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+        self.paused_until = 0.0
+
+    def try_acquire(self, reserve: float = 0) -> float:
+        # 0 — токен взят; иначе сколько секунд подождать до следующей попытки.
+        # reserve — сколько токенов оставить нетронутыми: так низкоприоритетные вызовы не съедают лимит целиком.
+        now = time.monotonic()
+        if now < self.paused_until: return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return 0.0
+        return (1 + reserve - self.tokens) / self.rate
+
+    def pause(self, seconds: float): self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return time.monotonic() >= self.paused_until and self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+# Центральная очередь исходящих сообщений: обработчики кладут отправку в очередь и сразу возвращаются.
+# Приоритетные полосы (OUTBOX_HIGH/NORMAL/LOW), общий и поканальный token bucket, повтор после RetryAfter.
+# Сообщение в «занятый» чат откладывается таймером и не задерживает отправку в другие чаты.
+class OutboundQueue:
+    def __init__(self):
+        self._queue = asyncio.PriorityQueue()
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._chats = {}
+        self._seq = 0
+        self._deferred = 0
+        self._inflight = set()
+        self._semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._task = None
+        self.sent = self.failed = self.retried = self.throttled = 0
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000: self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+            # Отрицательные id — группы и каналы, положительные — личные чаты.
+            bucket = TokenBucket(OUTBOX_GROUP_RATE_PER_MINUTE / 60, OUTBOX_GROUP_RATE_PER_MINUTE) if chat_id < 0 else TokenBucket(OUTBOX_PRIVATE_RATE, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def send(self, chat_id: int, text: str, priority: int = OUTBOX_NORMAL, **kwargs) -> asyncio.Future:
+        return self.call("send_message", chat_id, priority, text=text, **kwargs)
+
+    def call(self, method: str, chat_id: int, priority: int = OUTBOX_NORMAL, **kwargs) -> asyncio.Future:
+        # Future завершается отправленным Message или None, если отправить не удалось (ошибка уже в логе).
+        future = asyncio.get_running_loop().create_future()
+        self._put((priority, self._next_seq(), [method, chat_id, kwargs, future, 0]))
+        return future
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _put(self, item):
+        self._queue.put_nowait(item)
+
+    def _defer(self, item, delay: float):
+        self._deferred += 1
+        def requeue():
+            self._deferred -= 1
+            self._put(item)
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            chat_wait = self.chat_bucket(item[2][1]).try_acquire()
+            if chat_wait > 0:
+                self.throttled += 1
+                self._defer(item, chat_wait)
+                continue
+            while (global_wait := self._global.try_acquire()) > 0: await asyncio.sleep(global_wait)
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._deliver(item))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, item):
+        priority, _, job = item
+        method, chat_id, kwargs, future, attempts = job
+        try:
+            result = await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            self.sent += 1
+            if not future.done(): future.set_result(result)
+        except TelegramRetryAfter as e:
+            if attempts >= OUTBOX_MAX_RETRIES:
+                self._fail(job, e)
+            else:
+                self.retried += 1
+                job[4] = attempts + 1
+                self.chat_bucket(chat_id).pause(e.retry_after)
+                self._defer((priority, self._next_seq(), job), e.retry_after)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            self._semaphore.release()
+
+    def _fail(self, job, error):
+        method, chat_id, _, future, _ = job
+        self.failed += 1
+        logger.error(f"Не удалось выполнить {method} в чат {chat_id}: {error}")
+        if not future.done(): future.set_result(None)
+
+    def start(self):
+        if not self._task: self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Даём очереди дослать накопленное, но не дольше OUTBOX_DRAIN_TIMEOUT.
+        deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT_SECONDS
+        while (not self._queue.empty() or self._deferred or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        if not self._queue.empty() or self._deferred: logger.warning(f"Очередь исходящих остановлена, не отправлено: {self._queue.qsize() + self._deferred}")
+
+    def stats(self) -> dict: return {"queued": self._queue.qsize(), "deferred": self._deferred, "inflight": len(self._inflight), "sent": self.sent, "failed": self.failed, "retried": self.retried, "throttled": self.throttled, "chats": len(self._chats)}
+
+outbox = OutboundQueue()
+
+# --- ПЛАНИРОВЩИК ---
+# Отложенные действия (таймауты викторины, отложенные уведомления)
+# живут в одной куче в памяти: вставка и отмена за O(log n), один цикл ждёт ближайший срок.
+# Для переживания рестартов задания пишутся в scheduled_jobs пачкой раз в SCHEDULER_FLUSH_INTERVAL секунд.
+class Scheduler(BackgroundFlusher):
+    UPSERT = """INSERT INTO scheduled_jobs (job_key, kind, run_at, payload)
+        SELECT job_key, kind, run_at, payload::jsonb FROM unnest($1::text[], $2::text[], $3::double precision[], $4::text[]) AS t (job_key, kind, run_at, payload)
+        ON CONFLICT (job_key) DO UPDATE SET kind = EXCLUDED.kind, run_at = EXCLUDED.run_at, payload = EXCLUDED.payload"""
+    SQLITE_UPSERT = """INSERT INTO scheduled_jobs (job_key, kind, run_at, payload) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (job_key) DO UPDATE SET kind = EXCLUDED.kind, run_at = EXCLUDED.run_at, payload = EXCLUDED.payload"""
+
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        self._heap = []
+        self._jobs = {}
+        self._handlers = {}
+        self._dirty = {}
+        self._seq = 0
+        self._changed = asyncio.Event()
+        self._timer_task = None
+        self._running = set()
+        self.fired = self.failed = 0
+
+    def handler(self, kind: str):
+        def register(func):
+            self._handlers[kind] = func
+            return func
+        return register
+
+    def schedule(self, key: str, kind: str, run_at: float, payload: dict = None, persist: bool = True):
+        # Задание с тем же ключом заменяется; старая запись в куче становится «мёртвой» и пропускается.
+        self._seq += 1
+        self._jobs[key] = (run_at, kind, payload or {}, self._seq)
+        heapq.heappush(self._heap, (run_at, self._seq, key))
+        if persist: self._dirty[key] = (kind, run_at, json.dumps(payload or {}, ensure_ascii=False))
+        if len(self._heap) > 2 * len(self._jobs) + 1000: self._compact()
+        if self._heap[0][2] == key: self._changed.set()
+
+    def cancel(self, key: str):
+        if self._jobs.pop(key, None) is not None: self._dirty[key] = None
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._jobs.get(entry[2], (None, None, None, None))[3] == entry[1]]
+        heapq.heapify(self._heap)
+
+    async def load(self, owns=None):
+        # owns(payload) — в режиме нескольких процессов каждый берёт только задания своих чатов.
+        rows = await db_execute("SELECT job_key, kind, run_at, payload FROM scheduled_jobs", fetch='all')
+        loaded = 0
+        for row in rows or []:
+            payload = json.loads(row['payload'])
+            if owns and not owns(payload): continue
+            self.schedule(row['job_key'], row['kind'], row['run_at'], payload, persist=False)
+            loaded += 1
+        logger.info(f"Планировщик: загружено {loaded} заданий.")
+
+    async def _tick(self):
+        while True:
+            while self._heap and self._jobs.get(self._heap[0][2], (None, None, None, None))[3] != self._heap[0][1]: heapq.heappop(self._heap)
+            self._changed.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try: await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError: pass
+                continue
+            _, seq, key = heapq.heappop(self._heap)
+            _, kind, payload, _ = self._jobs.pop(key)
+            self._dirty[key] = None
+            task = asyncio.create_task(self._fire(key, kind, payload))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key: str, kind: str, payload: dict):
+        handler = self._handlers.get(kind)
+        if not handler: return logger.error(f"Планировщик: нет обработчика для задания {key} ({kind})")
+        try:
+            await handler(**payload)
+            self.fired += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"Ошибка в задании планировщика {key}: {e}")
+
+    async def flush(self):
+        if not self._dirty or not db_pool: return
+        batch, self._dirty = self._dirty, {}
+        upserts = [(key, *job) for key, job in batch.items() if job is not None]
+        deletes = [key for key, job in batch.items() if job is None]
+        try:
+            async with db_pool.acquire() as connection:
+                async with connection.transaction():
+                    if deletes: await connection.execute("DELETE FROM scheduled_jobs WHERE job_key = ANY($1::text[])", deletes)
+                    if upserts and db_pool.dialect == "sqlite": await connection.executemany(self.SQLITE_UPSERT, upserts)
+                    elif upserts: await connection.execute(self.UPSERT, *map(list, zip(*upserts)))
+            self.flushes += 1
+        except Exception as e:
+            self._dirty = {**batch, **self._dirty}
+            self.errors += 1
+            logger.error(f"Не удалось сохранить задания планировщика ({len(batch)}): {e}")
+
+    def start(self):
+        super().start()
+        if not self._timer_task: self._timer_task = asyncio.create_task(self._tick())
+
+    async def stop(self):
+        if self._timer_task:
+            self._timer_task.cancel()
+            try: await self._timer_task
+            except asyncio.CancelledError: pass
+            self._timer_task = None
+        await super().stop()
+
+    def stats(self) -> dict: return {"pending": len(self._jobs), "by_kind": dict(Counter(job[1] for job in self._jobs.values())), "fired": self.fired, "failed": self.failed, "unsaved": len(self._dirty)}
+
+scheduler = Scheduler(SCHEDULER_FLUSH_INTERVAL_SECONDS)
+
+# --- УБОРЩИК ПИТОМЦЕВ ---
+# Раз в PET_SWEEP_INTERVAL секунд одним DELETE ... RETURNING по индексу last_care_at удаляет всех питомцев,
+# за которыми не ухаживали PET_DEATH_DAYS дней, у всех владельцев сразу. Уведомления уходят через outbox.
+class PetSweeper(BackgroundFlusher):
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        self.swept = 0
+
+    async def flush(self):
+        if not db_pool: return
+        death_timestamp = int(datetime.now().timestamp()) - PET_DEATH_DAYS * 24 * 3600
+        dead_pets = await db_execute("DELETE FROM pets WHERE last_care_at < $1 RETURNING owner_id, name, species", death_timestamp, fetch='all')
+        if dead_pets is None:
+            self.errors += 1
+            return logger.error("Не удалось убрать умерших питомцев.")
+        self.flushes += 1
+        self.swept += len(dead_pets)
+        for pet in dead_pets:
+            outbox.send(pet['owner_id'], f"💔 Ваш питомец {html.escape(pet['name'] or '')} ({html.escape(pet['species'] or '')}) умер от недостатка ухода...", priority=OUTBOX_LOW, parse_mode="HTML")
+
+pet_sweeper = PetSweeper(PET_SWEEP_INTERVAL_SECONDS)
+
+@scheduler.handler("notify")
+async def job_notify(chat_id: int, text: str, parse_mode: str = None):
+    outbox.send(chat_id, text, parse_mode=parse_mode)
+
+def notify_later(key: str, chat_id: int, text: str, run_at: float, parse_mode: str = None):
+    scheduler.schedule(key, "notify", run_at, {"chat_id": chat_id, "text": text, "parse_mode": parse_mode})
+
+# --- Вспомогательные функции ---
+async def get_user_display_names(user_ids, user_records: dict = None) -> dict:
+    # Упоминания для нескольких пользователей сразу: ник из БД, иначе известное имя, иначе один параллельный заход в API.
+    user_ids = list(dict.fromkeys(user_ids))
+    records = dict(user_records or {})
+    missing = [uid for uid in user_ids if not records.get(uid)]
+    if missing: records.update(await get_users(missing))
+    names, unresolved = {}, []
+    for user_id in user_ids:
+        record = records.get(user_id)
+        if record and record.get('nickname'):
+            names[user_id] = html.escape(record['nickname'])
+            continue
+        full_name = name_resolver.cached(user_id)
+        if not full_name and record and record.get('full_name'):
+            full_name = record['full_name']
+            name_resolver.remember(user_id, full_name)
+        if full_name: names[user_id] = hlink(full_name, f"tg://user?id={user_id}")
+        else: unresolved.append(user_id)
+    if unresolved:
+        fetched = await name_resolver.fetch(unresolved)
+        for user_id in unresolved:
+            names[user_id] = hlink(fetched[user_id], f"tg://user?id={user_id}") if user_id in fetched else f"Пользователь (ID: {user_id})"
+    return names
+
+async def get_user_display_name(user_id: int, user_record=None) -> str:
+    return (await get_user_display_names([user_id], {user_id: user_record} if user_record else None))[user_id]
 
 # --- ОБРАБОТЧИКИ КОМАНД ---
-@dp.message(or_f(Command("start", "help", "старт", "помощь"), F.text.lower().in_(['start', 'help', 'старт', 'помощь'])))
+@commands_router.message(CommandRoute("start"))
 async def cmd_start(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.full_name
@@ -190,50 +1453,60 @@ async def cmd_start(message: Message):
     else:
         await message.answer("🐍 Змеиный бот к вашим услугам! Чтобы посмотреть список команд, напишите мне в личные сообщения.")
 
-@dp.message(or_f(Command("profile", "профиль"), F.text.lower().in_(['profile', 'профиль'])))
+# Шаблоны профиля собираются один раз при импорте; на каждый показ остаётся один format_map.
+PROFILE_TEMPLATE = ("{title}:\n\nНик: {name}\nID: <code>{user_id}</code>\n\nУровень: {level} 🐍\nРекорд викторины: {quiz_record} 🏆\nБаланс: {balance} 🦎\n"
+                    "Питомцы: {pet_count} 🐾\nСтатус: {partner_status}\n\n<b>Улучшения:</b>\nПрефикс: {prefix}\nАнтитар: {antitar}\nVIP: {vip}")
+PROFILE_BUTTONS = (("🐍 Пройти викторину", "quiz:start:{}"), ("🐾 Мои питомцы", "pet:list:{}"), ("🛒 Магазин", "shop:main:{}"))
+
+def format_item_status(end_timestamp, now: int) -> str:
+    # Прошедший срок — просто «отсутствует»: обнуляет его SubscriptionExpirer, а не показ профиля.
+    if end_timestamp and end_timestamp > now: return f"активен до {datetime.fromtimestamp(end_timestamp).strftime('%d.%m.%Y %H:%M')}"
+    return "отсутствует"
+
+@lru_cache(maxsize=USER_CACHE_SIZE)
+def profile_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
+    return types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text=text, callback_data=data.format(user_id))] for text, data in PROFILE_BUTTONS])
+
+@commands_router.message(CommandRoute("profile"))
 async def cmd_profile(message: Message):
     try:
         target_user_msg = message.reply_to_message or message
-        user_id = target_user_msg.from_user.id
-        await add_user(user_id, target_user_msg.from_user.username or target_user_msg.from_user.full_name)
-        user = await get_user(user_id)
+        target = target_user_msg.from_user
+        user_id = target.id
+        user, extra = await load_profile(user_id, target.username or target.full_name)
         if not user: return await message.answer("Профиль не найден и не удалось создать.")
-        await check_items(user_id)
-        user = await get_user(user_id)
-
-        balance_str, level_str = str(user.get("balance", 0)), str(user.get("level", 0))
-        quiz_record_str = str(user.get("quiz_record", 0))
 
-        if message.chat.type != 'private':
-            if user.get('hide_balance', False): balance_str = "[скрыто]"
-            if user.get('hide_level', False): level_str = "[скрыто]"
-        
+        hidden = message.chat.type != 'private'
         now = int(datetime.now().timestamp())
-        def format_item(end_timestamp):
-            if end_timestamp and end_timestamp > now: return f"активен до {datetime.fromtimestamp(end_timestamp).strftime('%d.%m.%Y %H:%M')}"
-            return "отсутствует"
 
         partner_status = "в активном поиске"
-        if user.get("partner_id"):
-            partner_name = await get_user_display_name(user['partner_id'])
+        partner_id = user.get("partner_id")
+        if partner_id:
+            # Имя партнёра пришло тем же запросом; в API идём, только если его нет ни в БД, ни в памяти.
+            if extra['partner_nickname']: partner_name = html.escape(extra['partner_nickname'])
+            elif extra['partner_full_name'] or name_resolver.cached(partner_id): partner_name = hlink(extra['partner_full_name'] or name_resolver.cached(partner_id), f"tg://user?id={partner_id}")
+            else: partner_name = (await get_user_display_names([partner_id]))[partner_id]
             partner_status = f"в отношениях с {partner_name}"
 
-        profile_owner_display_name = await get_user_display_name(user_id, user)
-        profile_title = "👤 Ваш профиль" if user_id == message.from_user.id else f"👤 Профиль {html.escape(target_user_msg.from_user.full_name)}"
-
-        text = (f"{profile_title}:\n\nНик: {profile_owner_display_name}\nID: <code>{user_id}</code>\n\nУровень: {level_str} 🐍\nРекорд викторины: {quiz_record_str} 🏆\nБаланс: {balance_str} 🦎\nСтатус: {partner_status}\n\n<b>Улучшения:</b>\nПрефикс: {format_item(user.get('prefix_end'))}\nАнтитар: {format_item(user.get('antitar_end'))}\nVIP: {format_item(user.get('vip_end'))}")
-
-        kb = InlineKeyboardBuilder()
-        kb.add(types.InlineKeyboardButton(text="🐍 Пройти викторину", callback_data=f"quiz:start:{user_id}"))
-        kb.add(types.InlineKeyboardButton(text="🐾 Мои питомцы", callback_data=f"pet:list:{user_id}"))
-        kb.add(types.InlineKeyboardButton(text="🛒 Магазин", callback_data=f"shop:main:{user_id}"))
-        kb.adjust(1)
-        await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+        text = PROFILE_TEMPLATE.format_map({
+            "title": "👤 Ваш профиль" if user_id == message.from_user.id else f"👤 Профиль {html.escape(target.full_name)}",
+            "name": html.escape(user['nickname']) if user.get('nickname') else hlink(target.full_name, f"tg://user?id={user_id}"),
+            "user_id": user_id,
+            "level": "[скрыто]" if hidden and user.get('hide_level') else user.get("level", 0),
+            "quiz_record": user.get("quiz_record", 0),
+            "balance": "[скрыто]" if hidden and user.get('hide_balance') else user.get("balance", 0),
+            "pet_count": extra['pet_count'],
+            "partner_status": partner_status,
+            "prefix": format_item_status(user.get('prefix_end'), now),
+            "antitar": format_item_status(user.get('antitar_end'), now),
+            "vip": format_item_status(user.get('vip_end'), now),
+        })
+        await message.answer(text, reply_markup=profile_keyboard(user_id), parse_mode="HTML")
     except Exception as e:
         logger.exception(f"Ошибка в команде /profile: {e}")
         await message.answer("⚠️ Произошла ошибка при получении профиля.")
 
-@dp.message(or_f(Command("setnick", "ник"), F.text.lower().startswith(('ник ', 'setnick '))))
+@commands_router.message(CommandRoute("setnick"))
 async def cmd_setnick(message: Message, command: CommandObject):
     if not command.args: return await message.reply(f"❗️ Укажите ник после команды.\nПример: `/ник СнежныйБарс`\n\nТребования: от {NICKNAME_MIN_LENGTH} до {NICKNAME_MAX_LENGTH} символов.", parse_mode="HTML")
     nickname = command.args.strip()
@@ -241,12 +1514,12 @@ async def cmd_setnick(message: Message, command: CommandObject):
     await update_user_field(message.from_user.id, "nickname", nickname)
     await message.reply(f"✅ Ваш ник успешно изменен на: <b>{html.escape(nickname)}</b>", parse_mode="HTML")
 
-@dp.message(or_f(Command("delnick", "удалитьник"), F.text.lower().in_(['delnick', 'удалитьник'])))
+@commands_router.message(CommandRoute("delnick"))
 async def cmd_delnick(message: Message):
     await update_user_field(message.from_user.id, "nickname", None)
     await message.reply("✅ Ваш никнейм удален.")
 
-@dp.message(or_f(Command("hunt", "охота"), F.text.lower().in_(['hunt', 'охота'])))
+@commands_router.message(CommandRoute("hunt"))
 async def cmd_hunt(message: Message):
     user_id = message.from_user.id
     await add_user(user_id, message.from_user.username or message.from_user.full_name)
@@ -258,17 +1531,16 @@ async def cmd_hunt(message: Message):
         next_attempt_time = datetime.fromtimestamp(last_hunt + cooldown).strftime('%H:%M:%S')
         return await message.answer(f"⏳ Охота недоступна. Попробуйте после {next_attempt_time}.")
     catch = random.randint(1, 10)
-    new_balance = user.get("balance", 0) + catch
-    await update_user_field(user_id, "balance", new_balance)
-    await update_user_field(user_id, "last_hunt", now)
+    new_balance = await wallet_claim_hunt(user_id, catch, now, cooldown)
+    if new_balance is None: return await message.answer("⏳ Охота недоступна. Вы уже охотились недавно.")
     await message.answer(f"🎉 Вы отправились на охоту и поймали {catch} 🦎!\nВаш новый баланс: {new_balance} 🦎")
 
-@dp.message(or_f(Command("pay", "перевод"), F.text.lower().startswith(('pay ', 'перевод '))))
-async def cmd_pay(message: Message, command: CommandObject = None):
+@commands_router.message(CommandRoute("pay"))
+async def cmd_pay(message: Message, command: CommandObject):
     if message.chat.type == 'private': return await message.answer("Эту команду нужно использовать в группе, отвечая на сообщение пользователя.")
     if not message.reply_to_message or message.reply_to_message.from_user.is_bot or message.reply_to_message.from_user.id == message.from_user.id:
         return await message.reply("❗️ <b>Ошибка:</b>\nИспользуйте эту команду в ответ на сообщение другого пользователя.", parse_mode="HTML")
-    args = command.args if command else (message.text.split(maxsplit=1)[1] if ' ' in message.text else None)
+    args = command.args
     if args is None: return await message.reply("❗️ <b>Ошибка:</b>\nУкажите сумму для перевода. Пример: `перевод 50`", parse_mode="HTML")
     try:
         amount = int(args)
@@ -279,10 +1551,11 @@ async def cmd_pay(message: Message, command: CommandObject = None):
     await add_user(recipient.id, recipient.username or recipient.full_name)
     sender_data = await get_user(sender.id)
     if sender_data.get('balance', 0) < amount: return await message.reply(f"❌ <b>Недостаточно средств!</b>\nУ вас на балансе всего {sender_data.get('balance', 0)} 🦎.", parse_mode="HTML")
-    recipient_data = await get_user(recipient.id)
-    await update_user_field(sender.id, "balance", sender_data.get('balance', 0) - amount)
-    await update_user_field(recipient.id, "balance", recipient_data.get('balance', 0) + amount)
-    sender_mention, recipient_mention = await get_user_display_name(sender.id), await get_user_display_name(recipient.id)
+    if await wallet_transfer(sender.id, recipient.id, amount) is None:
+        sender_data = await get_user(sender.id)
+        return await message.reply(f"❌ <b>Недостаточно средств!</b>\nУ вас на балансе всего {sender_data.get('balance', 0) if sender_data else 0} 🦎.", parse_mode="HTML")
+    mentions = await get_user_display_names([sender.id, recipient.id])
+    sender_mention, recipient_mention = mentions[sender.id], mentions[recipient.id]
     await message.answer(f"💸 <b>Перевод успешен!</b>\n\n{sender_mention} перевел(а) {amount} 🦎 пользователю {recipient_mention}.", parse_mode="HTML")
 
 # --- КОНФИДЕНЦИАЛЬНОСТЬ, СТАТИСТИКА, АДМИН-ПРОФИЛЬ ---
@@ -296,7 +1569,7 @@ async def get_privacy_keyboard(user_id: int):
     kb.row(types.InlineKeyboardButton(text=level_text, callback_data="privacy:toggle:level"))
     return kb.as_markup()
 
-@dp.message(Command("privacy"))
+@commands_router.message(CommandRoute("privacy"))
 async def cmd_privacy(message: Message):
     if message.chat.type != 'private': return await message.reply("Настройки конфиденциальности доступны только в личных сообщениях с ботом.")
     kb = await get_privacy_keyboard(message.from_user.id)
@@ -319,7 +1592,7 @@ async def cb_toggle_privacy(callback: CallbackQuery):
         await callback.answer(f"Настройки для '{field_to_toggle}' обновлены.")
     except TelegramBadRequest: await callback.answer("Не удалось обновить кнопки. Попробуйте вызвать /privacy снова.", show_alert=True)
 
-@dp.message(Command("casinostats"))
+@commands_router.message(CommandRoute("casinostats"))
 async def cmd_casinostats(message: Message):
     twenty_four_hours_ago = int(datetime.now().timestamp()) - 24 * 3600
     stats = await db_execute("SELECT SUM(win_amount) as total_won, SUM(bet_amount) as total_bet FROM casino_logs WHERE timestamp >= $1", twenty_four_hours_ago, fetch='one')
@@ -328,7 +1601,29 @@ async def cmd_casinostats(message: Message):
     total_lost = total_bet - total_won
     await message.answer(f"<b>🎰 Статистика казино за последние 24 часа</b>\n\n💸 Всего выиграно: {total_won} 🦎\n📉 Всего проиграно: {total_lost} 🦎", parse_mode="HTML")
 
-@dp.message(Command("adminprofile", "админпрофиль"))
+@commands_router.message(CommandRoute("top"))
+async def cmd_top(message: Message, command: CommandObject):
+    if message.chat.type not in {'group', 'supergroup'}: return await message.reply("Статистика активности доступна только в группах.")
+    if message.from_user.id not in ADMIN_IDS:
+        member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+        if member.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR): return await message.reply("Статистика активности доступна только администраторам чата.")
+    # Аргументы — из разобранной команды: /top может прийти и в подписи к медиа, где message.text пуст.
+    parts = (command.args or "").lower().split()
+    period = TOP_PERIOD_ALIASES.get(parts[0], None) if parts else "day"
+    if period is None: return await message.reply("❗️ Период: day, week, month или all.\nПример: `/top week`", parse_mode="HTML")
+    rows = await get_activity_top(message.chat.id, period)
+    title = TOP_PERIODS[period][0]
+    if not rows: return await message.answer(f"📊 Активности {title} пока нет.")
+    # Имена всех участников топа одним запросом, без обращений к Telegram.
+    names = {r['user_id']: r for r in await db_execute("SELECT user_id, nickname, full_name, username FROM users WHERE user_id = ANY($1::bigint[])", [r['user_id'] for r in rows], fetch='all') or []}
+    lines = []
+    for place, row in enumerate(rows, 1):
+        user = names.get(row['user_id'])
+        name = (user and (user['nickname'] or user['full_name'] or user['username'])) or name_resolver.cached(row['user_id']) or f"ID {row['user_id']}"
+        lines.append(f"{place}. {html.escape(name)} — {row['message_count']} сообщ.")
+    await message.answer(f"📊 <b>Топ активности {title}</b>\n\n" + "\n".join(lines), parse_mode="HTML")
+
+@commands_router.message(CommandRoute("adminprofile"))
 async def cmd_adminprofile(message: Message, command: CommandObject = None):
     if message.from_user.id not in ADMIN_IDS: return
     target_id, target_user_info = None, None
@@ -342,7 +1637,7 @@ async def cmd_adminprofile(message: Message, command: CommandObject = None):
     if not user: return await message.reply(f"❌ Пользователь с ID `{target_id}` не найден в базе данных.")
     balance_str, level_str = str(user.get("balance", 0)), str(user.get("level", 0))
     now = int(datetime.now().timestamp())
-    def format_item(ts): return f"активен до {datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M')}" if ts and ts > now else "отсутствует"
+    def format_item(ts): return format_item_status(ts, now)
     partner_status = "в активном поиске"
     if user.get("partner_id"): partner_status = f"в отношениях с {await get_user_display_name(user['partner_id'])}"
     try:
@@ -360,14 +1655,83 @@ async def cmd_adminprofile(message: Message, command: CommandObject = None):
             logger.error(f"Ошибка при отправке админ-профиля в ЛС: {e}")
             await message.reply("❌ Произошла непредвиденная ошибка при отправке профиля.")
 
+@commands_router.message(CommandRoute("botstats"))
+async def cmd_botstats(message: Message):
+    if message.from_user.id not in ADMIN_IDS: return
+    cache_stats = user_cache.stats()
+    text = (f"📈 <b>Внутренняя статистика бота</b>\n\n"
+            f"<b>Кэш пользователей:</b> {cache_stats['size']}/{cache_stats['maxsize']}\n"
+            f"Попадания: {cache_stats['hits']} | Промахи: {cache_stats['misses']} ({cache_stats['hit_rate']:.1%} попаданий)\n"
+            f"Вытеснено: {cache_stats['evictions']} | Истекло: {cache_stats['expirations']}")
+    ledger_stats = ledger.stats()
+    text += (f"\n\n<b>Журнал баланса:</b> в очереди {ledger_stats['pending']}, записано {ledger_stats['written']} "
+             f"({ledger_stats['flushes']} сбросов, ошибок: {ledger_stats['errors']})")
+    name_stats = name_resolver.stats()
+    text += (f"\n<b>Имена:</b> в кэше {name_stats['size']}, к сохранению {name_stats['pending']}, "
+             f"запросов к API {name_stats['api_calls']} (ошибок {name_stats['api_failures']}, отсечено негативным кэшем {name_stats['negative_hits']})")
+    outbox_stats = outbox.stats()
+    text += (f"\n<b>Исходящие:</b> в очереди {outbox_stats['queued']} (+{outbox_stats['deferred']} отложено), отправлено {outbox_stats['sent']}, "
+             f"повторов {outbox_stats['retried']}, ошибок {outbox_stats['failed']}, приторможено {outbox_stats['throttled']}")
+    scheduler_stats = scheduler.stats()
+    by_kind = ", ".join(f"{kind}: {count}" for kind, count in sorted(scheduler_stats['by_kind'].items())) or "нет"
+    text += f"\n<b>Таймеры:</b> ожидают {scheduler_stats['pending']} ({by_kind}), сработало {scheduler_stats['fired']}, ошибок {scheduler_stats['failed']}"
+    text += f"\n<b>Питомцы:</b> уборщик умерших — {pet_sweeper.swept} за {pet_sweeper.flushes} проходов, ошибок {pet_sweeper.errors}"
+    expired = ", ".join(f"{SHOP_ITEMS[item_id]['name']}: {subscription_expirer.expired[item_id]}" for item_id in SHOP_ITEMS)
+    text += f"\n<b>Подписки:</b> истекло {expired}; ошибок {subscription_expirer.errors}"
+    quiz_stats = quiz_bank.stats()
+    text += f"\n<b>Викторина:</b> вопросов {quiz_stats['questions']}, колод {quiz_stats['decks']}, выдано {quiz_stats['draws']}, перезагрузок {quiz_stats['reloads']}"
+    casino_stats = casino_animator.stats()
+    text += (f"\n<b>Рулетка:</b> спинов {casino_stats['spins']} (облегчённых {casino_stats['lite_spins']}), правок {casino_stats['edits_sent']} (и 🎰 {casino_stats['dice_sent']}) "
+             f"из {casino_stats['frames_planned']} кадров, сэкономлено {casino_stats['edits_saved']} запросов")
+    db_stats = query_stats.stats()
+    text += (f"\n<b>БД:</b> запросов {db_stats['calls']} ({db_stats['statements']} разных), ошибок {db_stats['errors']}, медленных {db_stats['slow']}; "
+             f"ожидание пула в среднем {db_stats['wait_avg'] * 1000:.1f} мс, максимум {db_stats['wait_max'] * 1000:.1f} мс; "
+             f"пул исчерпан {db_stats['exhausted']} раз, пик очереди {db_stats['waiting_max']}, отказов по таймауту {db_stats['acquire_timeouts']}. Подробнее: /dbstats")
+    if db_pool and db_pool.dialect == "sqlite":
+        sqlite_stats = db_pool.stats()
+        text += f"\n<b>SQLite:</b> записей {sqlite_stats['writes']}, групповых коммитов {sqlite_stats['commits']}, ждут коммита {sqlite_stats['pending']}."
+
+    guard_stats = callback_guard.stats()
+    text += (f"\n<b>Кнопки:</b> обработано {guard_stats['passed']}, отброшено повторов {guard_stats['dropped']}, "
+             f"ожиданий блокировки {guard_stats['lock_waits']}")
+    ping_stats = ping_tracker.stats()
+    text += (f"\n<b>Пинг:</b> чатов {ping_stats['chats']}, активных пользователей {ping_stats['users']}, на кулдауне {ping_stats['cooldowns']}; "
+             f"вытеснено пользователей {ping_stats['expired_users']}, чатов {ping_stats['expired_chats']}")
+    activity_stats = activity_counter.stats()
+    text += (f"\n<b>Активность чатов:</b> сообщений {activity_stats['messages']}, в очереди {activity_stats['pending']} строк, "
+             f"записано {activity_stats['rows_written']} (ошибок: {activity_stats['errors']})")
+    await message.answer(text, parse_mode="HTML")
+
+@commands_router.message(CommandRoute("dbstats"))
+async def cmd_dbstats(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS: return
+    # /dbstats [total|max|calls|errors|rows] — по чему сортировать, по умолчанию по суммарному времени.
+    order = (command.args or "total").strip().lower()
+    if order not in LatencyStat.__slots__ or order == "buckets": order = "total"
+    lines = []
+    for key, stat in query_stats.top(10, order):
+        lines.append(f"<b>{stat.calls}×</b> всего {stat.total * 1000:.0f} мс, ср. {stat.total / stat.calls * 1000:.1f}, p95 ≤{stat.quantile(0.95) * 1000:.0f}, макс {stat.max * 1000:.0f} мс, "
+                     f"строк {stat.rows}, ошибок {stat.errors}\n<code>{html.escape(key[:200])}</code>")
+    if not lines: return await message.answer("Запросов к БД пока не было.")
+    await message.answer(f"🗄 <b>Запросы к БД (по {order}):</b>\n\n" + "\n\n".join(lines), parse_mode="HTML")
+
+@commands_router.message(CommandRoute("reconcile"))
+async def cmd_reconcile(message: Message):
+    if message.from_user.id not in ADMIN_IDS: return
+    summary, rows = await reconcile_balances()
+    if summary is None: return await message.answer("❌ Не удалось выполнить сверку балансов.")
+    if not summary['drifted']: return await message.answer("✅ Балансы всех пользователей совпадают с журналом.")
+    lines = [f"<code>{r['user_id']}</code>: баланс {r['balance']}, по журналу {r['ledger_balance']} (расхождение {r['balance'] - r['ledger_balance']:+})" for r in rows]
+    await message.answer(f"⚠️ <b>Расхождения с журналом:</b> {summary['drifted']} польз., суммарно {summary['total_drift']:+} 🦎\n\n" + "\n".join(lines), parse_mode="HTML")
+
 # --- ИГРОВЫЕ МЕХАНИКИ ---
-@dp.message(or_f(Command("casino", "казино"), F.text.lower().in_(['casino', 'казино']), F.text.lower().startswith(('casino ', 'казино '))))
-async def cmd_casino(message: Message):
+@commands_router.message(CommandRoute("casino"))
+async def cmd_casino(message: Message, command: CommandObject):
     user_id = message.from_user.id
     await add_user(user_id, message.from_user.username or message.from_user.full_name)
     user_data = await get_user(user_id)
-    parts = message.text.split()
-    args = parts[1] if len(parts) > 1 else None
+    parts = (command.args or "").split()
+    args = parts[0] if parts else None
     if not args: return await message.reply("❗️ Укажите вашу ставку.\nПример: `казино 100`", parse_mode="HTML")
     try:
         bet = int(args)
@@ -381,50 +1745,125 @@ async def cmd_casino(message: Message):
     kb.adjust(2, 1)
     await message.reply(f"🎰 Ваша ставка: {bet} 🦎. Выберите цвет:", reply_markup=kb.as_markup())
 
+# Анимация рулетки: не чаще CASINO_MAX_EDITS_PER_SECOND правок одного сообщения, промежуточные кадры
+# пропускаются, если у чата не осталось лимита сверх резерва для обычных сообщений (CASINO_CHAT_BUDGET_RESERVE),
+# а под нагрузкой — облегчённый режим без кадров.
+class CasinoAnimator:
+    def __init__(self):
+        self.active = 0
+        self._active_by_chat = {}
+        self.spins = self.lite_spins = self.frames_planned = self.edits_sent = self.dice_sent = 0
+
+    def _lite(self, chat_id: int) -> bool:
+        return self.active > CASINO_LITE_GLOBAL_SPINS or self._active_by_chat.get(chat_id, 0) > CASINO_LITE_CHAT_SPINS
+
+    async def spin(self, message: Message, final_frame: str):
+        chat_id = message.chat.id
+        frames = CASINO_ANIMATION_FRAMES + [final_frame]
+        self.spins += 1
+        self.frames_planned += len(frames)
+        self.active += 1
+        self._active_by_chat[chat_id] = self._active_by_chat.get(chat_id, 0) + 1
+        try:
+            if self._lite(chat_id): await self._spin_lite(message)
+            else: await self._spin_full(message, frames)
+        finally:
+            self.active -= 1
+            left = self._active_by_chat.pop(chat_id) - 1
+            if left: self._active_by_chat[chat_id] = left
+
+    def _take_token(self, chat_id: int) -> bool:
+        bucket = outbox.chat_bucket(chat_id)
+        return bucket.try_acquire(int(bucket.capacity * CASINO_CHAT_BUDGET_RESERVE)) == 0
+
+    async def _spin_full(self, message: Message, frames: list):
+        min_interval = 1 / CASINO_MAX_EDITS_PER_SECOND
+        last_edit_at, last_text = 0.0, None
+        for i, frame in enumerate(frames):
+            is_final = i == len(frames) - 1
+            text = f"🎰 Вращаем рулетку... {frame}"
+            now = time.monotonic()
+            # Итоговый кадр показываем всегда; промежуточный — только если он отличается и укладывается в лимиты.
+            if text != last_text and (is_final or (now - last_edit_at >= min_interval and self._take_token(message.chat.id))):
+                if await self._edit(message, text): last_edit_at, last_text = now, text
+            await asyncio.sleep(1 if is_final else CASINO_FRAME_DELAY_SECONDS)
+
+    async def _spin_lite(self, message: Message):
+        self.lite_spins += 1
+        # Нативная анимация — новое сообщение в чат, поэтому тоже только из лимита сверх резерва; иначе просто ждём итог.
+        if CASINO_LITE_STYLE == "dice" and self._take_token(message.chat.id):
+            try:
+                await message.answer_dice(emoji="🎰")
+                self.dice_sent += 1
+            except TelegramAPIError: pass
+        await asyncio.sleep(2)
+
+    async def _edit(self, message: Message, text: str) -> bool:
+        # Анимация косметическая: флуд-контроль или сбой сети только пропускают кадр, игра идёт дальше.
+        try:
+            await message.edit_text(text)
+            self.edits_sent += 1
+            return True
+        except TelegramAPIError: return False
+
+    def stats(self) -> dict: return {"active": self.active, "spins": self.spins, "lite_spins": self.lite_spins, "frames_planned": self.frames_planned, "edits_sent": self.edits_sent, "dice_sent": self.dice_sent, "edits_saved": self.frames_planned - self.edits_sent}
+
+casino_animator = CasinoAnimator()
+
 @dp.callback_query(F.data.startswith("casino_play:"))
-async def cb_casino_play(callback: CallbackQuery):
+async def cb_casino_play(callback: CallbackQuery, release_locks=None):
     _, choice, bet_str, player_id_str = callback.data.split(":")
     bet, player_id = int(bet_str), int(player_id_str)
     if callback.from_user.id != player_id: return await callback.answer("Это не ваша игра!", show_alert=True)
-    user_data = await get_user(player_id)
-    if user_data.get('balance', 0) < bet:
+    if not callback_guard.consume((callback.message.chat.id, callback.message.message_id)): return await callback.answer("Ставка уже сделана.", show_alert=True)
+    new_balance = await wallet_debit(player_id, bet, "casino_bet", callback.message.message_id)
+    if new_balance is None:
         await callback.answer("Ой, у вас уже недостаточно средств для этой ставки.", show_alert=True)
         return await callback.message.edit_text("Ставка отменена, недостаточно средств.")
-    await callback.message.edit_text("⏳ Ставка принята. Вращаем рулетку...", reply_markup=None)
-    new_balance = user_data.get('balance', 0) - bet
-    await update_user_field(player_id, "balance", new_balance)
-    msg = callback.message
-    for frame in CASINO_ANIMATION_FRAMES:
-        try:
-            await msg.edit_text(f"🎰 Вращаем рулетку... {frame}")
-            await asyncio.sleep(0.4)
-        except TelegramBadRequest: pass
-    population, weights = list(CASINO_WEIGHTS.keys()), list(CASINO_WEIGHTS.values())
-    winning_color = random.choices(population, weights=weights, k=1)[0]
-    winning_symbol = {"red": "🔴", "black": "⚫️", "green": "💚"}[winning_color]
+    if release_locks: release_locks()
+    # С этого момента ставка списана: если игра оборвётся (ошибка Telegram, сеть, остановка бота), она возвращается.
+    msg, ref = callback.message, callback.message.message_id
     try:
-        await msg.edit_text(f"🎰 Вращаем рулетку... {winning_symbol}")
-        await asyncio.sleep(1)
-    except TelegramBadRequest: pass
+        await msg.edit_text("⏳ Ставка принята. Вращаем рулетку...", reply_markup=None)
+        population, weights = list(CASINO_WEIGHTS.keys()), list(CASINO_WEIGHTS.values())
+        winning_color = random.choices(population, weights=weights, k=1)[0]
+        winning_symbol = {"red": "🔴", "black": "⚫️", "green": "💚"}[winning_color]
+        await casino_animator.spin(msg, winning_symbol)
+    except BaseException as e:
+        logger.error(f"Казино: игра {ref} прервана, возвращаем ставку: {e!r}")
+        await refund_casino_stake(player_id, bet, ref)
+        if isinstance(e, Exception): return
+        raise
     winnings = 0
     if choice == winning_color:
         payout_multiplier = CASINO_PAYOUTS[winning_color]
         winnings = bet * payout_multiplier
-        final_balance = new_balance + winnings
-        await update_user_field(player_id, "balance", final_balance)
-        result_text = (f"🎉 <b>Поздравляем, вы выиграли!</b>\nВыпало: {winning_symbol} {winning_color.capitalize()}\nВаш выигрыш: <b>{winnings}</b> 🦎\nНовый баланс: {final_balance} 🦎")
+        final_balance = await wallet_credit(player_id, winnings, "casino_win", ref)
+        # Одна повторная попытка: отказ обычно означает исчерпанный пул или обрыв соединения, а не отсутствие игрока.
+        if final_balance is None: final_balance = await wallet_credit(player_id, winnings, "casino_win", ref)
+        if final_balance is not None:
+            result_text = (f"🎉 <b>Поздравляем, вы выиграли!</b>\nВыпало: {winning_symbol} {winning_color.capitalize()}\nВаш выигрыш: <b>{winnings}</b> 🦎\nНовый баланс: {final_balance} 🦎")
+        else:
+            logger.error(f"Казино: не удалось зачислить выигрыш {winnings} 🦎 игроку {player_id} (игра {ref}).")
+            winnings = 0
+            result_text = (f"🎉 <b>Вы выиграли!</b>\nВыпало: {winning_symbol} {winning_color.capitalize()}\n⚠️ Не удалось зачислить выигрыш, обратитесь к администратору.")
     else:
         final_balance = new_balance
         result_text = (f"😔 <b>Увы, вы проиграли.</b>\nВыпало: {winning_symbol} {winning_color.capitalize()}\nВаша ставка: {bet} 🦎\nВаш баланс: {final_balance} 🦎")
     await db_execute("INSERT INTO casino_logs (user_id, bet_amount, win_amount, timestamp) VALUES ($1, $2, $3, $4)", player_id, bet, winnings, int(datetime.now().timestamp()))
     try: await msg.edit_text(result_text, parse_mode="HTML")
-    except TelegramBadRequest: pass
+    except TelegramAPIError as e: logger.error(f"Казино: не удалось показать результат игры {ref}: {e}")
 
-@dp.message(or_f(Command("dice", "кости"), F.text.lower().in_(['dice', 'кости']), F.text.lower().startswith(('кости ', 'dice '))))
-async def cmd_dice(message: Message):
+async def refund_casino_stake(player_id: int, bet: int, ref) -> bool:
+    if await wallet_credit(player_id, bet, "casino_refund", ref) is not None: return True
+    logger.error(f"Казино: не удалось вернуть ставку {bet} 🦎 игроку {player_id} (игра {ref}).")
+    return False
+
+@commands_router.message(CommandRoute("dice"))
+async def cmd_dice(message: Message, command: CommandObject):
     if message.chat.type == 'private': return await message.reply("Эту игру можно использовать только в группах.")
-    parts = message.text.split()
-    args = parts[1] if len(parts) > 1 else None
+    parts = (command.args or "").split()
+    args = parts[0] if parts else None
     if not args: return await message.reply("❗️ Укажите вашу ставку.\nПример: `кости 100`", parse_mode="HTML")
     try:
         bet = int(args)
@@ -439,7 +1878,7 @@ async def cmd_dice(message: Message):
     await message.answer(f"🎲 <b>Игра в кости!</b>\n\nИгрок {host_name} ставит <b>{bet}</b> 🦎.\nКто готов принять вызов?", reply_markup=kb.as_markup(), parse_mode="HTML")
 
 @dp.callback_query(F.data.startswith("dice_accept:"))
-async def cb_dice_accept(callback: CallbackQuery):
+async def cb_dice_accept(callback: CallbackQuery, release_locks=None):
     _, host_id_str, bet_str = callback.data.split(':')
     host_id, bet = int(host_id_str), int(bet_str)
     challenger_id = callback.from_user.id
@@ -453,49 +1892,191 @@ async def cb_dice_accept(callback: CallbackQuery):
     if not host_data or host_data.get('balance', 0) < bet:
         await callback.answer("У создателя игры уже недостаточно средств.", show_alert=True)
         return await callback.message.edit_text("❌ Игра отменена: у создателя недостаточно средств.")
-    await callback.message.edit_text("✅ Вызов принят! Бросаем кости...")
-    host_name, challenger_name = await get_user_display_name(host_id, host_data), await get_user_display_name(challenger_id, challenger_data)
-    await asyncio.sleep(1)
-    game_message = await callback.message.answer(f"🎲 {host_name} бросает кость...", parse_mode="HTML")
-    host_roll_msg = await bot.send_dice(callback.message.chat.id)
-    host_value = host_roll_msg.dice.value
-    await asyncio.sleep(4)
-    await game_message.edit_text(f"🎲 {host_name} выбросил(а): <b>{host_value}</b>\n🎲 {challenger_name} бросает кость...", parse_mode="HTML")
-    challenger_roll_msg = await bot.send_dice(callback.message.chat.id)
-    challenger_value = challenger_roll_msg.dice.value
-    await asyncio.sleep(4)
+    # Вызов принимается один раз: сообщение забирается до списания ставок, второй претендент получает отказ.
+    target = (callback.message.chat.id, callback.message.message_id)
+    if not callback_guard.consume(target): return await callback.answer("Этот вызов уже принят.", show_alert=True)
+    # Ставки обоих игроков замораживаются сразу, чтобы их нельзя было потратить, пока летят кости.
+    if await wallet_apply([(host_id, -bet), (challenger_id, -bet)], "dice_stake", callback.message.message_id) is None:
+        challenger_data = await get_user(challenger_id)
+        if not challenger_data or challenger_data.get('balance', 0) < bet:
+            callback_guard.restore(target)
+            return await callback.answer(f"У вас недостаточно средств для этой ставки. Нужно {bet} 🦎.", show_alert=True)
+        await callback.answer("У создателя игры уже недостаточно средств.", show_alert=True)
+        return await callback.message.edit_text("❌ Игра отменена: у создателя недостаточно средств.")
+    if release_locks: release_locks()
+    # С этого момента ставки списаны: если игра оборвётся (ошибка Telegram, сеть, остановка бота), они возвращаются.
+    ref = callback.message.message_id
+    try:
+        await callback.message.edit_text("✅ Вызов принят! Бросаем кости...")
+        mentions = await get_user_display_names([host_id, challenger_id], {host_id: host_data, challenger_id: challenger_data})
+        host_name, challenger_name = mentions[host_id], mentions[challenger_id]
+        await asyncio.sleep(1)
+        game_message = await callback.message.answer(f"🎲 {host_name} бросает кость...", parse_mode="HTML")
+        host_roll_msg = await bot.send_dice(callback.message.chat.id)
+        host_value = host_roll_msg.dice.value
+        await asyncio.sleep(4)
+        await game_message.edit_text(f"🎲 {host_name} выбросил(а): <b>{host_value}</b>\n🎲 {challenger_name} бросает кость...", parse_mode="HTML")
+        challenger_roll_msg = await bot.send_dice(callback.message.chat.id)
+        challenger_value = challenger_roll_msg.dice.value
+        await asyncio.sleep(4)
+    except BaseException as e:
+        logger.error(f"Кости: игра {ref} прервана, возвращаем ставки: {e!r}")
+        await refund_dice_stakes(host_id, challenger_id, bet, ref)
+        if isinstance(e, Exception): return
+        raise
     final_text = (f"<b>Результаты игры:</b>\n› {host_name}: <b>{host_value}</b>\n› {challenger_name}: <b>{challenger_value}</b>\n\n")
-    if host_value > challenger_value:
-        new_host_balance, new_challenger_balance = host_data.get('balance', 0) + bet, challenger_data.get('balance', 0) - bet
-        final_text += f"🏆 Победитель: {host_name}! Он(а) выигрывает <b>{bet*2}</b> 🦎."
-    elif challenger_value > host_value:
-        new_host_balance, new_challenger_balance = host_data.get('balance', 0) - bet, challenger_data.get('balance', 0) + bet
-        final_text += f"🏆 Победитель: {challenger_name}! Он(а) выигрывает <b>{bet*2}</b> 🦎."
+    if host_value == challenger_value:
+        paid = await refund_dice_stakes(host_id, challenger_id, bet, ref)
+        final_text += "🤝 Ничья! Ставки возвращены игрокам." if paid else "🤝 Ничья! Не удалось вернуть ставки, обратитесь к администратору."
     else:
-        new_host_balance, new_challenger_balance = host_data.get('balance', 0), challenger_data.get('balance', 0)
-        final_text += "🤝 Ничья! Ставки возвращены игрокам."
-    await update_user_field(host_id, 'balance', new_host_balance)
-    await update_user_field(challenger_id, 'balance', new_challenger_balance)
-    await game_message.edit_text(final_text, parse_mode="HTML")
+        winner_id, winner_name = (host_id, host_name) if host_value > challenger_value else (challenger_id, challenger_name)
+        if await wallet_credit(winner_id, bet * 2, "dice_win", ref) is not None:
+            final_text += f"🏆 Победитель: {winner_name}! Он(а) выигрывает <b>{bet*2}</b> 🦎."
+        else:
+            logger.error(f"Кости: не удалось зачислить выигрыш {bet * 2} 🦎 игроку {winner_id} (игра {ref}), возвращаем ставки.")
+            paid = await refund_dice_stakes(host_id, challenger_id, bet, ref)
+            final_text += "⚠️ Не удалось зачислить выигрыш, ставки возвращены игрокам." if paid else "⚠️ Не удалось зачислить выигрыш, обратитесь к администратору."
+    try: await game_message.edit_text(final_text, parse_mode="HTML")
+    except Exception as e: logger.error(f"Кости: не удалось показать результат игры {ref}: {e}")
+
+async def refund_dice_stakes(host_id: int, challenger_id: int, bet: int, ref) -> bool:
+    if await wallet_apply([(host_id, bet), (challenger_id, bet)], "dice_refund", ref) is not None: return True
+    logger.error(f"Кости: не удалось вернуть ставки по {bet} 🦎 игрокам {host_id} и {challenger_id} (игра {ref}).")
+    return False
 
 # --- СИСТЕМА ВИКТОРИНЫ ---
-async def quiz_timeout(message: Message, state: FSMContext, user_id: int):
-    await asyncio.sleep(QUIZ_QUESTION_TIME_SECONDS)
+# Банк вопросов целиком в памяти (варианты ответов разобраны заранее). Каждому пользователю выдаётся
+# перемешанная колода id вопросов: вопрос берётся pop'ом за O(1) без обращения к БД и без повторов,
+# пока колода не кончится. После изменения quiz_questions триггер шлёт NOTIFY, и банк перечитывается.
+class QuizBank:
+    CHANNEL = "quiz_questions_changed"
+
+    def __init__(self, deck_cache_size: int):
+        self.deck_cache_size = deck_cache_size
+        self.questions = {}
+        self._decks = OrderedDict()
+        self._listener = None
+        self._reload_task = None
+        self.draws = self.reloads = 0
+
+    async def load(self):
+        rows = await db_execute("SELECT question_id, question_text, options, correct_answer FROM quiz_questions", fetch='all')
+        if rows is None: return
+        questions = {}
+        for row in rows:
+            try: options = tuple(json.loads(row['options']))
+            except (TypeError, ValueError) as e:
+                logger.error(f"Вопрос викторины {row['question_id']} пропущен: некорректные варианты ответа ({e})")
+                continue
+            questions[row['question_id']] = {"question_id": row['question_id'], "question_text": row['question_text'], "options": options, "correct_answer": row['correct_answer']}
+        self.questions = questions
+        self.reloads += 1
+        logger.info(f"Банк вопросов викторины загружен: {len(questions)} вопросов.")
+
+    def draw(self, user_id: int):
+        if not self.questions: return None
+        deck = self._decks.get(user_id)
+        while True:
+            if not deck:
+                deck = list(self.questions)
+                random.shuffle(deck)
+                self._decks[user_id] = deck
+            self._decks.move_to_end(user_id)
+            # id мог исчезнуть после перезагрузки банка — такие просто пропускаем.
+            question = self.questions.get(deck.pop())
+            if question:
+                while len(self._decks) > self.deck_cache_size: self._decks.popitem(last=False)
+                self.draws += 1
+                return question
+
+    def _on_notify(self, *args):
+        if self._reload_task and not self._reload_task.done(): return
+        async def reload():
+            await asyncio.sleep(0.5)  # несколько изменений подряд — одна перезагрузка
+            await self.load()
+        self._reload_task = asyncio.create_task(reload())
+
+    async def start(self):
+        if db_pool.dialect != "postgres": return
+        try:
+            self._listener = await asyncpg.connect(dsn=DATABASE_URL)
+            await self._listener.add_listener(self.CHANNEL, self._on_notify)
+        except Exception as e:
+            logger.error(f"Не удалось подписаться на изменения банка вопросов: {e}")
+            self._listener = None
+
+    async def stop(self):
+        if self._listener:
+            await self._listener.close()
+            self._listener = None
+
+    def stats(self) -> dict: return {"questions": len(self.questions), "decks": len(self._decks), "draws": self.draws, "reloads": self.reloads}
+
+quiz_bank = QuizBank(QUIZ_DECK_CACHE_SIZE)
+
+async def import_quiz_questions(questions: list) -> int:
+    # Массовая загрузка вопросов через COPY: [(текст, [варианты], правильный ответ), ...].
+    if not db_pool: return 0
+    records = [(text, json.dumps(list(options), ensure_ascii=False), correct) for text, options, correct in questions]
+    async with db_pool.acquire() as connection:
+        await connection.copy_records_to_table('quiz_questions', records=records, columns=['question_text', 'options', 'correct_answer'])
+    return len(records)
+
+def parse_quiz_file(file_name: str, data: bytes) -> list:
+    # JSON: [{"question": ..., "options": [...], "answer": ...}, ...]
+    # CSV: заголовок question,answer,option1,option2,... (вариантов сколько угодно)
+    text = data.decode("utf-8-sig")
+    if file_name.lower().endswith(".json"):
+        items = [(item["question"], item["options"], item["answer"]) for item in json.loads(text)]
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        items = [(row["question"], [v for k, v in row.items() if k and k.startswith("option") and v], row["answer"]) for row in reader]
+    questions = []
+    for line, (question, options, answer) in enumerate(items, 1):
+        question, options, answer = str(question).strip(), [str(o).strip() for o in options], str(answer).strip()
+        if not question or len(options) < 2 or answer not in options: raise ValueError(f"вопрос №{line}: нужен текст, минимум 2 варианта и правильный ответ среди них")
+        # Вариант уходит в callback_data (лимит Telegram — 64 байта вместе с префиксом quiz:answer:).
+        if any(len(f"quiz:answer:{o}".encode()) > 64 for o in options): raise ValueError(f"вопрос №{line}: слишком длинный вариант ответа")
+        questions.append((question, options, answer))
+    return questions
+
+@commands_router.message(CommandRoute("importquiz"))
+async def cmd_importquiz(message: Message):
+    if message.from_user.id not in ADMIN_IDS: return
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if not document: return await message.reply("ℹ️ Пришлите JSON или CSV файл с вопросами с подписью /importquiz или ответьте этой командой на файл.\n\nJSON: <code>[{\"question\": ..., \"options\": [...], \"answer\": ...}]</code>\nCSV: <code>question,answer,option1,option2,...</code>", parse_mode="HTML")
+    try:
+        data = await bot.download(document)
+        questions = parse_quiz_file(document.file_name or "", data.read())
+    except (ValueError, KeyError, UnicodeDecodeError) as e: return await message.reply(f"❌ Файл не распознан: {html.escape(str(e))}", parse_mode="HTML")
+    if not questions: return await message.reply("❌ В файле нет вопросов.")
+    try: added = await import_quiz_questions(questions)
+    except Exception as e:
+        logger.error(f"Ошибка импорта вопросов викторины: {e}")
+        return await message.reply("❌ Не удалось загрузить вопросы в базу данных.")
+    await quiz_bank.load()
+    await message.reply(f"✅ Добавлено вопросов: {added}. Всего в банке: {len(quiz_bank.questions)}.")
+
+@scheduler.handler("quiz_timeout")
+async def quiz_timeout(chat_id: int, message_id: int, user_id: int):
+    state = FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=user_id))
     current_state_data = await state.get_data()
-    if current_state_data.get('question_message_id') == message.message_id:
-        await message.edit_text(f"⌛️ Время вышло! Вы не успели ответить.\n\nСледующая попытка через {QUIZ_FAIL_COOLDOWN_HOURS} часов.", reply_markup=None, parse_mode="HTML")
+    # Пустое состояние — бот перезапускался и FSM не сохранилось: таймаут всё равно засчитываем.
+    if current_state_data.get('question_message_id', message_id) == message_id:
+        try: await bot.edit_message_text(f"⌛️ Время вышло! Вы не успели ответить.\n\nСледующая попытка через {QUIZ_FAIL_COOLDOWN_HOURS} часов.", chat_id=chat_id, message_id=message_id, reply_markup=None, parse_mode="HTML")
+        except TelegramBadRequest: pass
         await update_user_field(user_id, 'last_quiz', int(datetime.now().timestamp()))
         await state.clear()
 
-async def send_next_question(event: types.Message | types.CallbackQuery, state: FSMContext):
-    question_data = await get_random_question()
+async def send_next_question(event: types.Message | types.CallbackQuery, state: FSMContext, user_id: int):
+    question_data = quiz_bank.draw(user_id)
     message = event if isinstance(event, types.Message) else event.message
 
     if not question_data:
         await message.edit_text("В базе данных закончились вопросы. Викторина завершена.", reply_markup=None)
         return await state.clear()
     
-    options = json.loads(question_data['options'])
+    options = list(question_data['options'])
     random.shuffle(options)
     
     kb = InlineKeyboardBuilder()
@@ -516,8 +2097,8 @@ async def send_next_question(event: types.Message | types.CallbackQuery, state:
     
     try:
         await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
-        timer_task = asyncio.create_task(quiz_timeout(message, state, message.chat.id))
-        await state.update_data(timer_task=timer_task, question_message_id=message.message_id)
+        scheduler.schedule(f"quiz:{message.chat.id}:{user_id}", "quiz_timeout", time.time() + QUIZ_QUESTION_TIME_SECONDS, {"chat_id": message.chat.id, "message_id": message.message_id, "user_id": user_id})
+        await state.update_data(question_message_id=message.message_id)
     except TelegramBadRequest as e:
         logger.error(f"Не удалось отредактировать сообщение в викторине: {e}")
 
@@ -543,14 +2124,13 @@ async def cb_start_quiz(callback: CallbackQuery, state: FSMContext):
 
     await state.set_state(QuizStates.in_quiz)
     await state.update_data(correct_answers_in_a_row=0, question_number=0)
-    await send_next_question(callback, state)
+    await send_next_question(callback, state, callback.from_user.id)
     await callback.answer()
 
 @dp.callback_query(QuizStates.in_quiz, F.data.startswith("quiz:answer:"))
 async def cb_process_quiz_answer(callback: CallbackQuery, state: FSMContext):
     state_data = await state.get_data()
-    timer_task = state_data.get('timer_task')
-    if timer_task: timer_task.cancel()
+    scheduler.cancel(f"quiz:{callback.message.chat.id}:{callback.from_user.id}")
 
     user_answer = callback.data.split(":", 2)[2]
     correct_answer = state_data.get('correct_answer')
@@ -569,7 +2149,7 @@ async def cb_process_quiz_answer(callback: CallbackQuery, state: FSMContext):
         
         if correct_answers < QUIZ_MAX_QUESTIONS:
             await callback.answer(f"✅ Правильно! +1 уровень. Следующий вопрос...", show_alert=False)
-            await send_next_question(callback.message, state)
+            await send_next_question(callback.message, state, callback.from_user.id)
         else:
             await update_user_field(callback.from_user.id, 'last_quiz', int(datetime.now().timestamp()))
             await callback.message.edit_text(f"🎉 <b>Поздравляем!</b>\n\nВы ответили правильно на все {QUIZ_MAX_QUESTIONS} вопроса. Ваш рекорд обновлен!\n\nСледующая викторина будет доступна через {QUIZ_SUCCESS_COOLDOWN_HOURS} часов.", parse_mode="HTML", reply_markup=None)
@@ -580,9 +2160,8 @@ async def cb_process_quiz_answer(callback: CallbackQuery, state: FSMContext):
         await state.clear()
 
 # --- СИСТЕМА ПИТОМЦЕВ ---
-@dp.message(or_f(Command("mypet", "мойпитомец"), F.text.lower().in_(['mypet', 'мойпитомец'])))
+@commands_router.message(CommandRoute("mypet"))
 async def cmd_mypet(message: Message):
-    await check_all_pets_death(message.from_user.id)
     pets = await get_pets(message.from_user.id)
     if not pets: return await message.reply("У вас пока нет питомцев. Приобрести яйцо можно в /eggshop")
     kb = InlineKeyboardBuilder()
@@ -595,7 +2174,6 @@ async def cmd_mypet(message: Message):
 async def cb_list_pets(callback: CallbackQuery):
     target_user_id = int(callback.data.split(":")[2])
     if callback.from_user.id != target_user_id: return await callback.answer("Это не ваш профиль!", show_alert=True)
-    await check_all_pets_death(target_user_id)
     pets = await get_pets(target_user_id)
     if not pets:
         await callback.answer("У вас пока нет питомцев.", show_alert=True)
@@ -635,7 +2213,7 @@ async def my_pet_profile_logic(user_id: int, pet: dict, message_or_callback: typ
     kb.row(types.InlineKeyboardButton(text="⬅️ К списку питомцев", callback_data=f"pet:list:{user_id}"))
     kb.adjust(2)
     image_url = "https://i.imgur.com/3TSa7A0.png"
-    species_data = next((s for r in PET_SPECIES.values() for s in r if s['species_name'] == pet_species), None)
+    species_data = PET_SPECIES_BY_NAME.get(pet_species)
     if species_data:
         for level_threshold, url in sorted(species_data['images'].items(), reverse=True):
             if pet_level >= level_threshold:
@@ -668,30 +2246,30 @@ async def cb_pet_action(callback: CallbackQuery):
     if not pet or pet['owner_id'] != callback.from_user.id:
         await callback.answer("Это не ваш питомец.", show_alert=True)
         return await callback.message.delete()
+    if action not in PET_ACTIONS_COST: return
     user = await get_user(callback.from_user.id)
-    cost = PET_ACTIONS_COST.get(action, 0)
+    cost = PET_ACTIONS_COST[action]
     if user.get('balance', 0) < cost: return await callback.answer(f"Недостаточно ящерок! Нужно {cost} 🦎.", show_alert=True)
-    now, updated, result_text = int(datetime.now().timestamp()), False, ""
+    now = int(datetime.now().timestamp())
+    if action == "grow" and now - (pet.get('last_grown', 0)) < 24 * 3600: return await callback.answer("Растить питомца можно только раз в день!", show_alert=True)
+    if action == "water" and pet['pet_level'] < 10: return await callback.answer("Эта функция доступна с 10 уровня питомца!", show_alert=True)
+    if action == "walk" and pet['pet_level'] < 15: return await callback.answer("Эта функция доступна с 15 уровня питомца!", show_alert=True)
+    if await wallet_debit(callback.from_user.id, cost, f"pet_{action}", pet_id) is None: return await callback.answer(f"Недостаточно ящерок! Нужно {cost} 🦎.", show_alert=True)
     if action == "grow":
-        if now - (pet.get('last_grown', 0)) < 24 * 3600: return await callback.answer("Растить питомца можно только раз в день!", show_alert=True)
         await db_execute("UPDATE pets SET pet_level = pet_level + 1, last_grown = $1 WHERE pet_id = $2", now, pet_id)
-        result_text, updated = f"Вы вырастили своего питомца! Его новый уровень: {pet['pet_level'] + 1}.", True
+        result_text = f"Вы вырастили своего питомца! Его новый уровень: {pet['pet_level'] + 1}."
     elif action == "feed":
         await update_pet_field(pet_id, "last_fed", now)
-        result_text, updated = "Вы покормили питомца.", True
+        result_text = "Вы покормили питомца."
     elif action == "water":
-        if pet['pet_level'] < 10: return await callback.answer("Эта функция доступна с 10 уровня питомца!", show_alert=True)
         await update_pet_field(pet_id, "last_watered", now)
-        result_text, updated = "Вы напоили питомца.", True
-    elif action == "walk":
-        if pet['pet_level'] < 15: return await callback.answer("Эта функция доступна с 15 уровня питомца!", show_alert=True)
+        result_text = "Вы напоили питомца."
+    else:
         await update_pet_field(pet_id, "last_walked", now)
-        result_text, updated = "Вы выгуляли питомца.", True
-    if updated:
-        await update_user_field(callback.from_user.id, "balance", user.get('balance', 0) - cost)
-        await callback.answer(result_text)
-        updated_pet_data = await get_single_pet(pet_id)
-        await my_pet_profile_logic(callback.from_user.id, updated_pet_data, callback)
+        result_text = "Вы выгуляли питомца."
+    await callback.answer(result_text)
+    updated_pet_data = await get_single_pet(pet_id)
+    await my_pet_profile_logic(callback.from_user.id, updated_pet_data, callback)
 
 @dp.callback_query(F.data.startswith("hatch_egg:"))
 async def cb_hatch_egg(callback: CallbackQuery, state: FSMContext):
@@ -711,7 +2289,7 @@ async def cb_hatch_egg(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("Отлично! Как вы назовете своего нового питомца? Введите имя (до 15 символов).")
     await callback.answer()
 
-@dp.message(PetHatchStates.waiting_for_name)
+@messages_router.message(PetHatchStates.waiting_for_name)
 async def process_pet_name_after_hatch(message: Message, state: FSMContext):
     pet_name = message.text
     if len(pet_name) > 15: return await message.answer("Имя слишком длинное. Попробуйте еще раз (до 15 символов).")
@@ -728,7 +2306,7 @@ async def process_pet_name_after_hatch(message: Message, state: FSMContext):
 
 # ... (Остальные системы без изменений, как в предыдущем ответе)
 
-@dp.message(or_f(Command("mypet", "мойпитомец"), F.text.lower().in_(['mypet', 'мойпитомец'])))
+@commands_router.message(CommandRoute("mypet"))
 async def cmd_mypet(message: Message):
     await my_pet_profile_logic(message.from_user.id, message)
 
@@ -770,7 +2348,7 @@ async def my_pet_profile_logic(user_id: int, pet: dict, message_or_callback: typ
 
     # 3. Получаем URL картинки (код без изменений)
     image_url = "https://i.imgur.com/3TSa7A0.png" # Запасная картинка
-    species_data = next((s for r in PET_SPECIES.values() for s in r if s['species_name'] == pet_species), None)
+    species_data = PET_SPECIES_BY_NAME.get(pet_species)
     if species_data:
         for level_threshold, url in sorted(species_data['images'].items(), reverse=True):
             if pet_level >= level_threshold:
@@ -823,11 +2401,8 @@ async def notify_admins_of_purchase(user_id: int, item_name: str, days: int, new
         notification_chat_ids = set(ADMIN_IDS)
         notification_chat_ids.add(target_group_id)
 
-        for chat_id in notification_chat_ids:
-            try:
-                await bot.send_message(chat_id, text, parse_mode="HTML")
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление о покупке в чат {chat_id}: {e}")
+        # Уведомления уходят через очередь: покупатель получает ответ, не дожидаясь отправки админам.
+        for chat_id in notification_chat_ids: outbox.send(chat_id, text, priority=OUTBOX_LOW, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Критическая ошибка в функции уведомления о покупке: {e}")
 
@@ -878,13 +2453,58 @@ async def cb_pet_action(callback: CallbackQuery):
     else:
         return
 
-    await update_user_field(user_id, "balance", user_balance - cost)
+    if await wallet_debit(user_id, cost, f"pet_{action}", pet['pet_id']) is None:
+        await callback.answer(f"Недостаточно ящерок! Нужно {cost} 🦎.", show_alert=True)
+        return
     await callback.answer(result_text, show_alert=False)
     await my_pet_profile_logic(user_id, callback, is_callback=True)
 
 # --- СИСТЕМА МАГАЗИНА ---
 SHOP_ITEMS = {"prefix": {"name": "Префикс", "prices": {1: 20, 3: 40, 7: 100}}, "antitar": {"name": "Антитар", "prices": {1: 30, 3: 60, 7: 130}}, "vip": {"name": "VIP", "prices": {1: 50, 3: 100, 7: 300}}}
-
+# Списание и продление подписки одним условным UPDATE; имена колонок берутся только из SHOP_ITEMS.
+SHOP_PURCHASE_QUERIES = {item_id: f"UPDATE users SET balance = balance - $1, {item_id}_end = GREATEST(COALESCE({item_id}_end, 0), $2) + $3 WHERE user_id = $4 AND balance >= $1 RETURNING *" for item_id in SHOP_ITEMS}
+SHOP_EXPIRE_QUERIES = {item_id: f"UPDATE users SET {item_id}_end = 0 WHERE {item_id}_end BETWEEN 1 AND $1 RETURNING user_id" for item_id in SHOP_ITEMS}
+
+# Истёкшие подписки обнуляются пакетно: раз в SUBSCRIPTION_SWEEP_INTERVAL секунд по одному UPDATE на вид
+# улучшения (по частичному индексу на *_end). Чтение ничего не пишет — прошедший срок просто считается неактивным.
+class SubscriptionExpirer(BackgroundFlusher):
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        self._hooks = []
+        self.expired = Counter()
+
+    def on_expired(self, func):
+        # Подписчики получают (user_id, item_id) для каждой истёкшей подписки; по умолчанию их нет, пользователям ничего не пишется.
+        self._hooks.append(func)
+        return func
+
+    async def flush(self):
+        if not db_pool: return
+        now = int(datetime.now().timestamp())
+        for item_id, query in SHOP_EXPIRE_QUERIES.items():
+            rows = await db_execute(query, now, fetch='all')
+            if rows is None:
+                self.errors += 1
+                logger.error(f"Не удалось обнулить истёкшие подписки {item_id}.")
+                continue
+            self.expired[item_id] += len(rows)
+            for row in rows:
+                user_cache.update_fields(row['user_id'], **{f"{item_id}_end": 0})
+                for hook in self._hooks:
+                    try: await hook(row['user_id'], item_id)
+                    except Exception as e: logger.error(f"Ошибка в обработчике окончания подписки {item_id} у {row['user_id']}: {e}")
+        self.flushes += 1
+
+subscription_expirer = SubscriptionExpirer(SUBSCRIPTION_SWEEP_INTERVAL_SECONDS)
+
+async def wallet_purchase(user_id: int, item_id: str, price: int, add_seconds: int):
+    row = await db_execute(SHOP_PURCHASE_QUERIES[item_id], price, int(datetime.now().timestamp()), add_seconds, user_id, fetch='one')
+    row = _wallet_commit(user_id, row)
+    if row: ledger.record(user_id, -price, "shop", f"{item_id}:{add_seconds // (24 * 3600)}d")
+    return row
+
+# Меню магазина не меняются во время работы: собираются при первом обращении (или при запуске) и дальше берутся из кэша.
+@lru_cache(maxsize=None)
 def create_shop_menu():
     kb = InlineKeyboardBuilder()
     for item_id, item_data in SHOP_ITEMS.items():
@@ -892,6 +2512,7 @@ def create_shop_menu():
     kb.adjust(1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def create_item_menu(item_id: str):
     kb = InlineKeyboardBuilder()
     item_data = SHOP_ITEMS[item_id]
@@ -901,7 +2522,7 @@ def create_item_menu(item_id: str):
     kb.adjust(1)
     return kb.as_markup()
 
-@dp.message(or_f(Command("shop", "магазин"), F.text.lower().in_(['shop', 'магазин'])))
+@commands_router.message(CommandRoute("shop"))
 async def cmd_shop(message: Message):
     await message.answer("🛒 Магазин: выберите предмет для покупки.", reply_markup=create_shop_menu())
 
@@ -941,15 +2562,10 @@ async def cb_buy_item(callback: CallbackQuery):
             await callback.answer(f"❌ У вас недостаточно 🦎 (у вас {user_balance}, требуется {price}).", show_alert=True)
             return
         
-        new_balance = user_balance - price
-        await update_user_field(user_id, "balance", new_balance)
-        
-        now_ts = int(datetime.now().timestamp())
-        add_seconds = days * 24 * 3600
-        field_name = f"{item_id}_end"
-        current_end = user[field_name] or 0
-        new_end = max(current_end, now_ts) + add_seconds
-        await update_user_field(user_id, field_name, new_end)
+        updated_user = await wallet_purchase(user_id, item_id, price, days * 24 * 3600)
+        if not updated_user:
+            return await callback.answer(f"❌ У вас недостаточно 🦎 (требуется {price}).", show_alert=True)
+        new_balance, new_end = updated_user["balance"], updated_user[f"{item_id}_end"]
 
         await notify_admins_of_purchase(
             user_id=user_id,
@@ -967,17 +2583,17 @@ async def cb_buy_item(callback: CallbackQuery):
         await callback.answer("Произошла ошибка при покупке.", show_alert=True)
 
 # --- СИСТЕМА ПОПОЛНЕНИЯ ЧЕРЕЗ TELEGRAM STARS ---
-@dp.message(or_f(Command("topup", "пополнить"), F.text.lower().in_(['topup', 'пополнить'])))
+@commands_router.message(CommandRoute("topup"))
 async def cmd_topup(message: Message, state: FSMContext):
     await message.answer("Введите количество ящерок, которое вы хотите купить.\n\n▫️ <b>Курс:</b> 3 ящерки = 1 ★\n▫️ <b>Лимиты:</b> от 20 до 10 000 ящерок за раз.\n▫️ Количество должно быть кратно 3.\n\nДля отмены просто напишите /cancel или отмена.", parse_mode="HTML")
     await state.set_state(TopupStates.waiting_for_amount)
 
-@dp.message(or_f(Command("cancel", "отмена"), F.text.lower().in_(['cancel', 'отмена'])), F.state == TopupStates.waiting_for_amount)
+@commands_router.message(CommandRoute("cancel"), F.state == TopupStates.waiting_for_amount)
 async def cancel_topup(message: Message, state: FSMContext):
     await message.answer("Действие отменено.")
     await state.clear()
 
-@dp.message(TopupStates.waiting_for_amount)
+@messages_router.message(TopupStates.waiting_for_amount)
 async def process_topup_amount(message: Message, state: FSMContext):
     try:
         lizards_to_buy = int(message.text)
@@ -997,7 +2613,7 @@ async def process_topup_amount(message: Message, state: FSMContext):
 async def pre_checkout_query_handler(pre_checkout_query: PreCheckoutQuery):
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
-@dp.message(F.successful_payment)
+@messages_router.message(F.successful_payment)
 async def successful_payment_handler(message: Message):
     try:
         payload = message.successful_payment.invoice_payload
@@ -1005,17 +2621,15 @@ async def successful_payment_handler(message: Message):
         user_id = int(user_id_str)
         lizards_to_add = int(lizards_str)
         await add_user(user_id, message.from_user.username or message.from_user.full_name)
-        user = await get_user(user_id)
-        current_balance = user['balance'] or 0
-        new_balance = current_balance + lizards_to_add
-        await update_user_field(user_id, 'balance', new_balance)
+        new_balance = await wallet_credit(user_id, lizards_to_add, "topup", message.successful_payment.telegram_payment_charge_id)
+        if new_balance is None: raise RuntimeError(f"не удалось начислить {lizards_to_add} ящерок пользователю {user_id}")
         await bot.send_message(chat_id=user_id, text=f"✅ Оплата прошла успешно!\n\nВам начислено: {lizards_to_add} 🦎\nВаш новый баланс: {new_balance} 🦎", parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in successful_payment_handler: {e}")
         await bot.send_message(chat_id=message.from_user.id, text="Произошла ошибка при начислении ящерок. Пожалуйста, свяжитесь с администратором.")
 
 # --- СИСТЕМА БРАКОВ ---
-@dp.message(or_f(Command("marry", "женить"), F.text.lower().in_(['marry', 'женить'])))
+@commands_router.message(CommandRoute("marry"))
 async def cmd_marry(message: Message):
     if message.chat.type == 'private':
         await message.answer("Эту команду нужно использовать в группе, отвечая на сообщение пользователя.")
@@ -1052,7 +2666,7 @@ async def cmd_marry(message: Message):
     target_mention = await get_user_display_name(target.id)
     await message.reply(f"Вы уверены, что хотите сделать предложение {target_mention}?\nСтоимость этого действия: {MARRIAGE_COST} 🦎.\n\nЭто действие нельзя будет отменить.", reply_markup=kb.as_markup(), parse_mode="HTML")
 
-@dp.message(or_f(Command("accept", "принять"), F.text.lower().in_(['accept', 'принять'])))
+@commands_router.message(CommandRoute("accept"))
 async def cmd_accept(message: Message):
     user_id = message.from_user.id
     await add_user(user_id, message.from_user.username or message.from_user.full_name)
@@ -1068,11 +2682,11 @@ async def cmd_accept(message: Message):
     await update_user_field(user_id, "partner_id", proposer_id)
     await update_user_field(proposer_id, "partner_id", user_id)
     await update_user_field(user_id, "proposal_from_id", 0)
-    user_mention = await get_user_display_name(user_id)
-    proposer_mention = await get_user_display_name(proposer_id)
+    mentions = await get_user_display_names([user_id, proposer_id])
+    user_mention, proposer_mention = mentions[user_id], mentions[proposer_id]
     await message.answer(f"💖 Поздравляем! {proposer_mention} и {user_mention} теперь официально состоят в отношениях! 💖", parse_mode="HTML")
 
-@dp.message(or_f(Command("divorce", "развод"), F.text.lower().in_(['divorce', 'развод'])))
+@commands_router.message(CommandRoute("divorce"))
 async def cmd_divorce(message: Message):
     user_id = message.from_user.id
     await add_user(user_id, message.from_user.username or message.from_user.full_name)
@@ -1103,11 +2717,12 @@ async def confirm_marry(callback: CallbackQuery):
         await callback.message.edit_text("❌ Упс! Этот пользователь уже получил предложение или вступил в отношения.")
         return await callback.answer()
     try:
-        new_balance = (proposer_data['balance'] or 0) - MARRIAGE_COST
-        await update_user_field(proposer_id, "balance", new_balance)
+        if await wallet_debit(proposer_id, MARRIAGE_COST, "marriage", target_id) is None:
+            await callback.message.edit_text(f"❌ Упс! На вашем счету больше недостаточно средств. Требуется {MARRIAGE_COST} 🦎.")
+            return await callback.answer()
         await update_user_field(target_id, "proposal_from_id", proposer_id)
-        proposer_mention = await get_user_display_name(proposer_id)
-        target_mention = await get_user_display_name(target_id)
+        mentions = await get_user_display_names([proposer_id, target_id])
+        proposer_mention, target_mention = mentions[proposer_id], mentions[target_id]
         await callback.message.edit_text("Предложение успешно отправлено!")
         await callback.message.answer(f"💍 {target_mention}, вам поступило предложение руки и сердца от {proposer_mention}!\n\nЧтобы принять его, напишите команду `/accept` или `принять`.", parse_mode="HTML")
         await callback.answer()
@@ -1131,8 +2746,8 @@ async def confirm_divorce(callback: CallbackQuery):
     partner_id = user_data['partner_id']
     await update_user_field(user_id, "partner_id", 0)
     await update_user_field(partner_id, "partner_id", 0)
-    user_mention = await get_user_display_name(user_id)
-    partner_mention = await get_user_display_name(partner_id)
+    mentions = await get_user_display_names([user_id, partner_id])
+    user_mention, partner_mention = mentions[user_id], mentions[partner_id]
     await callback.message.edit_text("Отношения разорваны.")
     await callback.message.answer(f"💔 {user_mention} и {partner_mention} больше не вместе. 💔", parse_mode="HTML")
     await callback.answer()
@@ -1147,17 +2762,107 @@ async def cancel_divorce(callback: CallbackQuery):
 
 # --- ПОЛНОСТЬЮ ЗАМЕНИТЕ ЭТУ ФУНКЦИЮ НА НОВУЮ ---
 
-@dp.message(or_f(Command("ping", "пинг"), F.text.lower().in_(['ping', 'пинг']), F.text.lower().startswith(('ping ', 'пинг '))))
-async def cmd_ping(message: Message):
+# --- СИСТЕМА ПИНГА ---
+# Недавняя активность по чатам с вытеснением по времени и по размеру, поэтому память не растёт вместе с числом групп.
+# В каждом чате: last_seen упорядочен по времени последнего сообщения (старые снимаются с начала), members — массив
+# для случайной выборки за O(k) с удалением за O(1) через positions, cooldowns — кто уже был упомянут, в порядке истечения.
+class ChatActivity:
+    __slots__ = ("last_seen", "members", "positions", "cooldowns")
+
+    def __init__(self):
+        self.last_seen = OrderedDict()
+        self.members = []
+        self.positions = {}
+        self.cooldowns = OrderedDict()
+
+class PingTracker:
+    def __init__(self, window: int, cooldown: int, max_users_per_chat: int, max_chats: int):
+        self.window, self.cooldown = window, cooldown
+        self.max_users_per_chat, self.max_chats = max_users_per_chat, max_chats
+        self._chats = OrderedDict()
+        self.expired_users = self.expired_chats = 0
+
+    def touch(self, chat_id: int, user_id: int, now: float = None):
+        now = now or time.time()
+        chat = self._chats.get(chat_id)
+        if chat is None: chat = self._chats[chat_id] = ChatActivity()
+        else: self._chats.move_to_end(chat_id)
+        if user_id in chat.last_seen: chat.last_seen.move_to_end(user_id)
+        else:
+            chat.positions[user_id] = len(chat.members)
+            chat.members.append(user_id)
+        chat.last_seen[user_id] = now
+        self._expire_users(chat, now)
+        self._expire_chats(now)
+
+    def _remove(self, chat: ChatActivity, user_id: int):
+        del chat.last_seen[user_id]
+        index, last = chat.positions.pop(user_id), chat.members.pop()
+        if last != user_id:
+            chat.members[index] = last
+            chat.positions[last] = index
+
+    def _expire_users(self, chat: ChatActivity, now: float):
+        deadline = now - self.window
+        while chat.last_seen:
+            user_id, seen = next(iter(chat.last_seen.items()))
+            if seen >= deadline and len(chat.last_seen) <= self.max_users_per_chat: break
+            self._remove(chat, user_id)
+            self.expired_users += 1
+        while chat.cooldowns and next(iter(chat.cooldowns.values())) <= now: chat.cooldowns.popitem(last=False)
+
+    def _expire_chats(self, now: float):
+        # Чаты упорядочены по последнему сообщению: у первого самое старое, дальше него смотреть незачем.
+        deadline = now - self.window
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and (chat.last_seen and next(reversed(chat.last_seen.values())) >= deadline): break
+            del self._chats[chat_id]
+            self.expired_chats += 1
+
+    def known(self, chat_id: int) -> bool: return bool(self._chats.get(chat_id) and self._chats[chat_id].last_seen)
+
+    def sample(self, chat_id: int, k: int, exclude=(), now: float = None) -> list:
+        # Случайные k активных пользователей не на кулдауне и не из exclude. Обычно хватает O(k) попыток;
+        # если почти все отсеиваются, выбираем из полного списка подходящих.
+        chat = self._chats.get(chat_id)
+        if chat is None: return []
+        self._expire_users(chat, now or time.time())
+        members = chat.members
+        def eligible(user_id): return user_id not in exclude and user_id not in chat.cooldowns
+        picked = []
+        for _ in range(min(len(members), 4 * k + 8)):
+            if len(picked) == k: return picked
+            user_id = members[random.randrange(len(members))]
+            if user_id not in picked and eligible(user_id): picked.append(user_id)
+        rest = [user_id for user_id in members if user_id not in picked and eligible(user_id)]
+        return picked + random.sample(rest, min(k - len(picked), len(rest)))
+
+    def cool_down(self, chat_id: int, user_ids, now: float = None):
+        chat = self._chats.get(chat_id)
+        if chat is None: return
+        until = (now or time.time()) + self.cooldown
+        for user_id in user_ids:
+            chat.cooldowns.pop(user_id, None)
+            chat.cooldowns[user_id] = until
+
+    def stats(self) -> dict:
+        return {"chats": len(self._chats), "users": sum(len(chat.last_seen) for chat in self._chats.values()), "cooldowns": sum(len(chat.cooldowns) for chat in self._chats.values()),
+                "expired_users": self.expired_users, "expired_chats": self.expired_chats}
+
+ping_tracker = PingTracker(PING_ACTIVITY_WINDOW_SECONDS, PING_COOLDOWN_SECONDS, PING_MAX_USERS_PER_CHAT, PING_MAX_CHATS)
+
+@commands_router.message(CommandRoute("ping"))
+async def cmd_ping(message: Message, command: CommandObject):
     if message.chat.type not in {'group', 'supergroup'}:
         return await message.reply("Эту команду можно использовать только в группах.")
 
     # --- НОВЫЙ БЛОК: Определение количества повторений ---
-    parts = message.text.split()
+    parts = (command.args or "").split()
     repeat_count = 1
-    if len(parts) > 1 and parts[1].isdigit():
+    if parts and parts[0].isdigit():
         # Пользователь указал, сколько раз пинговать, например "пинг 5"
-        repeat_count = int(parts[1])
+        repeat_count = int(parts[0])
     
     # Ограничение, чтобы избежать спама
     if repeat_count > 5:
@@ -1165,87 +2870,526 @@ async def cmd_ping(message: Message):
         await message.reply("Максимальное количество повторений пинга — 5 раз.", parse_mode="HTML")
     
     # --- НОВЫЙ БЛОК: Цикл для повторения пингов ---
-    for i in range(repeat_count):
-        chat_id = message.chat.id
-        pinger_id = message.from_user.id
-        now = int(datetime.now().timestamp())
-
-        if chat_id not in recent_users_activity:
-            # Если это первая итерация, отправляем ошибку. Если нет, просто выходим из цикла.
-            if i == 0:
-                await message.reply("Я еще не видел никого в этом чате, некого пинговать.")
-            break
-
-        # Получаем ВСЕХ пользователей, которых бот когда-либо видел в этом чате
-        all_known_users_in_chat = list(recent_users_activity.get(chat_id, {}).keys())
-
-        # Фильтруем пользователей: не админы, не сам пингующий, не на кулдауне в 5 минут
-        eligible_users = [
-            uid for uid in all_known_users_in_chat
-            if uid != pinger_id and uid not in ADMIN_IDS and (now - ping_cooldowns.get(uid, 0) > 300)
-        ]
+    chat_id = message.chat.id
+    pinger_id = message.from_user.id
+    if not ping_tracker.known(chat_id):
+        return await message.reply("Я еще не видел никого в этом чате, некого пинговать.")
+    excluded = {pinger_id, *ADMIN_IDS}
 
-        if not eligible_users:
+    for i in range(repeat_count):
+        # Активные за окно пользователи: не админы, не сам пингующий, не упомянутые в этом чате последние 5 минут
+        target_ids = ping_tracker.sample(chat_id, PING_TARGETS, excluded)
+        if not target_ids:
             if i == 0:
                 await message.reply("Сейчас нет доступных для пинга пользователей (все либо админы, либо недавно уже упоминались).")
             break # Выходим из цикла, если пинговать больше некого
 
-        # ИЗМЕНЕНО: Бот будет стараться выбрать 3 человека, если это возможно
-        k = min(len(eligible_users), 3)
-        if k == 0: # Еще одна проверка на случай, если все отфильтровались
-            if i == 0:
-                await message.reply("Не нашлось ни одного пользователя для пинга.")
-            break
-
-        target_ids = random.sample(eligible_users, k)
-
         try:
-            pinger_mention = await get_user_display_name(pinger_id)
+            mentions = await get_user_display_names([pinger_id, *target_ids])
+            pinger_mention = mentions[pinger_id]
             ping_text = random.choice(PING_MESSAGES)
-            target_mentions = [await get_user_display_name(uid) for uid in target_ids]
+            target_mentions = [mentions[uid] for uid in target_ids]
             
             # Обновляем время последнего пинга для выбранных пользователей
-            for uid in target_ids:
-                ping_cooldowns[uid] = now
-                
+            ping_tracker.cool_down(chat_id, target_ids)
+
             mentions_str = ", ".join(target_mentions)
-            await message.answer(f"📞 {pinger_mention} зовет {mentions_str}: «{html.escape(ping_text)}»", disable_notification=False, parse_mode="HTML")
+            # Пинги уходят через очередь исходящих: лимит чата лишь ограничивает отправку, темп задаёт пауза ниже.
+            outbox.send(chat_id, f"📞 {pinger_mention} зовет {mentions_str}: «{html.escape(ping_text)}»", message_thread_id=message.message_thread_id if message.is_topic_message else None, disable_notification=False, parse_mode="HTML")
         except Exception as e:
             logger.error(f"Error in ping command while getting user mentions: {e}")
             await message.reply("Не удалось выбрать пользователя для пинга.")
 
         # Добавляем небольшую задержку между пингами, если их несколько
-        if repeat_count > 1:
+        if i < repeat_count - 1:
             await asyncio.sleep(1.5)
 
-@dp.message(F.chat.type.in_({'group', 'supergroup'}))
+@messages_router.message(F.chat.type.in_({'group', 'supergroup'}))
 async def track_user_activity(message: Message):
     if message.from_user.is_bot:
         return
 
-    chat_id = message.chat.id
-    user_id = message.from_user.id
+    ping_tracker.touch(message.chat.id, message.from_user.id)
+
+
+# --- МЕТРИКИ ---
+# Внешний middleware считает апдейты по типам и одновременно обрабатываемые; внутренние (на message и callback_query)
+# знают, какой обработчик выбран, и пишут его время в гистограмму по (имя, исход). На апдейт — пара perf_counter и dict.
+class HandlerMetrics:
+    def __init__(self):
+        self.updates = Counter()
+        self.handlers = {}
+        self.in_flight = self.in_flight_max = 0
+
+    def observe(self, name: str, outcome: str, elapsed: float):
+        stat = self.handlers.get((name, outcome))
+        if stat is None: stat = self.handlers[(name, outcome)] = LatencyStat()
+        stat.observe(elapsed, outcome == "error")
+
+handler_metrics = HandlerMetrics()
+
+@dp.update.outer_middleware()
+async def track_updates(handler, event: types.Update, data: dict):
+    handler_metrics.updates[event.event_type] += 1
+    handler_metrics.in_flight += 1
+    if handler_metrics.in_flight > handler_metrics.in_flight_max: handler_metrics.in_flight_max = handler_metrics.in_flight
+    try: return await handler(event, data)
+    finally: handler_metrics.in_flight -= 1
+
+async def time_handler(handler, event, data: dict):
+    name, started = data["handler"].callback.__name__, time.perf_counter()
+    try: result = await handler(event, data)
+    except Exception:
+        handler_metrics.observe(name, "error", time.perf_counter() - started)
+        raise
+    handler_metrics.observe(name, "ok", time.perf_counter() - started)
+    return result
+
+dp.message.middleware(time_handler)
+dp.callback_query.middleware(time_handler)
+
+def _metric_labels(**labels) -> str:
+    if not labels: return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def _render_histogram(lines: list, name: str, series):
+    lines.append(f"# TYPE {name} histogram")
+    for labels, stat in series:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stat.buckets):
+            cumulative += count
+            lines.append(f"{name}_bucket{_metric_labels(**labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_bucket{_metric_labels(**labels, le='+Inf')} {stat.calls}")
+        lines.append(f"{name}_sum{_metric_labels(**labels)} {stat.total}")
+        lines.append(f"{name}_count{_metric_labels(**labels)} {stat.calls}")
+
+def render_metrics() -> str:
+    lines = []
+    def metric(name: str, kind: str, value, **labels):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{_metric_labels(**labels)} {value}")
+
+    lines.append("# TYPE bot_updates_total counter")
+    lines.extend(f"bot_updates_total{_metric_labels(type=update_type)} {count}" for update_type, count in handler_metrics.updates.items())
+    metric("bot_handlers_in_flight", "gauge", handler_metrics.in_flight)
+    metric("bot_handlers_in_flight_max", "gauge", handler_metrics.in_flight_max)
+    _render_histogram(lines, "bot_handler_duration_seconds", ((dict(handler=name, outcome=outcome), stat) for (name, outcome), stat in handler_metrics.handlers.items()))
+
+    _render_histogram(lines, "bot_db_query_duration_seconds", ((dict(statement=key[:200]), stat) for key, stat in query_stats.statements.items()))
+    lines.append("# TYPE bot_db_query_errors_total counter")
+    lines.extend(f"bot_db_query_errors_total{_metric_labels(statement=key[:200])} {stat.errors}" for key, stat in query_stats.statements.items() if stat.errors)
+    metric("bot_db_slow_queries_total", "counter", query_stats.slow)
+    metric("bot_db_pool_acquires_total", "counter", query_stats.acquires)
+    metric("bot_db_pool_wait_seconds_total", "counter", query_stats.wait_total)
+    metric("bot_db_pool_wait_seconds_max", "gauge", query_stats.wait_max)
+    metric("bot_db_pool_waiting", "gauge", query_stats.waiting)
+    metric("bot_db_pool_waiting_max", "gauge", query_stats.waiting_max)
+    metric("bot_db_pool_exhausted_total", "counter", query_stats.exhausted)
+    metric("bot_db_pool_acquire_timeouts_total", "counter", query_stats.acquire_timeouts)
+    if db_pool:
+        metric("bot_db_pool_size", "gauge", db_pool.get_size())
+        metric("bot_db_pool_idle", "gauge", db_pool.get_idle_size())
+        metric("bot_db_pool_max_size", "gauge", db_pool.get_max_size())
+
+    outbox_stats = outbox.stats()
+    metric("bot_outbox_queued", "gauge", outbox_stats['queued'])
+    metric("bot_outbox_deferred", "gauge", outbox_stats['deferred'])
+    metric("bot_outbox_in_flight", "gauge", outbox_stats['inflight'])
+    metric("bot_outbox_sent_total", "counter", outbox_stats['sent'])
+    metric("bot_outbox_failed_total", "counter", outbox_stats['failed'])
+    metric("bot_outbox_retried_total", "counter", outbox_stats['retried'])
+    metric("bot_outbox_throttled_total", "counter", outbox_stats['throttled'])
+
+    cache_stats = user_cache.stats()
+    metric("bot_user_cache_size", "gauge", cache_stats['size'])
+    metric("bot_user_cache_hits_total", "counter", cache_stats['hits'])
+    metric("bot_user_cache_misses_total", "counter", cache_stats['misses'])
+    metric("bot_ledger_pending", "gauge", ledger.stats()['pending'])
+    metric("bot_activity_pending", "gauge", activity_counter.stats()['pending'])
+    lines.append("# TYPE bot_scheduled_jobs gauge")
+    lines.extend(f"bot_scheduled_jobs{_metric_labels(kind=kind)} {count}" for kind, count in scheduler.stats()['by_kind'].items())
+    metric("bot_casino_active_spins", "gauge", casino_animator.stats()['active'])
+    if BOT_MODE == "webhook":
+        webhook_stats = webhook_server.stats()
+        metric("bot_webhook_queued", "gauge", webhook_stats['queued'])
+        lines.append("# TYPE bot_webhook_requests_total counter")
+        lines.extend(f"bot_webhook_requests_total{_metric_labels(result=result)} {webhook_stats[result]}" for result in ("accepted", "rejected", "unauthorized", "invalid"))
+    guard_stats = callback_guard.stats()
+    metric("bot_callbacks_deduplicated_total", "counter", guard_stats['dropped'])
+    metric("bot_callback_lock_waits_total", "counter", guard_stats['lock_waits'])
+    metric("bot_callback_locks_held", "gauge", guard_stats['locks'])
+    ping_stats = ping_tracker.stats()
+    metric("bot_ping_tracked_chats", "gauge", ping_stats['chats'])
+    metric("bot_ping_tracked_users", "gauge", ping_stats['users'])
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    if not port: return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+# --- ВЕБХУК ---
+# Запрос от Telegram только кладётся в ограниченную очередь и сразу получает 200, обработку ведут WEBHOOK_WORKERS задач.
+# Если очередь полна, отвечаем 503: Telegram повторит доставку позже, а бот не набирает бесконечный хвост в памяти.
+class WebhookServer:
+    def __init__(self, path: str, secret: str, queue_size: int, workers: int):
+        self.path, self.secret, self.workers = path, secret, workers
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self._runner = None
+        # Куда отдавать апдейты: по умолчанию прямо в диспетчер, в главном процессе — в очередь воркера.
+        self.sink = lambda update: dp.feed_update(bot, update)
+        self.accepted = self.rejected = self.unauthorized = self.invalid = self.failed = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            self.unauthorized += 1
+            return web.Response(status=401)
+        try: update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            self.invalid += 1
+            return web.Response(status=400)
+        try: self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        self.accepted += 1
+        return web.Response()
+
+    async def _work(self):
+        while True:
+            update = await self._queue.get()
+            try: await self.sink(update)
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Ошибка обработки апдейта {update.update_id} из вебхука: {e}")
+            finally: self._queue.task_done()
+
+    async def start(self, host: str, port: int):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Вебхук слушает http://{host}:{port}{self.path}")
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL + self.path, secret_token=self.secret or None, allowed_updates=dp.resolve_used_update_types(), max_connections=min(100, max(self.workers, 1)))
+            logger.info(f"Вебхук зарегистрирован в Telegram: {WEBHOOK_URL}{self.path}")
+
+    async def stop(self):
+        # Сначала перестаём принимать запросы, потом дорабатываем то, что уже в очереди.
+        if self._runner: await self._runner.cleanup()
+        try: await asyncio.wait_for(self._queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError: logger.warning(f"Вебхук: не успели обработать {self._queue.qsize()} апдейтов при остановке.")
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict: return {"queued": self._queue.qsize(), "accepted": self.accepted, "rejected": self.rejected, "unauthorized": self.unauthorized, "invalid": self.invalid, "failed": self.failed}
+
+webhook_server = WebhookServer(WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+
+# --- ВОРКЕРЫ ---
+def update_partition_key(update: types.Update) -> int:
+    # Ключ FSM — (чат, пользователь), поэтому делим по чату; у апдейтов без чата (inline, pre_checkout) — по пользователю.
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat: return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user else 0
+
+def worker_for(key: int) -> int: return key % WORKERS
+
+def owns_job(payload: dict) -> bool:
+    key = payload.get("chat_id", payload.get("user_id"))
+    return key is None or worker_for(key) == max(WORKER_INDEX, 0)
+
+class KeyedSequencer:
+    # Апдейты с одним ключом выполняются строго по очереди, с разными — параллельно.
+    def __init__(self):
+        self._tails = {}
+
+    def submit(self, key, factory):
+        task = asyncio.create_task(self._run(self._tails.get(key), factory))
+        self._tails[key] = task
+        task.add_done_callback(lambda done, key=key: self._tails.pop(key, None) if self._tails.get(key) is done else None)
+        return task
+
+    async def _run(self, previous, factory):
+        if previous: await asyncio.wait([previous])
+        try: await factory()
+        except Exception as e: logger.exception(f"Ошибка обработки апдейта: {e}")
+
+    async def drain(self):
+        while self._tails: await asyncio.wait(list(self._tails.values()))
+
+class WorkerPool:
+    # Главный процесс: запускает воркеров и раскладывает апдейты по их очередям. Полная очередь притормаживает приём.
+    def __init__(self, workers: int, queue_size: int):
+        self.workers, self.queue_size = workers, queue_size
+        self._context = multiprocessing.get_context("spawn")
+        self._queues, self._processes = [], []
+        self.dispatched = Counter()
+
+    def start(self):
+        for index in range(self.workers):
+            work_queue = self._context.Queue(maxsize=self.queue_size)
+            os.environ["WORKER_INDEX"] = str(index)
+            process = self._context.Process(target=worker_entry, args=(index, work_queue), name=f"bot-worker-{index}")
+            process.start()
+            self._queues.append(work_queue)
+            self._processes.append(process)
+        os.environ.pop("WORKER_INDEX", None)
+        logger.info(f"Запущено воркеров: {self.workers}")
+
+    async def dispatch(self, update: types.Update):
+        key = update_partition_key(update)
+        index = worker_for(key)
+        item = (key, update.model_dump_json(exclude_unset=True))
+        while True:
+            try:
+                self._queues[index].put_nowait(item)
+                break
+            except queue.Full: await asyncio.sleep(0.05)
+        self.dispatched[index] += 1
+
+    async def stop(self, timeout: float = 30):
+        for work_queue in self._queues:
+            try: work_queue.put(None, timeout=1)
+            except queue.Full: pass
+        for process in self._processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Воркер {process.name} не завершился за {timeout} с, останавливаем принудительно.")
+                process.terminate()
+
+async def poll_updates(sink):
+    # Long polling в главном процессе: апдейты не обрабатываются здесь, а передаются в sink.
+    offset, allowed_updates = None, dp.resolve_used_update_types()
+    await bot.delete_webhook()
+    while True:
+        try: updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await sink(update)
+            offset = update.update_id + 1
+
+class UserCacheListener:
+    # При нескольких процессах чужие изменения строк users приходят через NOTIFY users_changed и сбрасывают кэш.
+    # Свои изменения пропускаются: их строки уже записаны в кэш (write-through), сброс только вызвал бы лишнее чтение.
+    CHANNEL = 'users_changed'
+
+    def __init__(self):
+        self._connection = None
+        self.invalidations = self.own = 0
+
+    def _on_notify(self, connection, pid, channel, payload):
+        user_id, _, origin = payload.partition(":")
+        if origin == DB_APPLICATION_NAME:
+            self.own += 1
+            return
+        user_cache.invalidate(int(user_id))
+        self.invalidations += 1
 
-    if chat_id not in recent_users_activity:
-        recent_users_activity[chat_id] = {}
-    
-    recent_users_activity[chat_id][user_id] = int(datetime.now().timestamp())
+    async def start(self):
+        try:
+            self._connection = await asyncpg.connect(dsn=DATABASE_URL)
+            await self._connection.add_listener(self.CHANNEL, self._on_notify)
+        except Exception as e:
+            logger.error(f"Не удалось подписаться на изменения пользователей: {e}")
+            self._connection = None
+
+    async def stop(self):
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
 
+user_cache_listener = UserCacheListener()
 
 # --- ЗАПУСК БОТА ---
-async def main():
-    global db_pool
-    await create_pool()
-    await init_db()
-    await populate_questions()
-    
+# SIGTERM (docker stop, systemd) и SIGINT выставляют stop_requested: бот перестаёт принимать апдейты и штатно
+# останавливает сервисы, дописывая буферы (журнал баланса, активность, имена, планировщик). Так же останавливаются
+# главный процесс и воркеры при WORKERS > 1. В одном процессе в режиме polling сигналы перехватывает сам aiogram
+# и так же выходит из start_polling.
+stop_requested = asyncio.Event()
+
+def install_stop_handlers():
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try: loop.add_signal_handler(signum, stop_requested.set)
+        except NotImplementedError: pass
+
+# Запуск — несколько независимых цепочек, идущих одновременно: БД (подключение с повторами, миграции, затем параллельно
+# банк вопросов, задания планировщика и подписки LISTEN), проверка токена (getMe), сервер метрик и прогрев статических кэшей.
+# Приём апдейтов начинается сразу; апдейты, пришедшие раньше готовности сервисов, ждут её в wait_for_boot.
+class BootTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    async def run(self, name: str, awaitable):
+        started = time.perf_counter()
+        try: return await awaitable
+        finally: self.stages[name] = (started - self.started, time.perf_counter() - started)
+
+    def report(self, title: str = "Бот"):
+        stages = ", ".join(f"{name} {elapsed * 1000:.0f} мс (+{offset * 1000:.0f})" for name, (offset, elapsed) in sorted(self.stages.items(), key=lambda item: item[1][0]))
+        logger.info(f"{title} запущен за {time.perf_counter() - self.started:.2f} с. Этапы (длительность, +старт от начала): {stages}")
+
+boot_ready = asyncio.Event()
+
+@dp.update.outer_middleware()
+async def wait_for_boot(handler, update: types.Update, data: dict):
+    if not boot_ready.is_set(): await boot_ready.wait()
+    return await handler(update, data)
+
+async def warm_static_caches():
+    create_shop_menu()
+    for item_id in SHOP_ITEMS: create_item_menu(item_id)
+
+async def load_quiz_bank(timer: BootTimer, populate: bool):
+    if populate: await timer.run("quiz.populate", populate_questions())
+    await timer.run("quiz.load", quiz_bank.load())
+
+async def start_services(timer: BootTimer, primary: bool = True, migrate: bool = True):
+    # primary — процесс, в котором работают фоновые задачи на всю базу (уборщики); при WORKERS > 1 это воркер 0.
+    # migrate — готовить схему и стартовые данные; воркеры это пропускают, схему готовит главный процесс.
+    await timer.run("db.connect", create_pool())
+    if migrate: await timer.run("db.migrate", init_db())
+    steps = [load_quiz_bank(timer, populate=migrate), timer.run("quiz.listen", quiz_bank.start()), timer.run("scheduler.load", scheduler.load(owns_job if WORKERS > 1 else None))]
+    if WORKERS > 1: steps.append(timer.run("users.listen", user_cache_listener.start()))
+    await asyncio.gather(*steps)
+    scheduler.start()
+    if primary:
+        pet_sweeper.start()
+        subscription_expirer.start()
+    ledger.start()
+    activity_counter.start()
+    name_resolver.start()
+    outbox.start()
+    boot_ready.set()
+
+async def boot(timer: BootTimer, primary: bool = True, migrate: bool = True, metrics_port: int = METRICS_PORT):
+    # Возвращает runner сервера метрик. Если какой-то этап упал, уже поднятый сервер метрик гасится здесь же.
+    results = await asyncio.gather(timer.run("metrics", start_metrics_server(metrics_port)), timer.run("telegram", bot.me()),
+                                   timer.run("static", warm_static_caches()), start_services(timer, primary, migrate), return_exceptions=True)
+    metrics_runner = results[0] if not isinstance(results[0], BaseException) else None
+    failed = next((result for result in results if isinstance(result, BaseException)), None)
+    if failed:
+        if metrics_runner: await metrics_runner.cleanup()
+        raise failed
+    return metrics_runner
+
+async def stop_services(metrics_runner):
+    if metrics_runner: await metrics_runner.cleanup()
+    await subscription_expirer.stop()
+    await pet_sweeper.stop()
+    await scheduler.stop()
+    await quiz_bank.stop()
+    await user_cache_listener.stop()
+    await outbox.stop()
+    await name_resolver.stop()
+    await activity_counter.stop()
+    await ledger.stop()
+    if db_pool:
+        await db_pool.close()
+        logger.info("Соединение с БД закрыто.")
+    await bot.session.close()
+
+def worker_entry(index: int, work_queue):
+    try: asyncio.run(run_worker(index, work_queue))
+    except KeyboardInterrupt: pass
+
+async def run_worker(index: int, work_queue):
+    timer, metrics_runner = BootTimer(), None
+    sequencer, loop = KeyedSequencer(), asyncio.get_running_loop()
+    install_stop_handlers()
     try:
-        await dp.start_polling(bot)
+        metrics_runner = await boot(timer, primary=index == 0, migrate=False, metrics_port=METRICS_PORT + index if METRICS_PORT else 0)
+        timer.report(f"Воркер {index}")
+        while True:
+            # Ждём с таймаутом, чтобы поток исполнителя не зависал в get() при остановке.
+            # После сигнала остановки дорабатываем то, что уже лежит в очереди, и выходим, как только она опустеет.
+            try: item = await loop.run_in_executor(None, work_queue.get, True, 1)
+            except queue.Empty:
+                if stop_requested.is_set(): break
+                continue
+            if item is None: break
+            key, raw = item
+            update = types.Update.model_validate_json(raw, context={"bot": bot})
+            sequencer.submit(key, lambda update=update: dp.feed_update(bot, update))
+        await sequencer.drain()
     finally:
-        if db_pool:
-            await db_pool.close()
-            logger.info("Пул соединений с PostgreSQL закрыт.")
+        await stop_services(metrics_runner)
+
+async def run_master():
+    # Главный процесс готовит схему БД один раз, затем только принимает апдейты и раздаёт их воркерам.
+    timer = BootTimer()
+    try:
+        await timer.run("db.connect", create_pool())
+        await timer.run("db.migrate", init_db())
+        await timer.run("quiz.populate", populate_questions())
+    finally:
+        if db_pool: await db_pool.close()
+    timer.report("Главный процесс")
+    install_stop_handlers()
+    pool = WorkerPool(WORKERS, WORKER_QUEUE_SIZE)
+    pool.start()
+    polling = None
+    try:
+        if BOT_MODE == "webhook":
+            webhook_server.sink = pool.dispatch
+            await webhook_server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        else: polling = asyncio.create_task(poll_updates(pool.dispatch))
+        await stop_requested.wait()
+        logger.info("Получен сигнал остановки.")
+    finally:
+        if polling:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+        if BOT_MODE == "webhook": await webhook_server.stop()
+        await pool.stop()
         await bot.session.close()
 
+async def receive_updates():
+    if BOT_MODE == "webhook":
+        install_stop_handlers()
+        await webhook_server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        await stop_requested.wait()
+        logger.info("Получен сигнал остановки.")
+    else: await dp.start_polling(bot, close_bot_session=False)
+
+async def main():
+    if WORKERS > 1: return await run_master()
+    timer, metrics_runner = BootTimer(), None
+    # Первый getUpdates (или приём вебхука) идёт параллельно с запуском, апдейты ждут в wait_for_boot.
+    receiving = asyncio.create_task(receive_updates())
+    try:
+        metrics_runner = await boot(timer)
+        timer.report()
+        await receiving
+    finally:
+        receiving.cancel()
+        try: await receiving
+        except (asyncio.CancelledError, Exception): pass
+        if BOT_MODE == "webhook": await webhook_server.stop()
+        await stop_services(metrics_runner)
+
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""Перенос пользователей из старых SQLite-файлов эпохи database.py (main.db, bot.db, ...) в базу бота из DB_URL.
+
+Строки читаются курсором пачками по --chunk (чтение следующей пачки идёт в потоке параллельно с записью текущей),
+грузятся через copy_records_to_table во временную таблицу и затем сливаются с users одним INSERT ... ON CONFLICT:
+- баланс, уровень, отметки времени и сроки улучшений — максимум из всех источников и того, что уже есть в БД,
+  поэтому повторный запуск ничего не меняет;
+- имя пользователя и партнёр — из БД, если там они уже заданы;
+- флаги старой схемы (prefix, has_vip, has_antitar) бессрочными не были предусмотрены новой схемой и превращаются
+  в срок улучшения: сейчас + --grant-days дней, но только если у пользователя в БД этого улучшения нет (срок 0).
+  Поэтому повторный запуск уже выданные сроки не продлевает; выдаст заново только истёкший и обнулённый.
+  Текст старого префикса некуда положить, он не переносится.
+Прирост баланса записывается в balance_ledger с причиной migration, чтобы /reconcile не показывал расхождений.
+Всё выполняется в одной транзакции. Бот лучше остановить: его кэш пользователей увидит новые балансы только через USER_CACHE_TTL.
+
+Запуск: DB_URL=... python migrate_legacy.py [файлы...] [--chunk 5000] [--grant-days 30]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "1:migrate")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import main
+
+DEFAULT_FILES = ["main.db", "bot.db", "bot_database.db", "bot_db.sqlite3"]
+# Колонки users, которые бывают в старых файлах, в порядке колонок временной таблицы.
+COLUMNS = ["user_id", "username", "balance", "level", "last_hunt", "last_quiz", "partner_id", "proposal_from_id", "prefix_end", "antitar_end", "vip_end"]
+# Флаги старой схемы, из которых получается срок улучшения, если самой колонки *_end в файле нет.
+# Выданный по флагу срок хранится во временной таблице отдельно (*_grant), чтобы при слиянии не продлевать уже имеющийся.
+LEGACY_FLAGS = {"prefix_end": ("prefix", "prefix IS NOT NULL"), "antitar_end": ("has_antitar", "has_antitar"), "vip_end": ("has_vip", "has_vip")}
+GRANTS = [column.replace("_end", "_grant") for column in LEGACY_FLAGS]
+
+STAGING = "legacy_users"
+CREATE_STAGING = f"CREATE TEMP TABLE {STAGING} (user_id BIGINT NOT NULL, username TEXT, balance BIGINT, level INTEGER, last_hunt BIGINT, last_quiz BIGINT, partner_id BIGINT, proposal_from_id BIGINT, prefix_end BIGINT, antitar_end BIGINT, vip_end BIGINT, prefix_grant BIGINT, antitar_grant BIGINT, vip_grant BIGINT)"
+# Пользователь мог оказаться в нескольких файлах — сначала сводим его строки в одну. Срок по флагу берётся,
+# только если у пользователя в БД такого улучшения нет. WHERE TRUE нужен SQLite: без него ON CONFLICT после JOIN неоднозначен.
+GRANTED = ", ".join(f"GREATEST(m.{column}, CASE WHEN COALESCE(u.{column}, 0) = 0 THEN m.{grant} ELSE 0 END) AS {column}" for column, grant in zip(LEGACY_FLAGS, GRANTS))
+MERGED = f"""SELECT m.user_id, m.username, m.balance, m.level, m.last_hunt, m.last_quiz, m.partner_id, m.proposal_from_id, {GRANTED} FROM (
+    SELECT user_id, MAX(username) AS username, COALESCE(MAX(balance), 0) AS balance, COALESCE(MAX(level), 0) AS level,
+    COALESCE(MAX(last_hunt), 0) AS last_hunt, COALESCE(MAX(last_quiz), 0) AS last_quiz, COALESCE(MAX(partner_id), 0) AS partner_id,
+    COALESCE(MAX(proposal_from_id), 0) AS proposal_from_id, COALESCE(MAX(prefix_end), 0) AS prefix_end,
+    COALESCE(MAX(antitar_end), 0) AS antitar_end, COALESCE(MAX(vip_end), 0) AS vip_end, COALESCE(MAX(prefix_grant), 0) AS prefix_grant,
+    COALESCE(MAX(antitar_grant), 0) AS antitar_grant, COALESCE(MAX(vip_grant), 0) AS vip_grant FROM {STAGING} GROUP BY user_id
+    ) m LEFT JOIN users u ON u.user_id = m.user_id WHERE TRUE"""
+LEDGER_QUERY = f"""INSERT INTO balance_ledger (user_id, delta, reason, ref, ts)
+    SELECT m.user_id, m.balance - COALESCE(u.balance, 0), 'migration', 'legacy', $1 FROM ({MERGED}) m LEFT JOIN users u ON u.user_id = m.user_id
+    WHERE m.balance > COALESCE(u.balance, 0)"""
+EXISTING_QUERY = f"SELECT COUNT(*) FROM users WHERE user_id IN (SELECT user_id FROM {STAGING})"
+MERGE_QUERY = f"""INSERT INTO users ({', '.join(COLUMNS)}) {MERGED}
+    ON CONFLICT (user_id) DO UPDATE SET username = COALESCE(users.username, EXCLUDED.username),
+        balance = GREATEST(COALESCE(users.balance, 0), EXCLUDED.balance), level = GREATEST(COALESCE(users.level, 0), EXCLUDED.level),
+        last_hunt = GREATEST(COALESCE(users.last_hunt, 0), EXCLUDED.last_hunt), last_quiz = GREATEST(COALESCE(users.last_quiz, 0), EXCLUDED.last_quiz),
+        partner_id = CASE WHEN COALESCE(users.partner_id, 0) <> 0 THEN users.partner_id ELSE EXCLUDED.partner_id END,
+        proposal_from_id = CASE WHEN COALESCE(users.proposal_from_id, 0) <> 0 THEN users.proposal_from_id ELSE EXCLUDED.proposal_from_id END,
+        prefix_end = GREATEST(COALESCE(users.prefix_end, 0), EXCLUDED.prefix_end), antitar_end = GREATEST(COALESCE(users.antitar_end, 0), EXCLUDED.antitar_end),
+        vip_end = GREATEST(COALESCE(users.vip_end, 0), EXCLUDED.vip_end)"""
+
+
+def legacy_select(source: sqlite3.Connection, grant_end: int):
+    # SELECT по старой таблице users в порядке COLUMNS + GRANTS: чего в файле нет — NULL, флаги — срок grant_end в *_grant.
+    present = {row[1] for row in source.execute("PRAGMA table_info(users)")}
+    if "user_id" not in present: return None
+    expressions = []
+    for column in COLUMNS:
+        if column in present: expressions.append(f"CAST({column} AS TEXT)" if column == "username" else f"CAST({column} AS INTEGER)")
+        else: expressions.append("NULL")
+    for column, (flag, condition) in LEGACY_FLAGS.items():
+        expressions.append(f"CASE WHEN {condition} THEN {grant_end} END" if column not in present and flag in present else "NULL")
+    return f"SELECT {', '.join(expressions)} FROM users WHERE user_id IS NOT NULL"
+
+
+async def stage_file(connection, path: str, grant_end: int, chunk: int) -> int:
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        query = legacy_select(source, grant_end)
+        if query is None:
+            print(f"{path}: нет таблицы users, пропущен")
+            return 0
+        cursor, rows, started = source.execute(query), 0, time.perf_counter()
+        pending = asyncio.create_task(asyncio.to_thread(cursor.fetchmany, chunk))
+        while batch := await pending:
+            pending = asyncio.create_task(asyncio.to_thread(cursor.fetchmany, chunk))
+            await connection.copy_records_to_table(STAGING, records=batch, columns=COLUMNS + GRANTS)
+            rows += len(batch)
+        elapsed = time.perf_counter() - started
+        print(f"{path}: {rows} строк за {elapsed:.2f} с ({rows / elapsed if elapsed else 0:.0f} строк/с)")
+        return rows
+    finally: source.close()
+
+
+async def migrate(files: list, chunk: int, grant_days: int):
+    await main.create_pool()
+    await main.init_db()
+    grant_end = int(datetime.now().timestamp()) + grant_days * 24 * 3600
+    started = time.perf_counter()
+    async with main.db_pool.acquire() as connection:
+        async with connection.transaction():
+            await connection.execute(CREATE_STAGING)
+            staged = 0
+            for path in files: staged += await stage_file(connection, path, grant_end, chunk)
+            merge_started = time.perf_counter()
+            users = await connection.fetchval(f"SELECT COUNT(DISTINCT user_id) FROM {STAGING}")
+            existing = await connection.fetchval(EXISTING_QUERY)
+            ledger_status = await connection.execute(LEDGER_QUERY, int(time.time()))
+            await connection.execute(MERGE_QUERY)
+            await connection.execute(f"DROP TABLE {STAGING}")
+    elapsed, merge_elapsed = time.perf_counter() - started, time.perf_counter() - merge_started
+    print(f"Итого: {staged} строк из {len(files)} файлов, {users} пользователей ({users - existing} новых, {existing} слито с существующими), "
+          f"записей в журнал баланса: {ledger_status.rsplit(' ', 1)[-1]}")
+    print(f"Время: {elapsed:.2f} с, из них слияние {merge_elapsed:.2f} с — {staged / elapsed if elapsed else 0:.0f} строк/с")
+    await main.db_pool.close()
+    await main.bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос пользователей из старых SQLite-файлов в базу бота (DB_URL).")
+    parser.add_argument("files", nargs="*", help="SQLite-файлы; по умолчанию существующие из " + ", ".join(DEFAULT_FILES))
+    parser.add_argument("--chunk", type=int, default=5000, help="строк в одной пачке COPY")
+    parser.add_argument("--grant-days", type=int, default=30, help="на сколько дней выдать улучшения по флагам prefix/has_vip/has_antitar")
+    args = parser.parse_args()
+    files = args.files or [path for path in DEFAULT_FILES if os.path.exists(path)]
+    missing = [path for path in files if not os.path.exists(path)]
+    if missing: sys.exit(f"Файлы не найдены: {', '.join(missing)}")
+    asyncio.run(migrate(files, args.chunk, args.grant_days))
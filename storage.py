@@ -0,0 +1,246 @@
+"""Хранилище бота: один интерфейс соединения поверх PostgreSQL (asyncpg) и SQLite (aiosqlite).
+
+Код бота пишет запросы один раз, в диалекте PostgreSQL ($1, ::cast, = ANY($1), GREATEST, date_trunc),
+а SqliteBackend переводит их в SQLite на лету (translate_sql). Соединение из acquire() в обоих бэкендах
+ведёт себя как соединение asyncpg: execute/fetch/fetchrow/fetchval/executemany/copy_records_to_table/transaction.
+Если свободного соединения нет дольше acquire_timeout секунд, acquire() бросает asyncio.TimeoutError, а не ждёт вечно.
+
+SQLite-бэкенд не блокирует цикл событий: запросы выполняются в потоке aiosqlite. База открывается в режиме WAL
+с synchronous=NORMAL, а записи группируются: одна транзакция накапливает изменения и фиксируется раз в
+commit_interval секунд или после commit_max_writes операторов, вместо COMMIT после каждого запроса.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(ABC):
+    # dialect — "postgres" или "sqlite": по нему вызывающий код выбирает запрос там, где один текст невозможен.
+    dialect = None
+
+    @abstractmethod
+    def acquire(self, timeout: float = None): ...
+    @abstractmethod
+    async def close(self): ...
+    @abstractmethod
+    def get_size(self) -> int: ...
+    @abstractmethod
+    def get_idle_size(self) -> int: ...
+    @abstractmethod
+    def get_max_size(self) -> int: ...
+
+
+# --- POSTGRESQL ---
+class PostgresBackend(Backend):
+    dialect = "postgres"
+
+    def __init__(self, pool, acquire_timeout: float = None):
+        self._pool = pool
+        self.acquire_timeout = acquire_timeout
+
+    @classmethod
+    async def connect(cls, dsn: str, acquire_timeout: float = None, **pool_options):
+        import asyncpg
+        return cls(await asyncpg.create_pool(dsn=dsn, **pool_options), acquire_timeout)
+
+    def acquire(self, timeout: float = None): return self._pool.acquire(timeout=timeout or self.acquire_timeout)
+    async def close(self): await self._pool.close()
+    def get_size(self) -> int: return self._pool.get_size()
+    def get_idle_size(self) -> int: return self._pool.get_idle_size()
+    def get_max_size(self) -> int: return self._pool.get_max_size()
+
+
+# --- SQLITE ---
+# Порядок важен: date_trunc(...)::date переводится раньше, чем убираются приведения типов.
+_SQLITE_REWRITES = (
+    (re.compile(r"date_trunc\('week', (\w+)\)::date"), r"date(\1, '-6 days', 'weekday 1')"),
+    (re.compile(r"date_trunc\('month', (\w+)\)::date"), r"date(\1, 'start of month')"),
+    (re.compile(r"= ANY\(\$(\d+)(?:::[a-z ]+\[\])?\)"), r"IN (SELECT value FROM json_each(?\1))"),
+    (re.compile(r"::(?:double precision|[a-z]+)(?:\[\])?"), ""),
+    (re.compile(r"\$(\d+)"), r"?\1"),
+    (re.compile(r"\bGREATEST\("), "MAX("),
+    (re.compile(r"\bLEAST\("), "MIN("),
+    (re.compile(r"\bIS DISTINCT FROM\b"), "IS NOT"),
+    (re.compile(r"\b(?:BIG)?SERIAL PRIMARY KEY\b"), "INTEGER PRIMARY KEY"),
+    (re.compile(r"\bJSONB\b"), "TEXT"),
+)
+_STATUS_VERBS = ("INSERT", "UPDATE", "DELETE")
+
+
+@lru_cache(maxsize=2048)
+def translate_sql(query: str) -> str:
+    for pattern, replacement in _SQLITE_REWRITES: query = pattern.sub(replacement, query)
+    return query
+
+
+def _adapt(value):
+    # Массивы параметров (для = ANY) и JSON передаются строкой JSON, даты — в ISO, как их хранит SQLite.
+    if isinstance(value, (list, tuple, dict)): return json.dumps(value, ensure_ascii=False, default=_adapt)
+    if isinstance(value, date) and not isinstance(value, datetime): return value.isoformat()
+    return value
+
+
+class Record(dict):
+    # Строка результата: доступ по имени колонки, как у asyncpg.Record, и по номеру (row[0]).
+    def __getitem__(self, key):
+        if isinstance(key, int): return list(self.values())[key]
+        return super().__getitem__(key)
+
+
+def _record_factory(cursor, row): return Record(zip([column[0] for column in cursor.description], row))
+
+
+class SqliteConnection:
+    def __init__(self, backend: "SqliteBackend"):
+        self._backend = backend
+        self._db = backend._db
+        self._savepoints = 0
+
+    async def _run(self, query: str, args):
+        await self._backend._begin()
+        return await self._db.execute(translate_sql(query), [_adapt(arg) for arg in args])
+
+    async def execute(self, query: str, *args) -> str:
+        async with await self._run(query, args) as cursor: rowcount = cursor.rowcount
+        verb = query.lstrip().split(None, 1)[0].upper()
+        if verb not in _STATUS_VERBS: return verb
+        self._backend._wrote(1)
+        return f"INSERT 0 {rowcount}" if verb == "INSERT" else f"{verb} {rowcount}"
+
+    async def fetch(self, query: str, *args) -> list:
+        async with await self._run(query, args) as cursor: rows = await cursor.fetchall()
+        if not query.lstrip().upper().startswith("SELECT"): self._backend._wrote(1)
+        return rows
+
+    async def fetchrow(self, query: str, *args):
+        rows = await self.fetch(query, *args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query: str, *args):
+        row = await self.fetchrow(query, *args)
+        return row[0] if row else None
+
+    async def executemany(self, query: str, args):
+        rows = [[_adapt(arg) for arg in params] for params in args]
+        await self._backend._begin()
+        await self._db.executemany(translate_sql(query), rows)
+        self._backend._wrote(len(rows))
+
+    async def copy_records_to_table(self, table_name: str, *, records, columns) -> str:
+        # В SQLite нет COPY: та же пачка вставляется одним executemany внутри текущей групповой транзакции.
+        records = list(records)
+        placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+        await self.executemany(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", records)
+        return f"COPY {len(records)}"
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Групповая транзакция уже открыта, поэтому блок — точка сохранения: при ошибке откатывается только он.
+        await self._backend._begin()
+        self._savepoints += 1
+        name = f"sp_{self._savepoints}"
+        await self._db.execute(f"SAVEPOINT {name}")
+        try: yield
+        except BaseException:
+            await self._db.execute(f"ROLLBACK TO {name}")
+            await self._db.execute(f"RELEASE {name}")
+            raise
+        else: await self._db.execute(f"RELEASE {name}")
+        finally: self._savepoints -= 1
+
+
+class SqliteBackend(Backend):
+    # Одно соединение на процесс: SQLite всё равно допускает только одного писателя, а очередь за asyncio.Lock
+    # дешевле, чем ожидание блокировки файла. Работать с одной базой может только один процесс бота.
+    dialect = "sqlite"
+
+    def __init__(self, path: str, commit_interval: float = 0.05, commit_max_writes: int = 1000, acquire_timeout: float = None):
+        self.path = path
+        self.acquire_timeout = acquire_timeout
+        self.commit_interval, self.commit_max_writes = commit_interval, commit_max_writes
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._pending = 0
+        self._opened_at = 0.0
+        self._committer = None
+        self.commits = self.writes = 0
+
+    @classmethod
+    async def connect(cls, path: str, **options):
+        import aiosqlite
+        backend = cls(path, **options)
+        backend._db = await aiosqlite.connect(path, isolation_level=None)
+        backend._db.row_factory = _record_factory
+        for pragma in ("journal_mode = WAL", "synchronous = NORMAL", "busy_timeout = 5000"):
+            await backend._db.execute(f"PRAGMA {pragma}")
+        backend._committer = asyncio.create_task(backend._commit_loop())
+        return backend
+
+    async def _begin(self):
+        if not self._db.in_transaction:
+            await self._db.execute("BEGIN")
+            self._opened_at = time.monotonic()
+
+    def _wrote(self, count: int):
+        self._pending += count
+        self.writes += count
+
+    def _commit_due(self) -> bool:
+        return self._pending >= self.commit_max_writes or (self._pending and time.monotonic() - self._opened_at >= self.commit_interval)
+
+    async def _commit(self):
+        if not self._db.in_transaction: return
+        await self._db.execute("COMMIT")
+        if self._pending: self.commits += 1
+        self._pending = 0
+
+    async def _commit_loop(self):
+        # Под нагрузкой коммитит тот, кто отпускает соединение (_acquire); цикл нужен для затишья после последней записи.
+        while True:
+            await asyncio.sleep(max(self.commit_interval, 0.01))
+            if self._lock.locked() or not self._db.in_transaction: continue
+            try:
+                async with self._lock: await self._commit()
+            except Exception as e: logger.error(f"SQLite: не удалось зафиксировать транзакцию: {e}")
+
+    @asynccontextmanager
+    async def _acquire(self, timeout: float):
+        await asyncio.wait_for(self._lock.acquire(), timeout)
+        try: yield SqliteConnection(self)
+        finally:
+            try:
+                if self._commit_due(): await self._commit()
+            finally: self._lock.release()
+
+    def acquire(self, timeout: float = None): return self._acquire(timeout or self.acquire_timeout)
+
+    async def close(self):
+        if self._committer:
+            self._committer.cancel()
+            try: await self._committer
+            except asyncio.CancelledError: pass
+            self._committer = None
+        async with self._lock:
+            await self._commit()
+            await self._db.close()
+
+    def get_size(self) -> int: return 1
+    def get_idle_size(self) -> int: return 0 if self._lock.locked() else 1
+    def get_max_size(self) -> int: return 1
+
+    def stats(self) -> dict: return {"writes": self.writes, "commits": self.commits, "pending": self._pending}
+
+
+def sqlite_path(url: str):
+    # sqlite:///abs/path.db, sqlite:relative.db или sqlite::memory: — путь к файлу; для остальных адресов None.
+    if not url.startswith("sqlite:"): return None
+    path = url[len("sqlite:"):]
+    return path[2:] if path.startswith("//") else path
@@ -0,0 +1,9 @@
+"""Общая подготовка тестов: корень репозитория в sys.path и минимальное окружение, без которого main.py не импортируется."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("DB_URL", "sqlite:///:memory:")
+os.environ.setdefault("METRICS_PORT", "0")
@@ -0,0 +1,97 @@
+"""Защита колбэков: однократный захват игровых сообщений, окно отбрасывания повторных нажатий и блокировки по ключам."""
+import asyncio
+
+import main
+
+
+def test_consume_once_and_restore():
+    guard = main.CallbackGuard(1.0)
+    assert guard.consume((-100, 7))
+    assert not guard.consume((-100, 7))
+    assert guard.consume((-100, 8))
+    guard.restore((-100, 7))
+    assert guard.consume((-100, 7))
+    guard.restore((-100, 999))  # неизвестное сообщение — ничего не делает
+    assert guard.stats()["consumed"] == 2
+
+
+def test_consume_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(main.CallbackGuard, "CONSUMED_SIZE", 3)
+    guard = main.CallbackGuard(1.0)
+    for message_id in range(4): assert guard.consume((1, message_id))
+    assert guard.stats()["consumed"] == 3
+    # Самое старое сообщение вытеснено и снова может быть захвачено, остальные — нет.
+    assert guard.consume((1, 0))
+    assert not guard.consume((1, 3))
+
+
+def test_claim_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    guard = main.CallbackGuard(2.0)
+    key = (1, (-100, 7), "casino_play:red:10:1")
+    assert guard.claim(key)
+    assert not guard.claim(key)  # ещё выполняется
+    guard.release(key)
+    now[0] += 1.0
+    assert not guard.claim(key)  # в окне после завершения
+    assert guard.claim((2, (-100, 7), "casino_play:red:10:1"))  # другой пользователь
+    now[0] += 1.5
+    assert guard.claim(key)
+    # Истёкшие записи вычищаются при следующем claim.
+    guard.release(key)
+    guard.release((2, (-100, 7), "casino_play:red:10:1"))
+    now[0] += 10
+    assert guard.claim(("other",))
+    assert guard.stats()["tracked"] == 1
+
+
+def test_keyed_locks_serialize_and_release_early():
+    async def scenario():
+        locks = main.KeyedLocks()
+        order = []
+        first_released = asyncio.Event()
+
+        async def first():
+            async with locks.hold(("user", 1), ("message", 7)) as release:
+                order.append("first:start")
+                await asyncio.sleep(0.01)
+                release()
+                first_released.set()
+                await asyncio.sleep(0.05)
+                order.append("first:end")
+
+        async def second():
+            await asyncio.sleep(0)
+            async with locks.hold(("message", 7)):
+                order.append("second")
+
+        async def unrelated():
+            await asyncio.sleep(0)
+            async with locks.hold(("user", 2)):
+                order.append("unrelated")
+
+        await asyncio.gather(first(), second(), unrelated())
+        assert order.index("unrelated") < order.index("second")
+        # Второй обработчик входит сразу после release(), не дожидаясь конца первого.
+        assert order.index("second") < order.index("first:end")
+        assert locks.waits == 1
+        assert len(locks) == 0
+
+    asyncio.run(scenario())
+
+
+def test_keyed_locks_same_order_no_deadlock():
+    async def scenario():
+        locks = main.KeyedLocks()
+        done = []
+
+        async def worker(name, *keys):
+            async with locks.hold(*keys):
+                await asyncio.sleep(0.01)
+                done.append(name)
+
+        await asyncio.wait_for(asyncio.gather(worker("a", "x", "y"), worker("b", "y", "x")), timeout=1)
+        assert sorted(done) == ["a", "b"] and len(locks) == 0
+
+    asyncio.run(scenario())
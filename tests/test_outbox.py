@@ -0,0 +1,105 @@
+"""Очередь исходящих: token bucket, повтор после RetryAfter с паузой чата и отправка в другие чаты, пока один занят."""
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+
+
+class Clock:
+    def __init__(self): self.now = 1000.0
+    def __call__(self): return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_rate_and_capacity(clock):
+    bucket = main.TokenBucket(rate=2, capacity=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0
+    # Простой не копит больше capacity.
+    clock.now += 100
+    assert [bucket.try_acquire() for _ in range(4)][-1] > 0
+    assert bucket.idle() is False
+    clock.now += 2
+    assert bucket.idle() is True
+
+
+def test_token_bucket_reserve(clock):
+    bucket = main.TokenBucket(rate=1, capacity=4)
+    # С резервом 2 берутся только два токена из четырёх, остальные остаются обычным вызовам.
+    assert [bucket.try_acquire(2) for _ in range(3)][:2] == [0, 0]
+    assert bucket.try_acquire(2) == pytest.approx(1.0)
+    assert bucket.try_acquire() == 0 and bucket.try_acquire() == 0
+
+
+def test_token_bucket_pause(clock):
+    bucket = main.TokenBucket(rate=10, capacity=10)
+    bucket.pause(5)
+    assert bucket.try_acquire() == pytest.approx(5)
+    bucket.pause(1)  # более короткая пауза не сокращает уже объявленную
+    clock.now += 5
+    assert bucket.try_acquire() == 0
+
+
+class FakeBot:
+    def __init__(self, retry_after: dict):
+        self.retry_after = retry_after  # chat_id -> сколько раз ответить RetryAfter
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.retry_after.get(chat_id, 0) > 0:
+            self.retry_after[chat_id] -= 1
+            raise TelegramRetryAfter(method=SendMessage(chat_id=chat_id, text=text), message="Too Many Requests", retry_after=0.05)
+        self.sent.append((chat_id, text))
+        return (chat_id, text)
+
+
+def run_outbox(fake_bot, monkeypatch, sends):
+    # Личный чат: один токен, но быстрое пополнение, чтобы повторы не ждали по секунде.
+    monkeypatch.setattr(main, "OUTBOX_PRIVATE_RATE", 20)
+    monkeypatch.setattr(main, "bot", fake_bot)
+
+    async def scenario():
+        outbox = main.OutboundQueue()
+        outbox.start()
+        futures = [outbox.send(chat_id, text) for chat_id, text in sends]
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=5)
+        await outbox.stop()
+        return outbox, results
+
+    return asyncio.run(scenario())
+
+
+def test_retry_after_pauses_chat_and_retries(monkeypatch):
+    fake_bot = FakeBot({1: 1})
+    outbox, results = run_outbox(fake_bot, monkeypatch, [(1, "первое"), (-100, "в группу")])
+    assert results == [(1, "первое"), (-100, "в группу")]
+    # Группа не ждёт паузы личного чата.
+    assert fake_bot.sent == [(-100, "в группу"), (1, "первое")]
+    assert outbox.stats()["retried"] == 1 and outbox.stats()["sent"] == 2 and outbox.stats()["failed"] == 0
+
+
+def test_retry_after_gives_up(monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_MAX_RETRIES", 2)
+    fake_bot = FakeBot({1: 10})
+    outbox, results = run_outbox(fake_bot, monkeypatch, [(1, "не дойдёт")])
+    assert results == [None]
+    assert fake_bot.retry_after[1] == 7  # первая попытка и два повтора
+    assert outbox.stats()["retried"] == 2 and outbox.stats()["failed"] == 1
+
+
+def test_busy_chat_does_not_block_others(monkeypatch):
+    fake_bot = FakeBot({})
+    outbox, _ = run_outbox(fake_bot, monkeypatch, [(1, "a"), (1, "b"), (2, "c")])
+    assert fake_bot.sent == [(1, "a"), (2, "c"), (1, "b")]
+    assert outbox.stats()["throttled"] >= 1
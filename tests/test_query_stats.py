@@ -0,0 +1,59 @@
+"""Статистика запросов: нормализация текста SQL, гистограмма задержек и учёт ожидания соединения из пула."""
+import logging
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM users WHERE user_id = $1", "SELECT * FROM users WHERE user_id = $1"),
+    ("SELECT * FROM users WHERE user_id = 42 LIMIT 10", "SELECT * FROM users WHERE user_id = ? LIMIT ?"),
+    ("UPDATE users SET nick = 'O''Brien', hide_level = 'f' WHERE user_id = $2", "UPDATE users SET nick = ?, hide_level = ? WHERE user_id = $2"),
+    ("SELECT col1, t2.x FROM t2 WHERE a > 3 OFFSET 20", "SELECT col1, t2.x FROM t2 WHERE a > ? OFFSET ?"),
+    ("SELECT 1\n    FROM  users\n\tWHERE x = $10", "SELECT ? FROM users WHERE x = $10"),
+])
+def test_normalize_sql(query, expected):
+    assert main.normalize_sql(query) == expected
+
+
+def test_latency_stat_buckets_and_quantiles():
+    stat = main.LatencyStat()
+    for elapsed in [0.0005] * 90 + [0.02] * 9 + [30.0]:
+        stat.observe(elapsed)
+    stat.observe(0.003, failed=True)
+    assert stat.calls == 101 and stat.errors == 1 and stat.max == 30.0
+    assert stat.buckets[0] == 90 and stat.buckets[-1] == 1 and sum(stat.buckets) == 101
+    assert stat.quantile(0.5) == 0.001
+    assert stat.quantile(0.95) == 0.025
+    # Хвост за последней границей — максимум.
+    assert stat.quantile(1.0) == 30.0
+
+
+def test_query_stats_groups_and_logs_slow(caplog):
+    stats = main.QueryStats(slow_threshold_ms=100)
+    stats.observe("SELECT * FROM users WHERE user_id = 1", 0.01, rows=1, failed=False)
+    stats.observe("SELECT * FROM users  WHERE user_id = 2", 0.02, rows=1, failed=False)
+    with caplog.at_level(logging.WARNING, logger="main"):
+        stats.observe("DELETE FROM pets WHERE last_care_at < $1", 0.5, rows=3, failed=True)
+    assert len(stats.statements) == 2
+    select = stats.statements["SELECT * FROM users WHERE user_id = ?"]
+    assert select.calls == 2 and select.rows == 2
+    assert stats.stats()["slow"] == 1 and stats.stats()["errors"] == 1
+    assert "Медленный запрос" in caplog.text
+    assert [key for key, _ in stats.top(1)] == ["DELETE FROM pets WHERE last_care_at < $1"]
+
+
+def test_query_stats_counts_only_blocked_waits():
+    stats = main.QueryStats(slow_threshold_ms=100)
+    # Свободное соединение: в очередь не встаёт.
+    blocked = stats.begin_wait(exhausted=False)
+    stats.end_wait(0.0001, blocked)
+    # Два запроса ждут, один дожидается, другой падает по таймауту.
+    first, second = stats.begin_wait(exhausted=True), stats.begin_wait(exhausted=True)
+    assert stats.stats()["waiting"] == 2
+    stats.end_wait(0.2, first)
+    stats.end_wait(1.0, second, acquired=False, timed_out=True)
+    result = stats.stats()
+    assert result["waiting"] == 0 and result["waiting_max"] == 2 and result["exhausted"] == 2 and result["acquire_timeouts"] == 1
+    assert result["acquires"] == 2 and result["wait_max"] == 0.2
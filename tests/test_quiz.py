@@ -0,0 +1,59 @@
+"""Викторина: разбор файла импорта (JSON и CSV) и колоды вопросов без повторов."""
+import json
+
+import pytest
+
+import main
+
+
+def test_parse_json():
+    data = json.dumps([{"question": " Столица Франции? ", "options": ["Париж", " Лион "], "answer": "Париж"}], ensure_ascii=False).encode()
+    assert main.parse_quiz_file("Quiz.JSON", data) == [("Столица Франции?", ["Париж", "Лион"], "Париж")]
+
+
+def test_parse_csv_with_bom_and_any_number_of_options():
+    data = "\ufeffquestion,answer,option1,option2,option3\n2+2?,4,3,4,5\nНебо?,синее,синее,зелёное,\n".encode()
+    assert main.parse_quiz_file("quiz.csv", data) == [("2+2?", ["3", "4", "5"], "4"), ("Небо?", ["синее", "зелёное"], "синее")]
+
+
+@pytest.mark.parametrize("items, message", [
+    ([{"question": "", "options": ["a", "b"], "answer": "a"}], "вопрос №1"),
+    ([{"question": "q", "options": ["a", "b"], "answer": "a"}, {"question": "q", "options": ["a"], "answer": "a"}], "вопрос №2"),
+    ([{"question": "q", "options": ["a", "b"], "answer": "c"}], "правильный ответ"),
+    ([{"question": "q", "options": ["a", "б" * 30], "answer": "a"}], "слишком длинный"),
+])
+def test_parse_rejects_invalid(items, message):
+    with pytest.raises(ValueError, match=message):
+        main.parse_quiz_file("quiz.json", json.dumps(items, ensure_ascii=False).encode())
+
+
+def test_parse_missing_column():
+    with pytest.raises(KeyError):
+        main.parse_quiz_file("quiz.csv", b"question,option1,option2\nq,a,b\n")
+
+
+def make_bank(count: int, deck_cache_size: int = 10) -> main.QuizBank:
+    bank = main.QuizBank(deck_cache_size)
+    bank.questions = {i: {"question_id": i, "question_text": f"q{i}", "options": ("a", "b"), "correct_answer": "a"} for i in range(count)}
+    return bank
+
+
+def test_deck_has_no_repeats_until_exhausted():
+    bank = make_bank(20)
+    first_round = [bank.draw(1)["question_id"] for _ in range(20)]
+    assert sorted(first_round) == list(range(20))
+    # Колода кончилась — выдаётся новая, снова без повторов.
+    second_round = [bank.draw(1)["question_id"] for _ in range(20)]
+    assert sorted(second_round) == list(range(20))
+    assert bank.draws == 40
+
+
+def test_deck_skips_removed_questions_and_evicts_old_users():
+    bank = make_bank(10, deck_cache_size=2)
+    bank.draw(1)
+    for question_id in range(5): bank.questions.pop(question_id)
+    assert all(bank.draw(1)["question_id"] >= 5 for _ in range(5))
+    bank.draw(2)
+    bank.draw(3)
+    assert list(bank._decks) == [2, 3]
+    assert make_bank(0).draw(1) is None
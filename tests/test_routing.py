@@ -0,0 +1,76 @@
+"""Маршрутизация команд: classify_text разбирает текст так же, как прежний набор фильтров or_f(Command(...), F.text...) на обработчиках."""
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram import F
+from aiogram.filters import Command, or_f
+from aiogram.types import Chat, Message, User
+
+import main
+
+BOT_USERNAME = "LizardBot"
+
+# Фильтры обработчиков до перехода на classify_command, в порядке регистрации: срабатывает первый подошедший.
+OLD_FILTERS = [
+    ("start", or_f(Command("start", "help", "старт", "помощь"), F.text.lower().in_(['start', 'help', 'старт', 'помощь']))),
+    ("profile", or_f(Command("profile", "профиль"), F.text.lower().in_(['profile', 'профиль']))),
+    ("setnick", or_f(Command("setnick", "ник"), F.text.lower().startswith(('ник ', 'setnick ')))),
+    ("delnick", or_f(Command("delnick", "удалитьник"), F.text.lower().in_(['delnick', 'удалитьник']))),
+    ("hunt", or_f(Command("hunt", "охота"), F.text.lower().in_(['hunt', 'охота']))),
+    ("pay", or_f(Command("pay", "перевод"), F.text.lower().startswith(('pay ', 'перевод ')))),
+    ("privacy", Command("privacy")),
+    ("casinostats", Command("casinostats")),
+    ("adminprofile", Command("adminprofile", "админпрофиль")),
+    ("casino", or_f(Command("casino", "казино"), F.text.lower().in_(['casino', 'казино']), F.text.lower().startswith(('casino ', 'казино ')))),
+    ("dice", or_f(Command("dice", "кости"), F.text.lower().in_(['dice', 'кости']), F.text.lower().startswith(('кости ', 'dice ')))),
+    ("mypet", or_f(Command("mypet", "мойпитомец"), F.text.lower().in_(['mypet', 'мойпитомец']))),
+    ("shop", or_f(Command("shop", "магазин"), F.text.lower().in_(['shop', 'магазин']))),
+    ("topup", or_f(Command("topup", "пополнить"), F.text.lower().in_(['topup', 'пополнить']))),
+    ("cancel", or_f(Command("cancel", "отмена"), F.text.lower().in_(['cancel', 'отмена']))),
+    ("marry", or_f(Command("marry", "женить"), F.text.lower().in_(['marry', 'женить']))),
+    ("accept", or_f(Command("accept", "принять"), F.text.lower().in_(['accept', 'принять']))),
+    ("divorce", or_f(Command("divorce", "развод"), F.text.lower().in_(['divorce', 'развод']))),
+    ("ping", or_f(Command("ping", "пинг"), F.text.lower().in_(['ping', 'пинг']), F.text.lower().startswith(('ping ', 'пинг ')))),
+]
+OLD_ALIASES = [alias for name, _ in OLD_FILTERS for alias in main.COMMANDS[name][0]]
+
+
+class FakeBot:
+    async def me(self): return User(id=1, is_bot=True, first_name="Ящерка", username=BOT_USERNAME)
+
+
+def variants(alias: str) -> list:
+    return [alias, alias.upper(), alias.capitalize(), f"{alias} 100", f"{alias} ", f"{alias}100", f"{alias}\n100", f"ну {alias}",
+            f"/{alias}", f"/{alias.capitalize()}", f"/{alias} 5 @user", f"/{alias}@{BOT_USERNAME}", f"/{alias}@{BOT_USERNAME.lower()} 1", f"/{alias}@otherbot", f" /{alias}"]
+
+
+async def old_route(text: str, is_caption: bool):
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=-100, type="supergroup"), text=None if is_caption else text, caption=text if is_caption else None)
+    for name, old_filter in OLD_FILTERS:
+        if await old_filter(message, bot=FakeBot()): return name
+    return None
+
+
+@pytest.mark.parametrize("is_caption", [False, True], ids=["text", "caption"])
+def test_routing_matches_old_filters(is_caption):
+    texts = [text for alias in OLD_ALIASES for text in variants(alias)] + ["привет", "/", "/unknown", "казинo", ""]
+
+    async def routes():
+        return [await old_route(text, is_caption) for text in texts]
+
+    expected = asyncio.run(routes())
+    actual = [main.classify_text(text, is_caption, BOT_USERNAME)[0] if text else None for text in texts]
+    mismatches = [(text, old, new) for text, old, new in zip(texts, expected, actual) if old != new]
+    assert mismatches == []
+
+
+def test_command_object():
+    name, command = main.classify_text("Казино 100 red")
+    assert name == "casino" and command.prefix == "" and command.args == "100 red"
+    name, command = main.classify_text(f"/dice@{BOT_USERNAME} 50", bot_username=BOT_USERNAME)
+    assert name == "dice" and command.command == "dice" and command.mention == BOT_USERNAME and command.args == "50"
+    assert main.classify_text("/top неделя")[1].args == "неделя"
+    name, command = main.classify_text("топ")
+    assert name == "top" and command.args is None
+    assert main.classify_text("профиль", is_caption=True) == (None, None)
@@ -0,0 +1,39 @@
+"""Планировщик: отложенное уведомление сохраняется в scheduled_jobs, переживает рестарт (load()) и срабатывает."""
+import asyncio
+import time
+
+import main
+import storage
+
+
+def test_notify_survives_restart(tmp_path, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main.outbox, "send", lambda chat_id, text, **kwargs: sent.append((chat_id, text, kwargs)))
+
+    async def scenario():
+        backend = await storage.SqliteBackend.connect(str(tmp_path / "jobs.db"))
+        monkeypatch.setattr(main, "db_pool", backend)
+        try:
+            async with backend.acquire() as connection:
+                await connection.execute("CREATE TABLE scheduled_jobs (job_key TEXT PRIMARY KEY, kind TEXT NOT NULL, run_at DOUBLE PRECISION NOT NULL, payload JSONB NOT NULL DEFAULT '{}')")
+            # Первый процесс ставит уведомление, сбрасывает его в БД и «падает», не дождавшись срока.
+            before = main.Scheduler(60)
+            before.handler("notify")(main.job_notify)
+            monkeypatch.setattr(main, "scheduler", before)
+            main.notify_later("notify:42", 42, "⏰ Напоминание", time.time() + 0.1, parse_mode="HTML")
+            await before.flush()
+            assert sent == []
+            # После рестарта задание читается из БД и срабатывает в срок.
+            after = main.Scheduler(60)
+            after.handler("notify")(main.job_notify)
+            await after.load()
+            assert after.stats()["by_kind"] == {"notify": 1}
+            after.start()
+            await asyncio.sleep(0.3)
+            await after.stop()
+            assert sent == [(42, "⏰ Напоминание", {"parse_mode": "HTML"})]
+            assert after.stats()["fired"] == 1
+            async with backend.acquire() as connection: assert await connection.fetchval("SELECT COUNT(*) FROM scheduled_jobs") == 0
+        finally: await backend.close()
+
+    asyncio.run(scenario())
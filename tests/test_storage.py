@@ -0,0 +1,123 @@
+"""Контракт соединения storage.py: один и тот же набор проверок для SqliteBackend и PostgresBackend.
+
+PostgreSQL проверяется, только если DB_URL указывает на него (postgres:// или postgresql://), иначе эти тесты пропускаются.
+Запуск: python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+POSTGRES_URL = os.getenv("DB_URL", "")
+HAS_POSTGRES = POSTGRES_URL.startswith(("postgres://", "postgresql://"))
+
+
+async def open_backend(kind: str, tmp_path):
+    # Пул из одного соединения: временные таблицы видны во всех запросах теста, а второй acquire упирается в таймаут.
+    if kind == "sqlite": return await storage.SqliteBackend.connect(str(tmp_path / "contract.db"), acquire_timeout=0.2)
+    return await storage.PostgresBackend.connect(POSTGRES_URL, acquire_timeout=0.2, min_size=1, max_size=1)
+
+
+@pytest.fixture(params=["sqlite", pytest.param("postgres", marks=pytest.mark.skipif(not HAS_POSTGRES, reason="DB_URL не указывает на PostgreSQL"))])
+def run(request, tmp_path):
+    # run(test) открывает бэкенд, создаёт временную таблицу items и выполняет async-тест test(backend).
+    def runner(test):
+        async def main():
+            backend = await open_backend(request.param, tmp_path)
+            try:
+                async with backend.acquire() as connection:
+                    await connection.execute("CREATE TEMP TABLE items (item_id BIGINT PRIMARY KEY, name TEXT NOT NULL, score INTEGER DEFAULT 0)")
+                await test(backend)
+            finally: await backend.close()
+        asyncio.run(main())
+    return runner
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM users WHERE user_id = $1 AND level > $2", "SELECT * FROM users WHERE user_id = ?1 AND level > ?2"),
+    ("SELECT * FROM users WHERE user_id = ANY($1::bigint[])", "SELECT * FROM users WHERE user_id IN (SELECT value FROM json_each(?1))"),
+    ("SELECT date_trunc('week', day)::date FROM t", "SELECT date(day, '-6 days', 'weekday 1') FROM t"),
+    ("SELECT date_trunc('month', day)::date FROM t", "SELECT date(day, 'start of month') FROM t"),
+    ("SELECT $1::double precision, $2::text", "SELECT ?1, ?2"),
+    ("SELECT GREATEST(a, b), LEAST(a, b) FROM t", "SELECT MAX(a, b), MIN(a, b) FROM t"),
+    ("UPDATE t SET a = $1 WHERE a IS DISTINCT FROM $1", "UPDATE t SET a = ?1 WHERE a IS NOT ?1"),
+    ("CREATE TABLE t (id BIGSERIAL PRIMARY KEY, data JSONB)", "CREATE TABLE t (id INTEGER PRIMARY KEY, data TEXT)"),
+])
+def test_translate_sql(query, expected):
+    assert storage.translate_sql(query) == expected
+
+
+def test_sqlite_path():
+    assert storage.sqlite_path("sqlite:///tmp/bot.db") == "/tmp/bot.db"
+    assert storage.sqlite_path("sqlite:bot.db") == "bot.db"
+    assert storage.sqlite_path("postgresql://localhost/bot") is None
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError): storage.Backend()
+
+
+def test_fetchval_and_fetchrow(run):
+    async def test(backend):
+        async with backend.acquire() as connection:
+            assert await connection.fetchval("SELECT $1::bigint + 1", 41) == 42
+            row = await connection.fetchrow("SELECT $1::text AS name, $2::bigint AS score", "змей", 7)
+            assert row["name"] == "змей" and row[1] == 7
+            assert await connection.fetchrow("SELECT item_id FROM items WHERE item_id = $1", 1) is None
+            assert await connection.fetchval("SELECT item_id FROM items WHERE item_id = $1", 1) is None
+    run(test)
+
+
+def test_execute_status_and_any(run):
+    async def test(backend):
+        async with backend.acquire() as connection:
+            assert await connection.execute("INSERT INTO items (item_id, name) VALUES ($1, $2), ($3, $4)", 1, "a", 2, "b") == "INSERT 0 2"
+            assert await connection.execute("UPDATE items SET score = GREATEST(score, $1) WHERE item_id = ANY($2::bigint[])", 5, [1, 2, 3]) == "UPDATE 2"
+            await connection.executemany("INSERT INTO items (item_id, name) VALUES ($1, $2) ON CONFLICT (item_id) DO UPDATE SET name = EXCLUDED.name", [(2, "bb"), (3, "c")])
+            rows = await connection.fetch("SELECT item_id, name, score FROM items ORDER BY item_id")
+            assert [(row["item_id"], row["name"], row["score"]) for row in rows] == [(1, "a", 5), (2, "bb", 5), (3, "c", 0)]
+    run(test)
+
+
+def test_transaction_rollback(run):
+    async def test(backend):
+        async with backend.acquire() as connection:
+            await connection.execute("INSERT INTO items (item_id, name) VALUES ($1, $2)", 1, "kept")
+            with pytest.raises(RuntimeError):
+                async with connection.transaction():
+                    await connection.execute("INSERT INTO items (item_id, name) VALUES ($1, $2)", 2, "rolled back")
+                    await connection.execute("UPDATE items SET name = $1 WHERE item_id = $2", "changed", 1)
+                    raise RuntimeError("откат")
+            async with connection.transaction():
+                await connection.execute("INSERT INTO items (item_id, name) VALUES ($1, $2)", 3, "committed")
+            rows = await connection.fetch("SELECT item_id, name FROM items ORDER BY item_id")
+            assert [(row["item_id"], row["name"]) for row in rows] == [(1, "kept"), (3, "committed")]
+    run(test)
+
+
+def test_copy_records_to_table(run):
+    async def test(backend):
+        records = [(i, f"item {i}", i * 10) for i in range(1, 501)]
+        async with backend.acquire() as connection:
+            status = await connection.copy_records_to_table("items", records=records, columns=["item_id", "name", "score"])
+            assert status == "COPY 500"
+            assert await connection.fetchval("SELECT COUNT(*) FROM items") == 500
+            assert await connection.fetchval("SELECT SUM(score) FROM items") == sum(record[2] for record in records)
+    run(test)
+
+
+def test_acquire_timeout(run):
+    async def test(backend):
+        assert backend.get_max_size() == 1
+        async with backend.acquire():
+            assert backend.get_idle_size() == 0
+            with pytest.raises(asyncio.TimeoutError):
+                async with backend.acquire(): pass
+        # После отказа соединение снова выдаётся.
+        async with backend.acquire() as connection: assert await connection.fetchval("SELECT 1") == 1
+    run(test)